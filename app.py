@@ -1,40 +1,85 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, make_response
+from flask import Blueprint, Flask, current_app, render_template, request, redirect, url_for, jsonify, make_response
 from flask_mail import Mail, Message
 from flask_login import LoginManager, UserMixin, login_user, login_required, current_user, logout_user
 from dotenv import load_dotenv
+import csv
+import hashlib
+import json
+import math
 import secrets
 import time
 import sqlite3
 import os
 import logging
+import threading
+import uuid
+import click
 from datetime import datetime, timedelta
+from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
-
-# Configurar logging para debugging
-logging.basicConfig(level=logging.DEBUG)
-
-# -----------------------------
-# Carregar variáveis de ambiente (.env)
-# -----------------------------
-load_dotenv()
+from database import Database, get_db, read_transaction, run_write
+from migrations import migrate
+import gamification
+import segmentation
+import city_stats
+import reservations
+import campaigns
+import pagination
+import exports
+import password_reset
+from versions import TableVersions
+from response_cache import ResponseCache
+from page_cache import PageCache
+from assets import AssetPipeline
+from jobs import DispatchQueue
+from mailer import SMTPSession
+from email_log import EmailLogBuffer, delivery_stats
+import user_context
+from structured_logging import StructuredLogging, mask_email
+from metrics import Metrics
+from donor_import import DonorImporter, ImportBusy, detect_format
+from broadcast import CampaignBroadcaster
 
 # -----------------------------
-# Inicialização da Aplicação
+# Extensões (ligadas à aplicação em create_app)
 # -----------------------------
-app = Flask(__name__)
-
-campanhas_db = [
-    {"id": 1, "nome": "Urgência O- Hospital X", "tipo_sanguineo": "O-", "vagas": 50, "participantes": 12, "status": "Ativa"},
-    {"id": 2, "nome": "Doação Geral de Verão", "tipo_sanguineo": "Todos", "vagas": 100, "participantes": 85, "status": "Ativa"},
-    {"id": 3, "nome": "AB+ Maternidade Central", "tipo_sanguineo": "AB+", "vagas": 30, "participantes": 30, "status": "Encerrada"},
-]
-# Define o próximo ID, essencial para a função POST
-proximo_id = 4
+structured_logging = StructuredLogging()
+db = Database()
+mail = Mail()
+assets = AssetPipeline()
+# Per-table version counters (shared by all workers through the database and a
+# stamp file) and the ETag/response cache built on them
+table_versions = TableVersions()
+response_cache = ResponseCache()
+# Rendered pages for anonymous visitors (index, cadastro, login, ...)
+page_cache = PageCache()
+# Campaign changes pushed to open pages (/api/campaigns/stream)
+broadcaster = CampaignBroadcaster()
+email_log = EmailLogBuffer(db)
+dispatch = DispatchQueue()
+# Bulk donor imports from partner CSV/JSONL files (donor_import.py)
+donor_importer = DonorImporter()
+
+# Prometheus metrics (metrics.py), served on /metrics; gauges are read at
+# scrape time
+metrics = Metrics()
+metrics.gauge('db_pool', 'SQLite connection pool state.', lambda: db.pool.stats(), label='stat')
+metrics.gauge('db_locks', 'SQLITE_BUSY handling in run_write.', lambda: db.lock_stats.snapshot(), label='stat')
+metrics.gauge('response_cache', 'ETag response cache.', lambda: response_cache.entries.stats(), label='stat')
+metrics.gauge('page_cache', 'Anonymous page cache.', lambda: page_cache.entries.stats(), label='stat')
+metrics.gauge('email_log_buffer', 'Buffered email_logs writer.', lambda: {
+    'pending': len(email_log._rows), 'flushed_rows': email_log.flushed_rows,
+    'flushes': email_log.flushes, 'dropped_rows': email_log.dropped_rows}, label='stat')
+metrics.gauge('log_queue', 'Background log writer queue.', lambda: structured_logging.stats(), label='stat')
+metrics.gauge('campaign_stream', 'Campaign SSE subscribers and events.', lambda: broadcaster.stats(), label='stat')
 
 # Flask-Login
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+login_manager.login_view = 'main.login'
+
+# Every route lives on this blueprint; cli_group=None keeps the commands at
+# the top level (``flask init-db``, not ``flask main init-db``).
+bp = Blueprint('main', __name__, cli_group=None)
 
 
 # For AJAX/API calls we prefer JSON 401 responses instead of HTML redirects.
@@ -45,141 +90,261 @@ def unauthorized_callback():
             return jsonify({'error': 'unauthorized'}), 401
     except Exception:
         pass
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
+
 
 # -----------------------------
-# Configurações do Flask
+# Configurações (via .env)
 # -----------------------------
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+def load_config():
+    """Application settings read from the environment."""
+    return {
+        'SECRET_KEY': os.getenv('SECRET_KEY'),
+        # development, testing or production; picks the logging defaults
+        'APP_ENV': os.getenv('APP_ENV') or os.getenv('FLASK_ENV', 'development'),
+
+        # Logging (see structured_logging.py): root level (default per APP_ENV),
+        # json or text, per-endpoint sampling of below-WARNING lines
+        'LOG_LEVEL': os.getenv('LOG_LEVEL'),
+        'LOG_FORMAT': os.getenv('LOG_FORMAT'),
+        'LOG_SAMPLE_RATES': os.getenv('LOG_SAMPLE_RATES', ''),
+        'LOG_ASYNC': os.getenv('LOG_ASYNC', 'True') == 'True',
+        'LOG_QUEUE_SIZE': int(os.getenv('LOG_QUEUE_SIZE', 10000)),
+
+        # Metrics (see metrics.py); /metrics also accepts
+        # "Authorization: Bearer <METRICS_TOKEN>" for scrapers without a session
+        'METRICS_ENABLED': os.getenv('METRICS_ENABLED', 'True') == 'True',
+        'METRICS_TOKEN': os.getenv('METRICS_TOKEN'),
+        # Log requests slower than this (ms) with their SQL statements
+        'METRICS_SLOW_REQUEST_MS': os.getenv('METRICS_SLOW_REQUEST_MS'),
+
+        # E-mail
+        'MAIL_SERVER': os.getenv('EMAIL_HOST'),
+        'MAIL_PORT': int(os.getenv('EMAIL_PORT', 587)),
+        'MAIL_USE_TLS': os.getenv('EMAIL_USE_TLS', 'True') == 'True',
+        'MAIL_USERNAME': os.getenv('EMAIL_HOST_USER'),
+        'MAIL_PASSWORD': os.getenv('EMAIL_HOST_PASSWORD'),
+        'MAIL_DEFAULT_SENDER': (
+            os.getenv('MAIL_DEFAULT_NAME', 'Suporte'),
+            os.getenv('EMAIL_HOST_USER')
+        ),
+
+        # Pool de conexões SQLite e PRAGMAs
+        'DATABASE': os.getenv('DATABASE_PATH', 'database.db'),
+        'DB_POOL_SIZE': int(os.getenv('DB_POOL_SIZE', 8)),
+        'DB_POOL_TIMEOUT': float(os.getenv('DB_POOL_TIMEOUT', 5)),
+        'DB_POOL_PREFILL': os.getenv('DB_POOL_PREFILL', 'False') == 'True',
+        'DB_JOURNAL_MODE': os.getenv('DB_JOURNAL_MODE', 'WAL'),
+        'DB_BUSY_TIMEOUT_MS': int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000)),
+        'DB_WRITE_RETRIES': int(os.getenv('DB_WRITE_RETRIES', 5)),
+        'DB_WAL_AUTOCHECKPOINT': int(os.getenv('DB_WAL_AUTOCHECKPOINT', 1000)),
+        # Apply pending migrations on the first request/background start of
+        # each process; with False run ``flask init-db`` on deploy instead.
+        'AUTO_MIGRATE': os.getenv('AUTO_MIGRATE', 'True') == 'True',
+
+        # Fingerprinted static files (python assets.py / flask build-assets)
+        'ASSET_BUNDLING': os.getenv('ASSET_BUNDLING', 'False') == 'True',
+
+        # Caches
+        'RESPONSE_CACHE_ENABLED': os.getenv('RESPONSE_CACHE_ENABLED', 'True') == 'True',
+        'RESPONSE_CACHE_ENTRIES': int(os.getenv('RESPONSE_CACHE_ENTRIES', 256)),
+        'PAGE_CACHE_ENABLED': os.getenv('PAGE_CACHE_ENABLED', 'True') == 'True',
+        'PAGE_CACHE_ENTRIES': int(os.getenv('PAGE_CACHE_ENTRIES', 128)),
+        # Per-user template context cache (seconds)
+        'USER_CONTEXT_TTL': float(os.getenv('USER_CONTEXT_TTL', 5)),
+
+        # Server-Sent Events (broadcast.py): every open stream holds a server
+        # thread, so SSE_MAX_CLIENTS caps them per process (under gunicorn it
+        # defaults to half of WEB_THREADS, see gunicorn.conf.py)
+        'SSE_MAX_CLIENTS': int(os.getenv('SSE_MAX_CLIENTS', 32)),
+        'SSE_HEARTBEAT': float(os.getenv('SSE_HEARTBEAT', 15)),
+        'SSE_MAX_DURATION': float(os.getenv('SSE_MAX_DURATION', 300)),
+        'SSE_POLL_INTERVAL': float(os.getenv('SSE_POLL_INTERVAL', 1)),
+
+        # Fila de disparo de campanhas
+        'DISPATCH_WORKERS': int(os.getenv('DISPATCH_WORKERS', 2)),
+        'DISPATCH_BATCH_SIZE': int(os.getenv('DISPATCH_BATCH_SIZE', 50)),
+        # Messages sent over one SMTP connection before it is closed and reopened
+        'SMTP_ROTATE_AFTER': int(os.getenv('SMTP_ROTATE_AFTER', 100)),
+        # email_logs buffering: flush every N rows or T seconds
+        'EMAIL_LOG_FLUSH_ROWS': int(os.getenv('EMAIL_LOG_FLUSH_ROWS', 200)),
+        'EMAIL_LOG_FLUSH_INTERVAL': float(os.getenv('EMAIL_LOG_FLUSH_INTERVAL', 2)),
+        # Under the pre-forking server (gunicorn.conf.py) threads are started in
+        # each worker after the fork instead, never in the master.
+        'BACKGROUND_WORKERS_AUTOSTART': os.getenv('BACKGROUND_WORKERS_AUTOSTART', 'True') == 'True',
+
+        # Importação em massa de doadores: rows per transaction, password
+        # hashing processes (0 hashes in the importing thread) and where
+        # uploaded files are kept until imported
+        'IMPORT_BATCH_SIZE': int(os.getenv('IMPORT_BATCH_SIZE', 500)),
+        'IMPORT_HASH_WORKERS': int(os.getenv('IMPORT_HASH_WORKERS', os.cpu_count() or 1)),
+        'IMPORT_DIR': os.getenv('IMPORT_DIR', 'imports'),
+
+        # Validity (seconds) of password reset links: requested from
+        # /recuperar, and handed out to donors imported without a password
+        'PASSWORD_RESET_TTL': int(os.getenv('PASSWORD_RESET_TTL', 3600)),
+        'IMPORT_INVITE_TTL': int(os.getenv('IMPORT_INVITE_TTL', 14 * 24 * 3600)),
+    }
 
-# If SECRET_KEY is not provided via environment (common in local/dev),
-# generate a secure random key so Flask session machinery (and Flask-Login)
-# can work. In production provide a fixed secret via the SECRET_KEY env var.
-if not app.config.get('SECRET_KEY'):
-    generated_secret = secrets.token_urlsafe(32)
-    app.config['SECRET_KEY'] = generated_secret
-    logging.warning('SECRET_KEY was not set in environment; generated a temporary key for session support (not for production).')
 
 # -----------------------------
-# Configuração de E-mail (via .env)
+# Inicialização da Aplicação
 # -----------------------------
-app.config['MAIL_SERVER'] = os.getenv('EMAIL_HOST')
-app.config['MAIL_PORT'] = int(os.getenv('EMAIL_PORT', 587))
-app.config['MAIL_USE_TLS'] = os.getenv('EMAIL_USE_TLS', 'True') == 'True'
-app.config['MAIL_USERNAME'] = os.getenv('EMAIL_HOST_USER')
-app.config['MAIL_PASSWORD'] = os.getenv('EMAIL_HOST_PASSWORD')
-app.config['MAIL_DEFAULT_SENDER'] = (
-    os.getenv('MAIL_DEFAULT_NAME', 'Suporte'),
-    os.getenv('EMAIL_HOST_USER')
-)
-
-mail = Mail(app)
+def create_app(config=None):
+    """Build the application; ``config`` overrides the environment settings.
+
+    Nothing touches the database schema here: migrations run from
+    ``flask init-db`` or, with ``AUTO_MIGRATE``, once per process on first use.
+    """
+    load_dotenv()
+    app = Flask(__name__)
+    app.config.update(load_config())
+    app.config.update(config or {})
+    structured_logging.init_app(app)
+
+    # If SECRET_KEY is not provided via environment (common in local/dev),
+    # generate a secure random key so Flask session machinery (and Flask-Login)
+    # can work. In production provide a fixed secret via the SECRET_KEY env var.
+    if not app.config.get('SECRET_KEY'):
+        app.config['SECRET_KEY'] = secrets.token_urlsafe(32)
+        logging.warning('SECRET_KEY was not set in environment; generated a temporary key for session support (not for production).')
+
+    mail.init_app(app)
+    login_manager.init_app(app)
+    db.init_app(app)
+    metrics.init_app(app, db)
+    assets.init_app(app)
+    table_versions.init_app(app, db)
+    response_cache.init_app(app, table_versions)
+    broadcaster.init_app(app, db, table_versions)
+    page_cache.init_app(app)
+    user_context.configure(app.config['USER_CONTEXT_TTL'])
+    email_log.init_app(app)
+    dispatch.init_app(app, db, enviar_email,
+                      open_session=lambda: SMTPSession(mail, rotate_after=app.config['SMTP_ROTATE_AFTER']),
+                      email_log=email_log)
+    donor_importer.init_app(app, db)
+    app.register_blueprint(bp)
+
+    if app.config['AUTO_MIGRATE']:
+        app.before_request(ensure_schema)
+    if app.config['BACKGROUND_WORKERS_AUTOSTART']:
+        start_background_workers()
+    return app
+
 
 # -----------------------------
 # Banco de Dados
 # -----------------------------
+_schema_lock = threading.Lock()
+_schema_ready = set()
+
+
 def init_db():
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
-    
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS usuarios (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT,
-            email TEXT,
-            telefone TEXT,
-            tipo_sanguineo TEXT,
-            data_nascimento TEXT,
-            genero TEXT,
-            cep TEXT,
-            endereco TEXT,
-            ja_doou TEXT,
-            primeira_vez TEXT,
-            interesse TEXT,
-            autoriza_msg INTEGER,
-            autoriza_dados INTEGER,
-            pontos INTEGER DEFAULT 0,
-            senha TEXT
-        )
-    ''')
-
-    c.execute("PRAGMA table_info(usuarios)")
-    columns = [col[1] for col in c.fetchall()]
-    if 'senha' not in columns:
-        c.execute('ALTER TABLE usuarios ADD COLUMN senha TEXT')
-    if 'nivel' not in columns:
-        # store donor level (e.g. 'Doador Iniciante', 'Doador Comprometido', 'Doador Heróico')
-        c.execute("ALTER TABLE usuarios ADD COLUMN nivel TEXT DEFAULT 'Doador Iniciante'")
-
-    conn.commit()
-    conn.close()
-
-    # Create a table to log email sends
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS email_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            campaign_name TEXT,
-            recipient_email TEXT,
-            status TEXT,
-            error TEXT,
-            sent_at TEXT,
-            admin_user_id INTEGER
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-init_db()
-
-# Create campaigns table if missing
-def init_campaigns_table():
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS campanhas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT NOT NULL,
-            tipo_sanguineo TEXT,
-            vagas INTEGER DEFAULT 0,
-            participantes INTEGER DEFAULT 0,
-            status TEXT DEFAULT 'Ativa',
-            created_at TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-init_campaigns_table()
-
-
-# Create participations table
-def init_participations_table():
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS participacoes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER NOT NULL,
-            campanha_id INTEGER NOT NULL,
-            joined_at TEXT,
-            UNIQUE(usuario_id, campanha_id)
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    """Bring the schema up to date (tables and indexes live in migrations.py)."""
+    with db.connection() as conn:
+        return migrate(conn)
+
+
+def ensure_schema():
+    """Run ``init_db`` once per process and database file."""
+    if db.pool.path in _schema_ready:
+        return
+    with _schema_lock:
+        if db.pool.path not in _schema_ready:
+            init_db()
+            _schema_ready.add(db.pool.path)
+
+
+@bp.cli.command('init-db')
+def init_db_command():
+    """Create or migrate the database schema."""
+    init_db()
+    _schema_ready.add(db.pool.path)
+    with db.connection() as conn:
+        print(f"Esquema na versão {conn.execute('PRAGMA user_version').fetchone()[0]}")
+
+
+@bp.cli.command('backfill-segments')
+def backfill_segments_command():
+    """Recompute usuarios.data_nascimento_iso and cidade_norm for every user."""
+    with db.connection() as conn:
+        print(f'{db.run_write(conn, segmentation.backfill)} usuários atualizados')
+
+
+@bp.cli.command('rebuild-city-stats')
+def rebuild_city_stats_command():
+    """Recompute the city_stats dashboard aggregate from usuarios."""
+    with db.connection() as conn:
+        print(f'{db.run_write(conn, city_stats.rebuild)} cidades agregadas')
+
+
+@bp.cli.command('import-donors')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False), required=False)
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Default: from the file extension.')
+@click.option('--resume', 'resume_id', type=int, help='Continue an interrupted import from its checkpoint.')
+@click.option('--invites', type=click.File('a', encoding='utf-8'),
+              help='Also append "email,token" here for every donor imported without a password: '
+                   'the token opens /redefinir_senha?token=... once (IMPORT_INVITE_TTL).')
+@click.option('--rejects', type=click.File('a', encoding='utf-8'), help='Append "line,reason" for rejected rows.')
+def import_donors_command(path, fmt, resume_id, invites, rejects):
+    """Import donors from a CSV or JSON Lines file."""
+    ensure_schema()
+    if resume_id is None:
+        if path is None:
+            raise click.UsageError('Informe o arquivo ou --resume')
+        with db.connection() as conn:
+            resume_id = db.run_write(conn, lambda conn: donor_importer.create(conn, path, fmt))
+        print(f'Importação {resume_id} criada')
+    reject_writer = csv.writer(rejects) if rejects else None
+
+    def show_progress(s):
+        print(f"{s['rows_read']} registros lidos, {s['inserted']} inseridos, "
+              f"{s['rejected']} rejeitados ({s['progress']:.0%})")
 
-init_participations_table()
+    try:
+        status = donor_importer.run(
+            resume_id,
+            rejects=(lambda *row: reject_writer.writerow(row)) if reject_writer else None,
+            progress=show_progress)
+    except ImportBusy:
+        raise click.ClickException(f'Importação {resume_id} já está em andamento')
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
+    print(f"Importação {resume_id}: {status['status']}, {status['inserted']} inseridos, "
+          f"{status['rejected']} rejeitados")
+    if invites:
+        ttl = current_app.config['IMPORT_INVITE_TTL']
+        with db.connection() as conn:
+            issued = db.run_write(conn, lambda conn: donor_importer.issue_invites(conn, resume_id, ttl))
+        csv.writer(invites).writerows(issued)
+        print(f'{len(issued)} convites gravados')
+
+
+@bp.cli.command('grant-admin')
+@click.argument('email')
+@click.option('--revoke', is_flag=True, help='Remove the admin flag instead.')
+def grant_admin_command(email, revoke):
+    """Give (or take away) access to the /api/admin routes."""
+    ensure_schema()
+    with db.connection() as conn:
+        changed = db.run_write(conn, lambda conn: conn.execute(
+            'UPDATE usuarios SET is_admin = ? WHERE email = ?', (0 if revoke else 1, email)).rowcount)
+    if not changed:
+        raise click.ClickException('Usuário não encontrado')
+    print('Acesso de administrador removido' if revoke else 'Acesso de administrador concedido')
 
 # -----------------------------
 # Função Genérica para Envio de E-mail
 # -----------------------------
-def enviar_email(para, assunto, mensagem):
+@metrics.track_email
+def enviar_email(para, assunto, mensagem, session=None):
+    """Envia um e-mail. Com ``session`` (mailer.SMTPSession) reaproveita a
+    conexão SMTP aberta em vez de abrir uma nova por mensagem."""
     try:
         # If SMTP not configured, write to an outbox folder for local testing
-        mail_server = app.config.get('MAIL_SERVER')
-        mail_user = app.config.get('MAIL_USERNAME')
+        mail_server = current_app.config.get('MAIL_SERVER')
+        mail_user = current_app.config.get('MAIL_USERNAME')
         if not mail_server or not mail_user:
             try:
                 os.makedirs('outbox', exist_ok=True)
@@ -187,169 +352,93 @@ def enviar_email(para, assunto, mensagem):
                 filename = f"outbox/{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}_{safe_email}.eml"
                 with open(filename, 'w', encoding='utf-8') as fh:
                     fh.write(f"To: {para}\nSubject: {assunto}\n\n{mensagem}")
-                logging.info(f"E-mail gravado em outbox (SMTP não configurado): {filename}")
+                logging.info('E-mail gravado em outbox (SMTP não configurado): %s', filename)
                 return {'status': 'sucesso', 'mensagem': f'E-mail gravado em outbox: {filename}'}
             except Exception:
                 logging.exception('Falha ao gravar e-mail em outbox')
                 # continue to attempt real send if possible
 
         # Compose and send real email
-        msg = Message(subject=assunto, recipients=[para], body=mensagem, sender=app.config.get('MAIL_DEFAULT_SENDER'))
-        mail.send(msg)
-        logging.info(f"E-mail enviado para {para} assunto='{assunto}'")
+        msg = Message(subject=assunto, recipients=[para], body=mensagem, sender=current_app.config.get('MAIL_DEFAULT_SENDER'))
+        if session is not None:
+            session.send(msg)
+        else:
+            mail.send(msg)
+        logging.info('E-mail enviado para %s', mask_email(para))
         return {'status': 'sucesso', 'mensagem': 'E-mail enviado com sucesso!'}
     except Exception as e:
-        logging.exception(f'Erro ao enviar email para {para}')
+        logging.exception('Erro ao enviar email para %s', mask_email(para))
         return {'status': 'erro', 'mensagem': str(e)}
 
 
+# -----------------------------
+# Threads em segundo plano
+# -----------------------------
+def start_background_workers():
+    """Start the email_logs flusher and the dispatch pool in this process."""
+    if dispatch.app.config['AUTO_MIGRATE']:
+        ensure_schema()
+    email_log.start()
+    dispatch.start()
+
+
+def stop_background_workers():
+    """Stop the dispatch pool, running imports and campaign streams, flush buffered email_logs rows."""
+    dispatch.stop()
+    donor_importer.stop()
+    broadcaster.stop()
+    email_log.stop()
+
+
 # --- Flask-Login user class and loader ---
 class User(UserMixin):
-    def __init__(self, id, email=None, nome=None):
+    def __init__(self, id, email=None, nome=None, is_admin=False):
         self.id = str(id)
         self.email = email
         self.nome = nome
+        self.is_admin = bool(is_admin)
 
 
 @login_manager.user_loader
 def load_user(user_id):
+    # Served from the per-user context cache, which inject_usuario reuses,
+    # so a page render costs at most one query for the current user.
     try:
-        conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute('SELECT * FROM usuarios WHERE id = ?', (int(user_id),))
-        row = c.fetchone()
-        conn.close()
-        if row:
-            return User(row['id'], row['email'], row['nome'])
+        ctx = user_context.get_user_context(user_id)
+        if ctx:
+            usuario = ctx['usuario']
+            return User(usuario['id'], usuario['email'], usuario['nome'], usuario['is_admin'])
     except Exception:
         return None
     return None
 
 
+def admin_required(view):
+    """Like ``login_required``, and answers 403 to users without ``usuarios.is_admin``
+    (granted with ``flask grant-admin``)."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return login_manager.unauthorized()
+        if not getattr(current_user, 'is_admin', False):
+            logging.info('Acesso administrativo negado para usuário ID: %s', current_user.id)
+            return jsonify({'error': 'forbidden'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+
 # Inject a safe `usuario` object into all templates so templates referencing
 # `usuario` don't raise UndefinedError when routes don't pass it explicitly.
-@app.context_processor
+# The values are lazy proxies: pages that never read them cost nothing.
+@bp.app_context_processor
 def inject_usuario():
-    try:
-        if getattr(current_user, 'is_authenticated', False):
-            uid = int(current_user.id)
-            conn = sqlite3.connect('database.db')
-            conn.row_factory = sqlite3.Row
-            c = conn.cursor()
-            c.execute('SELECT * FROM usuarios WHERE id = ?', (uid,))
-            row = c.fetchone()
-            if not row:
-                conn.close()
-                return {'usuario': {}}
-
-            usuario = dict(row)
-            # participations
-            c.execute('''
-                SELECT p.id as participacao_id, p.joined_at, c.*
-                FROM participacoes p
-                JOIN campanhas c ON p.campanha_id = c.id
-                WHERE p.usuario_id = ?
-                ORDER BY p.joined_at DESC
-            ''', (uid,))
-            parts = c.fetchall()
-            conn.close()
-            usuario['participacoes'] = [dict(r) for r in parts] if parts else []
-            participation_count = len(usuario['participacoes'])
-
-            # compute level
-            if participation_count >= 6:
-                nivel = 'Doador Heróico'
-            elif participation_count >= 3:
-                nivel = 'Doador Comprometido'
-            elif participation_count >= 1:
-                nivel = 'Doador Iniciante'
-            else:
-                nivel = usuario.get('nivel') or 'Não classificado'
-
-            usuario['nivel'] = usuario.get('nivel') or nivel
-
-            # thresholds
-            if participation_count >= 6:
-                next_threshold = 6
-                next_level_name = 'Nível Máximo'
-            elif participation_count >= 3:
-                next_threshold = 6
-                next_level_name = 'Doador Heróico'
-            elif participation_count >= 1:
-                next_threshold = 3
-                next_level_name = 'Doador Comprometido'
-            else:
-                next_threshold = 1
-                next_level_name = 'Doador Iniciante'
-
-            progresso = int(min(100, (participation_count / next_threshold) * 100)) if next_threshold else 0
-            usuario['participation_count'] = participation_count
-            usuario['next_threshold'] = next_threshold
-            usuario['next_level_name'] = next_level_name
-            usuario['participations_to_next'] = max(0, next_threshold - participation_count)
-            usuario['progress_text'] = f"{participation_count}/{next_threshold}"
-            usuario['progressoPercentual'] = progresso
-
-            # selos
-            selos = []
-            if usuario.get('ja_doou') == 'sim' or usuario.get('primeira_vez'):
-                selos.append({ 'nome': 'Primeira Doação', 'caminhoImagem': 'assets/selo-primeira-doacao.png' })
-            if participation_count >= 1:
-                selos.append({ 'nome': 'Iniciante', 'caminhoImagem': 'assets/emblemas/1.png' })
-            if participation_count >= 3:
-                selos.append({ 'nome': 'Comprometido', 'caminhoImagem': 'assets/emblemas/2.png' })
-            if participation_count >= 6:
-                selos.append({ 'nome': 'Heróico', 'caminhoImagem': 'assets/emblemas/3.png' })
-            usuario['selos'] = selos
-
-            # build full set of available emblems (all_selos) and mark unlocked
-            unlocked_names = set(s['nome'] for s in usuario['selos'])
-            all_selos = [
-                { 'nome': 'Primeira Doação', 'caminhoImagem': 'assets/selo-primeira-doacao.png' },
-                { 'nome': 'Iniciante', 'caminhoImagem': 'assets/emblemas/1.png' },
-                { 'nome': 'Comprometido', 'caminhoImagem': 'assets/emblemas/2.png' },
-                { 'nome': 'Heróico', 'caminhoImagem': 'assets/emblemas/3.png' },
-                # additional emblems (locked by default unless added above)
-                { 'nome': 'Salvador de Vidas', 'caminhoImagem': 'assets/emblemas/4.png' },
-                { 'nome': 'Tipo O Universal', 'caminhoImagem': 'assets/emblemas/5.png' },
-                { 'nome': 'Fidelidade', 'caminhoImagem': 'assets/emblemas/6.png' },
-            ]
-            for s in all_selos:
-                s['unlocked'] = (s['nome'] in unlocked_names)
-
-            return {'usuario': usuario, 'all_selos': all_selos}
-    except Exception:
-        pass
-
-    # default anonymous usuario to avoid template errors
-    default = {
-        'nivel': 'Doador Iniciante',
-        'progressoPercentual': 0,
-        'next_level_name': None,
-        'progress_text': '0/1',
-        'participations_to_next': 1,
-        'selos': [],
-        'participacoes': [],
-        'participation_count': 0
-    }
-    # also include all_selos for anonymous users (all locked)
-    all_selos = [
-        { 'nome': 'Primeira Doação', 'caminhoImagem': 'assets/selo-primeira-doacao.png', 'unlocked': False },
-        { 'nome': 'Iniciante', 'caminhoImagem': 'assets/emblemas/1.png', 'unlocked': False },
-        { 'nome': 'Comprometido', 'caminhoImagem': 'assets/emblemas/2.png', 'unlocked': False },
-        { 'nome': 'Heróico', 'caminhoImagem': 'assets/emblemas/3.png', 'unlocked': False },
-        { 'nome': 'Salvador de Vidas', 'caminhoImagem': 'assets/emblemas/4.png', 'unlocked': False },
-        { 'nome': 'Tipo O Universal', 'caminhoImagem': 'assets/emblemas/5.png', 'unlocked': False },
-        { 'nome': 'Fidelidade', 'caminhoImagem': 'assets/emblemas/6.png', 'unlocked': False },
-    ]
-    return {'usuario': default, 'all_selos': all_selos}
+    return user_context.template_proxies()
 
 # -----------------------------
 # Rotas
 # -----------------------------
-@app.route('/')
-def index():
+def cookie_logged_in():
+    """True when the usuario_id/login_time cookies are from the last 4 days."""
     cookie_usuario_id = request.cookies.get('usuario_id')
     login_time = request.cookies.get('login_time')
     logged_in = False
@@ -360,50 +449,55 @@ def index():
                 logged_in = True
         except (ValueError, TypeError):
             pass
-    return render_template('index.html', logged_in=logged_in)
+    return logged_in
+
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/')
+@page_cache.cached(vary=cookie_logged_in)
+def index():
+    return render_template('index.html', logged_in=cookie_logged_in())
+
+@bp.route('/login', methods=['GET', 'POST'])
+@page_cache.cached()
 def login():
     if request.method == 'POST':
         email = request.form.get('email')
         senha = request.form.get('password')
         if not email or not senha:
-            logging.error("Email ou senha não fornecidos")
+            logging.info('Login recusado: email ou senha não fornecidos')
             return render_template('login.html', error="Por favor, preencha todos os campos.", logged_in=False)
-        conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
         c = conn.cursor()
         c.execute('SELECT * FROM usuarios WHERE email = ?', (email,))
         usuario = c.fetchone()
-        conn.close()
         if not usuario:
-            logging.error(f"Usuário com email {email} não encontrado")
+            logging.info('Login recusado: e-mail não cadastrado')
             return render_template('login.html', error="Email ou senha inválidos", logged_in=False)
         if check_password_hash(usuario['senha'], senha):
-            user = User(usuario['id'], usuario['email'], usuario['nome'])
+            user = User(usuario['id'], usuario['email'], usuario['nome'], usuario['is_admin'])
             login_user(user)
-            logging.debug(f"Login bem-sucedido para usuário ID: {usuario['id']}")
-            return redirect(url_for('perfil'))
+            logging.debug('Login bem-sucedido para usuário ID: %s', usuario['id'])
+            return redirect(url_for('main.perfil'))
         else:
-            logging.error(f"Senha inválida para email {email}")
+            logging.info('Login recusado: senha inválida para usuário ID: %s', usuario['id'])
             return render_template('login.html', error="Email ou senha inválidos", logged_in=False)
     return render_template('login.html', logged_in=False)
 
 
-@app.route('/cadastro')
+@bp.route('/cadastro')
+@page_cache.cached()
 def cadastro():
     return render_template('cadastro.html', logged_in=False)
 
-@app.route('/campanhas')
+@bp.route('/campanhas')
+@response_cache.cached('campanhas', vary_user=True)
 def campanhas():
     try:
-        conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
         c = conn.cursor()
         # Buscar somente campanhas com status "Ativa"
         c.execute("SELECT * FROM campanhas WHERE status = 'Ativa' ORDER BY created_at DESC")
         campanhas_ativas = c.fetchall()
-        conn.close()
         return render_template('campanhas.html', campanhas=campanhas_ativas)
     except Exception as e:
         logging.exception("Erro ao carregar campanhas")
@@ -421,53 +515,61 @@ def campanhas():
             pass
     return render_template('campanhas.html', logged_in=logged_in)
 
-@app.route('/campanhas_admin')
+@bp.route('/campanhas_admin')
 def campanhas_admin():
     return render_template('campanhas_admin.html')
 
-@app.route('/dashboard_admin')
+@bp.route('/dashboard_admin')
 def dashboard_admin():
     return render_template('dashboard_admin.html', logged_in=False)
 
 
-@app.route('/submit', methods=['POST'])
+@bp.route('/submit', methods=['POST'])
 def submit():
     data = request.form.to_dict()
-    logging.debug(f"Dados recebidos do formulário: {data}")
     senha_hash = generate_password_hash(data.get('senha'))
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO usuarios (
-            nome, email, telefone, tipo_sanguineo, data_nascimento, genero,
-            cep, endereco, ja_doou, primeira_vez, interesse,
-            autoriza_msg, autoriza_dados, pontos, senha
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)
-    ''', (
-        data.get('nome'), data.get('email'), data.get('telefone'),
-        data.get('tipo_sanguineo'), data.get('data_nascimento'),
-        data.get('genero'), data.get('cep'), data.get('endereco'),
-        data.get('ja_doou'), data.get('primeira_vez'), data.get('interesse'),
-        1 if data.get('autoriza_msg') == 'sim' else 0,
-        1 if data.get('autoriza_dados') == 'sim' else 0,
-        senha_hash
-    ))
-    conn.commit()
-    user_id = c.lastrowid
-    conn.close()
+
+    def insert_usuario(conn):
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO usuarios (
+                nome, email, telefone, tipo_sanguineo, data_nascimento, genero,
+                cep, endereco, ja_doou, primeira_vez, interesse,
+                autoriza_msg, autoriza_dados, pontos, senha,
+                data_nascimento_iso, cidade_norm
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?)
+        ''', (
+            data.get('nome'), data.get('email'), data.get('telefone'),
+            data.get('tipo_sanguineo'), data.get('data_nascimento'),
+            data.get('genero'), data.get('cep'), data.get('endereco'),
+            data.get('ja_doou'), data.get('primeira_vez'), data.get('interesse'),
+            1 if data.get('autoriza_msg') == 'sim' else 0,
+            1 if data.get('autoriza_dados') == 'sim' else 0,
+            senha_hash,
+            *segmentation.normalized_fields(data.get('data_nascimento'), data.get('endereco'))
+        ))
+        city_stats.apply_change(conn, None, (data.get('endereco'), data.get('cep'),
+                                             1 if data.get('autoriza_msg') == 'sim' else 0))
+        return c.lastrowid
+
+    try:
+        user_id = run_write(insert_usuario)
+    except sqlite3.IntegrityError:
+        logging.info('Cadastro recusado: e-mail já cadastrado')
+        return render_template('login.html', error="Este email já está cadastrado. Faça login.", logged_in=False), 409
     # Log the user in immediately after registration
     user = User(user_id, data.get('email'), data.get('nome'))
     login_user(user)
-    logging.debug(f"Usuário cadastrado com ID: {user_id}")
-    return redirect(url_for('perfil'))
+    logging.debug('Usuário cadastrado com ID: %s', user_id)
+    return redirect(url_for('main.perfil'))
 
-@app.route('/editar_perfil', methods=['POST'])
+@bp.route('/editar_perfil', methods=['POST'])
 def editar_perfil():
     cookie_usuario_id = request.cookies.get('usuario_id')
     if not cookie_usuario_id:
         logging.debug("Nenhum cookie de usuário encontrado, redirecionando para login")
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     data = request.form.to_dict()
     user_id = int(cookie_usuario_id)
@@ -475,193 +577,99 @@ def editar_perfil():
     required_fields = ['nome', 'email', 'telefone', 'tipo_sanguineo', 'data_nascimento', 'genero', 'cep', 'endereco', 'ja_doou', 'interesse']
     for field in required_fields:
         if not data.get(field):
-            logging.error(f"Campo obrigatório ausente: {field}")
+            logging.info('Campo obrigatório ausente: %s', field)
             return render_template('perfil.html', error="Por favor, preencha todos os campos obrigatórios.", logged_in=True)
     
     senha = data.get('senha')
     senha_hash = generate_password_hash(senha) if senha else None
     
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
-    if senha:
-        c.execute('''
-            UPDATE usuarios SET
-                nome = ?, email = ?, telefone = ?, tipo_sanguineo = ?, data_nascimento = ?,
-                genero = ?, cep = ?, endereco = ?, ja_doou = ?, primeira_vez = ?,
-                interesse = ?, autoriza_msg = ?, autoriza_dados = ?, senha = ?
-            WHERE id = ?
-        ''', (
-            data.get('nome'), data.get('email'), data.get('telefone'),
-            data.get('tipo_sanguineo'), data.get('data_nascimento'), data.get('genero'),
-            data.get('cep'), data.get('endereco'), data.get('ja_doou'), data.get('primeira_vez'),
-            data.get('interesse'), 1 if data.get('autoriza_msg') == 'sim' else 0,
-            1 if data.get('autoriza_dados') == 'sim' else 0, senha_hash, user_id
-        ))
-    else:
-        c.execute('''
-            UPDATE usuarios SET
-                nome = ?, email = ?, telefone = ?, tipo_sanguineo = ?, data_nascimento = ?,
-                genero = ?, cep = ?, endereco = ?, ja_doou = ?, primeira_vez = ?,
-                interesse = ?, autoriza_msg = ?, autoriza_dados = ?
-            WHERE id = ?
-        ''', (
-            data.get('nome'), data.get('email'), data.get('telefone'),
-            data.get('tipo_sanguineo'), data.get('data_nascimento'), data.get('genero'),
-            data.get('cep'), data.get('endereco'), data.get('ja_doou'), data.get('primeira_vez'),
-            data.get('interesse'), 1 if data.get('autoriza_msg') == 'sim' else 0,
-            1 if data.get('autoriza_dados') == 'sim' else 0, user_id
-        ))
-    
-    conn.commit()
-    conn.close()
-    
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT * FROM usuarios WHERE id = ?', (user_id,))
-    usuario_data = c.fetchone()
-    conn.close()
-    
-    if usuario_data is None:
-        logging.error(f"Nenhum usuário encontrado para ID: {user_id}")
+    def update_usuario(conn):
+        old = city_stats.snapshot(conn, user_id)
+        c = conn.cursor()
+        if senha:
+            c.execute('''
+                UPDATE usuarios SET
+                    nome = ?, email = ?, telefone = ?, tipo_sanguineo = ?, data_nascimento = ?,
+                    genero = ?, cep = ?, endereco = ?, ja_doou = ?, primeira_vez = ?,
+                    interesse = ?, autoriza_msg = ?, autoriza_dados = ?, senha = ?,
+                    data_nascimento_iso = ?, cidade_norm = ?
+                WHERE id = ?
+            ''', (
+                data.get('nome'), data.get('email'), data.get('telefone'),
+                data.get('tipo_sanguineo'), data.get('data_nascimento'), data.get('genero'),
+                data.get('cep'), data.get('endereco'), data.get('ja_doou'), data.get('primeira_vez'),
+                data.get('interesse'), 1 if data.get('autoriza_msg') == 'sim' else 0,
+                1 if data.get('autoriza_dados') == 'sim' else 0, senha_hash,
+                *segmentation.normalized_fields(data.get('data_nascimento'), data.get('endereco')), user_id
+            ))
+        else:
+            c.execute('''
+                UPDATE usuarios SET
+                    nome = ?, email = ?, telefone = ?, tipo_sanguineo = ?, data_nascimento = ?,
+                    genero = ?, cep = ?, endereco = ?, ja_doou = ?, primeira_vez = ?,
+                    interesse = ?, autoriza_msg = ?, autoriza_dados = ?,
+                    data_nascimento_iso = ?, cidade_norm = ?
+                WHERE id = ?
+            ''', (
+                data.get('nome'), data.get('email'), data.get('telefone'),
+                data.get('tipo_sanguineo'), data.get('data_nascimento'), data.get('genero'),
+                data.get('cep'), data.get('endereco'), data.get('ja_doou'), data.get('primeira_vez'),
+                data.get('interesse'), 1 if data.get('autoriza_msg') == 'sim' else 0,
+                1 if data.get('autoriza_dados') == 'sim' else 0,
+                *segmentation.normalized_fields(data.get('data_nascimento'), data.get('endereco')), user_id
+            ))
+        if old is not None:
+            city_stats.apply_change(conn, old, (data.get('endereco'), data.get('cep'),
+                                                1 if data.get('autoriza_msg') == 'sim' else 0))
+
+    run_write(update_usuario)
+    user_context.invalidate(user_id)
+
+    ctx = user_context.get_user_context(user_id)
+    if ctx is None:
+        logging.error('Nenhum usuário encontrado para ID: %s', user_id)
         return render_template('perfil.html', error="Usuário não encontrado.", logged_in=False)
-    
-    usuario = dict(usuario_data)
-    usuario["nivel"] = "Doador Iniciante"
-    usuario["progressoPercentual"] = usuario["pontos"] * 10
-    usuario["selos"] = []
-    if usuario["ja_doou"] == 'sim':
-        usuario["selos"].append({
-            "nome": "Primeira Doação!",
-            "caminhoImagem": "assets/selo-primeira-doacao.png"
-        })
-    
-    logging.debug(f"Perfil atualizado para usuário ID: {user_id}")
+
+    usuario = ctx['usuario']
+    logging.debug('Perfil atualizado para usuário ID: %s', user_id)
     return render_template('perfil.html', usuario=usuario, success="Perfil atualizado com sucesso!", logged_in=True)
 
-@app.route('/perfil/')
-@app.route('/perfil/<int:usuario_id>')
-@app.route('/perfil/')
+@bp.route('/perfil/')
+@bp.route('/perfil/<int:usuario_id>')
+@bp.route('/perfil/')
 @login_required
 def perfil(usuario_id=None):
     # Use the authenticated user by default. Only allow viewing own profile for now.
     try:
         if usuario_id is not None and int(usuario_id) != int(current_user.id):
-            logging.warning(f"Usuário {current_user.id} tentou acessar perfil de {usuario_id}")
+            logging.warning('Usuário %s tentou acessar perfil de %s', current_user.id, usuario_id)
             return make_response('Forbidden', 403)
         usuario_id = usuario_id or int(current_user.id)
     except (ValueError, TypeError):
         logging.error("ID de usuário inválido")
-        return redirect(url_for('login'))
-
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT * FROM usuarios WHERE id = ?', (usuario_id,))
-    usuario_data = c.fetchone()
-    # fetch participations for the user
-    c.execute('''
-        SELECT p.id as participacao_id, p.joined_at, c.*
-        FROM participacoes p
-        JOIN campanhas c ON p.campanha_id = c.id
-        WHERE p.usuario_id = ?
-        ORDER BY p.joined_at DESC
-    ''', (usuario_id,))
-    participations_rows = c.fetchall()
-    conn.close()
-    if usuario_data is None:
-        logging.error(f"Nenhum usuário encontrado para ID: {usuario_id}")
+        return redirect(url_for('main.login'))
+
+    # Level, progress and badges come precomputed from the user row (see
+    # gamification.py), so the profile is a single cached lookup.
+    ctx = user_context.get_user_context(usuario_id)
+    if ctx is None:
+        logging.error('Nenhum usuário encontrado para ID: %s', usuario_id)
         return render_template('perfil.html', error="Usuário não encontrado. Por favor, faça login ou cadastre-se novamente.", logged_in=False)
-    usuario = dict(usuario_data)
-    usuario['participacoes'] = [dict(r) for r in participations_rows] if participations_rows else []
-    # Compute participation-based stats
-    participation_count = len(usuario['participacoes']) if usuario.get('participacoes') else 0
-
-    # Determine current level (prefer stored level if present)
-    def compute_level_from_count(n):
-        if n >= 6:
-            return 'Doador Heróico'
-        if n >= 3:
-            return 'Doador Comprometido'
-        if n >= 1:
-            return 'Doador Iniciante'
-        return 'Não classificado'
-
-    stored_level = usuario.get('nivel')
-    if stored_level and stored_level.strip() and stored_level != 'None':
-        usuario['nivel'] = stored_level
-    else:
-        usuario['nivel'] = compute_level_from_count(participation_count)
-
-    # Next level thresholds and names
-    if participation_count >= 6:
-        next_threshold = 6
-        next_level_name = 'Nível Máximo'
-    elif participation_count >= 3:
-        next_threshold = 6
-        next_level_name = 'Doador Heróico'
-    elif participation_count >= 1:
-        next_threshold = 3
-        next_level_name = 'Doador Comprometido'
-    else:
-        next_threshold = 1
-        next_level_name = 'Doador Iniciante'
-
-    # Progress towards next threshold
-    progresso_percentual = int(min(100, (participation_count / next_threshold) * 100)) if next_threshold else 0
-    participations_to_next = max(0, next_threshold - participation_count)
-
-    usuario['participation_count'] = participation_count
-    usuario['next_threshold'] = next_threshold
-    usuario['next_level_name'] = next_level_name
-    usuario['participations_to_next'] = participations_to_next
-    usuario['progress_text'] = f"{participation_count}/{next_threshold}"
-    usuario["progressoPercentual"] = progresso_percentual
-
-    # Build earned badges (selos) based on participation_count and other flags
-    selos = []
-    # First donation badge (if flagged in DB)
-    if usuario.get("ja_doou") == 'sim' or usuario.get('primeira_vez'):
-        selos.append({
-            'nome': 'Primeira Doação',
-            'caminhoImagem': 'assets/selo-primeira-doacao.png'
-        })
-
-    # Participation-based badges
-    # 1 participation -> Iniciante badge
-    if participation_count >= 1:
-        selos.append({ 'nome': 'Iniciante', 'caminhoImagem': 'assets/emblemas/1.png' })
-    # 3 participations -> Comprometido
-    if participation_count >= 3:
-        selos.append({ 'nome': 'Comprometido', 'caminhoImagem': 'assets/emblemas/2.png' })
-    # 6 participations -> Heróico
-    if participation_count >= 6:
-        selos.append({ 'nome': 'Heróico', 'caminhoImagem': 'assets/emblemas/3.png' })
-
-    # attach to usuario for template consumption
-    usuario['selos'] = selos
-    usuario["selos"] = []
-    if usuario.get("ja_doou") == 'sim':
-        usuario["selos"].append({
-            "nome": "Primeira Doação!",
-            "caminhoImagem": "assets/selo-primeira-doacao.png"
-        })
-    logging.debug(f"Dados do usuário: {usuario}")
+    usuario = ctx['usuario']
     return render_template('perfil.html', usuario=usuario, logged_in=True)
 
 
 # Rota para atualizar os dados do perfil (edição pelo usuário)
-@app.route('/perfil/<int:usuario_id>/update', methods=['POST'])
+@bp.route('/perfil/<int:usuario_id>/update', methods=['POST'])
 @login_required
 def update_perfil(usuario_id):
     # Recebe os dados do formulário e atualiza o usuário no banco
     data = request.form.to_dict()
-    logging.debug(f"Atualizando usuário {usuario_id} com: {data}")
 
     # Segurança: somente o dono do perfil pode atualizar
     try:
         if int(current_user.id) != int(usuario_id):
-            logging.warning(f"Tentativa de atualização não autorizada: user {current_user.id} tentou atualizar {usuario_id}")
+            logging.warning('Tentativa de atualização não autorizada: user %s tentou atualizar %s', current_user.id, usuario_id)
             return make_response('Forbidden', 403)
     except (ValueError, TypeError):
         logging.error("ID de usuário inválido no current_user")
@@ -682,26 +690,31 @@ def update_perfil(usuario_id):
     autoriza_msg = 1 if data.get('autoriza_msg') in ('on', '1', 'true', 'True') else 0
     autoriza_dados = 1 if data.get('autoriza_dados') in ('on', '1', 'true', 'True') else 0
 
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
-    c.execute('''
-        UPDATE usuarios SET
-            nome = ?, email = ?, telefone = ?, tipo_sanguineo = ?,
-            data_nascimento = ?, genero = ?, cep = ?, endereco = ?,
-            ja_doou = ?, primeira_vez = ?, interesse = ?,
-            autoriza_msg = ?, autoriza_dados = ?
-        WHERE id = ?
-    ''', (nome, email, telefone, tipo_sanguineo,
-          data_nascimento, genero, cep, endereco,
-          ja_doou, primeira_vez, interesse,
-          autoriza_msg, autoriza_dados, usuario_id))
-    conn.commit()
-    conn.close()
-
-    logging.debug(f"Usuário {usuario_id} atualizado com sucesso")
-    return redirect(url_for('perfil', usuario_id=usuario_id))
-
-@app.route('/api/dashboard_data')
+    def update_usuario(conn):
+        old = city_stats.snapshot(conn, usuario_id)
+        conn.execute('''
+            UPDATE usuarios SET
+                nome = ?, email = ?, telefone = ?, tipo_sanguineo = ?,
+                data_nascimento = ?, genero = ?, cep = ?, endereco = ?,
+                ja_doou = ?, primeira_vez = ?, interesse = ?,
+                autoriza_msg = ?, autoriza_dados = ?,
+                data_nascimento_iso = ?, cidade_norm = ?
+            WHERE id = ?
+        ''', (nome, email, telefone, tipo_sanguineo,
+              data_nascimento, genero, cep, endereco,
+              ja_doou, primeira_vez, interesse,
+              autoriza_msg, autoriza_dados,
+              *segmentation.normalized_fields(data_nascimento, endereco), usuario_id))
+        if old is not None:
+            city_stats.apply_change(conn, old, (endereco, cep, autoriza_msg))
+
+    run_write(update_usuario)
+    user_context.invalidate(usuario_id)
+
+    logging.debug('Usuário %s atualizado com sucesso', usuario_id)
+    return redirect(url_for('main.perfil', usuario_id=usuario_id))
+
+@bp.route('/api/dashboard_data')
 def api_dashboard_data():
     """Retorna dados agregados a partir da tabela usuarios para alimentar o dashboard.
     A saída é uma lista de objetos: { city, potential, engage, distance }
@@ -709,54 +722,19 @@ def api_dashboard_data():
     - potential: número de usuários na cidade (estimativa de doadores)
     - engage: proporção (0..1) de usuários com autoriza_msg=1
     - distance: valor numeric usado para simular logística (determinístico por cidade)
+
+    Lido da tabela city_stats (mantida em submit/edição de perfil), com ETag
+    pela versão do agregado: um If-None-Match igual responde 304 sem consultar o banco.
     """
     try:
-        conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute('SELECT endereco, cep, autoriza_msg FROM usuarios')
-        rows = c.fetchall()
-        conn.close()
-
-        # Agrupar por cidade extraída do endereco (heurística: token final após vírgula)
-        agg = {}
-        for r in rows:
-            endereco = r['endereco'] or ''
-            cep = r['cep'] or ''
-            # heurística simples para cidade
-            city = None
-            if ',' in endereco:
-                city = endereco.split(',')[-1].strip()
-            elif endereco.strip():
-                city = endereco.strip()
-            elif cep:
-                city = f'CEP {cep}'
-            else:
-                city = 'Desconhecido'
-
-            if city not in agg:
-                agg[city] = { 'count': 0, 'consent': 0 }
-            agg[city]['count'] += 1
-            try:
-                if int(r['autoriza_msg']) == 1:
-                    agg[city]['consent'] += 1
-            except Exception:
-                pass
-
-        results = []
-        for city, v in agg.items():
-            count = v['count']
-            consent = v['consent']
-            # deterministic pseudo-distance: sum of char codes mod 30 + 1
-            s = sum(ord(ch) for ch in city)
-            distance = (s % 30) + 1
-            engage = (consent / count) if count else 0
-            results.append({ 'city': city, 'potential': count, 'engage': round(engage, 2), 'distance': distance })
-
-
-        # sort descending by potential
-        results.sort(key=lambda x: x['potential'], reverse=True)
-        return jsonify({ 'data': results })
+        etag = f'city-stats-{table_versions.get("city_stats")[0]}'
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+        else:
+            response = jsonify({ 'data': city_stats.dashboard_rows(get_db()) })
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         logging.exception('Erro ao gerar dados do dashboard')
         return jsonify({'error': str(e)}), 500
@@ -765,185 +743,155 @@ def api_dashboard_data():
 # -----------------------------
 # Campaigns CRUD API
 # -----------------------------
-@app.route('/api/campaigns', methods=['GET'])
+@bp.route('/api/campaigns', methods=['GET'])
+@response_cache.cached('campanhas')
 def api_get_campaigns():
+    """Campanhas mais recentes primeiro.
+    Parâmetros opcionais: status, limit (paginação por cursor), cursor (o
+    next_cursor da página anterior) e fields=id,nome,... (projeção).
+    Sem limit, retorna todas as campanhas.
+    """
     try:
-        conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute('SELECT * FROM campanhas ORDER BY created_at DESC')
-        rows = c.fetchall()
-        conn.close()
-        campanhas = [dict(r) for r in rows]
-        return jsonify({'campaigns': campanhas})
+        rows, next_cursor = campaigns.list_page(
+            get_db(),
+            status=request.args.get('status'),
+            limit=pagination.parse_limit(request.args.get('limit')),
+            after=pagination.decode_cursor(request.args.get('cursor')),
+            fields=pagination.parse_fields(request.args.get('fields'), campaigns.COLUMNS),
+        )
+        return jsonify({'campaigns': rows, 'next_cursor': next_cursor})
+    except pagination.InvalidPageRequest as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logging.exception('Erro ao buscar campanhas')
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/campaigns', methods=['POST'])
+@bp.route('/api/campaigns/stream')
+def api_campaigns_stream():
+    """Server-Sent Events com as mudanças de campanhas (broadcast.py).
+    Evento ``campaigns``: lista de { id, ...campos alterados } ou { id, deleted };
+    evento ``reset``: recarregar a lista. Retorna 503 quando o processo já
+    atende SSE_MAX_CLIENTS conexões (o cliente volta a buscar /api/campaigns).
+    """
+    sub = broadcaster.subscribe(request.headers.get('Last-Event-ID'))
+    if sub is None:
+        response = jsonify({'error': 'Muitas conexões abertas'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+    response = current_app.response_class(broadcaster.stream(sub), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # keep reverse proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@bp.route('/api/campaigns', methods=['POST'])
 def api_create_campaign():
     try:
         data = request.get_json() or request.form.to_dict()
-        nome = data.get('nome')
-        tipo = data.get('tipo_sanguineo')
-        vagas = int(data.get('vagas') or 0)
-        status = data.get('status') or 'Ativa'
-        created_at = datetime.utcnow().isoformat()
-        conn = sqlite3.connect('database.db')
-        c = conn.cursor()
-        c.execute('INSERT INTO campanhas (nome, tipo_sanguineo, vagas, status, created_at) VALUES (?, ?, ?, ?, ?)',
-                  (nome, tipo, vagas, status, created_at))
-        conn.commit()
-        campaign_id = c.lastrowid
-        conn.close()
-        return jsonify({'id': campaign_id, 'message': 'Campanha criada'}), 201
+        campanha = run_write(lambda conn: campaigns.create(
+            conn, data.get('nome'), data.get('tipo_sanguineo'), data.get('vagas'), data.get('status')))
+        return jsonify({'id': campanha['id'], 'message': 'Campanha criada'}), 201
     except Exception as e:
         logging.exception('Erro ao criar campanha')
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/campaigns/<int:campaign_id>', methods=['PUT'])
+@bp.route('/api/campaigns/<int:campaign_id>', methods=['PUT'])
 def api_update_campaign(campaign_id):
     try:
         data = request.get_json() or request.form.to_dict()
-        nome = data.get('nome')
-        tipo = data.get('tipo_sanguineo')
-        vagas = data.get('vagas')
-        status = data.get('status')
-        conn = sqlite3.connect('database.db')
-        c = conn.cursor()
-        # Build update dynamically
-        updates = []
-        params = []
-        if nome is not None:
-            updates.append('nome = ?'); params.append(nome)
-        if tipo is not None:
-            updates.append('tipo_sanguineo = ?'); params.append(tipo)
-        if vagas is not None:
-            updates.append('vagas = ?'); params.append(int(vagas))
-        if status is not None:
-            updates.append('status = ?'); params.append(status)
-        if updates:
-            params.append(campaign_id)
-            sql = 'UPDATE campanhas SET ' + ', '.join(updates) + ' WHERE id = ?'
-            c.execute(sql, tuple(params))
-            conn.commit()
-        conn.close()
+        _, promoted = run_write(lambda conn: campaigns.update(conn, campaign_id, data))
+        for promoted_id in promoted:
+            user_context.invalidate(promoted_id)
         return jsonify({'message': 'Campanha atualizada'})
     except Exception as e:
         logging.exception('Erro ao atualizar campanha')
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/campaigns/<int:campaign_id>', methods=['DELETE'])
+@bp.route('/api/campaigns/<int:campaign_id>', methods=['DELETE'])
 def api_delete_campaign(campaign_id):
     try:
-        conn = sqlite3.connect('database.db')
-        c = conn.cursor()
-        c.execute('DELETE FROM campanhas WHERE id = ?', (campaign_id,))
-        conn.commit()
-        conn.close()
+        run_write(lambda conn: campaigns.delete(conn, campaign_id))
         return jsonify({'message': 'Campanha removida'})
     except Exception as e:
         logging.exception('Erro ao remover campanha')
         return jsonify({'error': str(e)}), 500
 
 # Rota para renderizar a página
-@app.route('/admin/campanhas')
+@bp.route('/admin/campanhas')
 def admin_campanhas():
     return render_template('admin_campanhas.html') # Assumindo que sua página está em 'admin_campanhas.html'
 
 # --- Endpoints da API para o JS ---
+# Mesma tabela campanhas de /api/campaigns (campaigns.py), no formato
+# esperado por campanhas_admin.js.
 
 # 1. Listar Campanhas (GET /api/campanhas)
-# @app.route('/api/campanhas', methods=['GET'])
-# def listar_campanhas():
-#     return jsonify(campanhas_db)
-@app.route('/api/campanhas', methods=['GET'])
+@bp.route('/api/campanhas', methods=['GET'])
+@response_cache.cached('campanhas')
 def listar_campanhas():
-    # Calcula as estatísticas dinamicamente
-    total_participantes = sum(c.get('participantes', 0) for c in campanhas_db)
-    total_vagas = sum(c.get('vagas', 0) for c in campanhas_db)
-    
-    # Retorna o formato esperado: { "campanhas": [...] }
+    conn = get_db()
+    # Retorna o formato esperado: { "campanhas": [...], "estatisticas": {...} }
     return jsonify({
-        "campanhas": campanhas_db,
-        "estatisticas": {
-            "totalCampanhas": len(campanhas_db),
-            "totalParticipantes": total_participantes,
-            "vagasDisponiveis": total_vagas - total_participantes
-        }
+        "campanhas": campaigns.list_campaigns(conn),
+        "estatisticas": campaigns.statistics(conn)
     })
 
 # 2. Criar Nova Campanha (POST /api/campanhas)
-@app.route('/api/campanhas', methods=['POST'])
+@bp.route('/api/campanhas', methods=['POST'])
 def criar_campanha():
-    global proximo_id
     dados = request.get_json()
-    
-    nova_campanha = {
-        "id": proximo_id,
-        "nome": dados.get('nome'),
-        "tipo_sanguineo": dados.get('tipo_sanguineo'),
-        "vagas": 50, # Valor padrão, pode ser ajustado na edição
-        "participantes": 0,
-        "status": "Ativa"
-    }
-    campanhas_db.append(nova_campanha)
-    proximo_id += 1
-    
+    nova_campanha = run_write(lambda conn: campaigns.create(
+        conn, dados.get('nome'), dados.get('tipo_sanguineo'),
+        dados.get('vagas') or 50,  # Valor padrão, pode ser ajustado na edição
+        "Ativa"))
     return jsonify({"mensagem": "Campanha criada com sucesso!", "campanha": nova_campanha}), 201
 
 # 3. Atualizar Campanha (PUT /api/campanhas/<id>)
-@app.route('/api/campanhas/<int:campanha_id>', methods=['PUT'])
+@bp.route('/api/campanhas/<int:campanha_id>', methods=['PUT'])
 def atualizar_campanha(campanha_id):
     dados = request.get_json()
-    
-    for campanha in campanhas_db:
-        if campanha['id'] == campanha_id:
-            campanha['nome'] = dados.get('nome', campanha['nome'])
-            campanha['tipo_sanguineo'] = dados.get('tipo_sanguineo', campanha['tipo_sanguineo'])
-            campanha['vagas'] = dados.get('vagas', campanha['vagas'])
-            campanha['status'] = dados.get('status', campanha['status'])
-            return jsonify({"mensagem": f"Campanha {campanha_id} atualizada com sucesso!"}), 200
-            
+    found, promoted = run_write(lambda conn: campaigns.update(conn, campanha_id, dados))
+    for promoted_id in promoted:
+        user_context.invalidate(promoted_id)
+    if found:
+        return jsonify({"mensagem": f"Campanha {campanha_id} atualizada com sucesso!"}), 200
     return jsonify({"erro": "Campanha não encontrada"}), 404
 
 # 4. Remover Campanha (DELETE /api/campanhas/<id>)
-@app.route('/api/campanhas/<int:campanha_id>', methods=['DELETE'])
+@bp.route('/api/campanhas/<int:campanha_id>', methods=['DELETE'])
 def remover_campanha(campanha_id):
-    global campanhas_db
-    tamanho_original = len(campanhas_db)
-    # Filtra a lista, mantendo apenas as campanhas cujo ID é diferente do ID a ser removido
-    campanhas_db = [c for c in campanhas_db if c['id'] != campanha_id]
-    
-    if len(campanhas_db) < tamanho_original:
+    if run_write(lambda conn: campaigns.delete(conn, campanha_id)):
         return jsonify({"mensagem": f"Campanha {campanha_id} removida com sucesso!"}), 200
     else:
         return jsonify({"erro": "Campanha não encontrada"}), 404
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for('index'))
-@app.route('/enviar_email.html')
+    return redirect(url_for('main.index'))
+@bp.route('/enviar_email.html')
 def enviar_email_page():
     """ Rota GET para CARREGAR a página 'enviar_email.html' """
     try:
         return render_template('enviar_email.html')
-    except Exception as e:
-        print(f"Erro ao renderizar enviar_email.html: {e}")
+    except Exception:
+        logging.exception('Erro ao renderizar enviar_email.html')
         return "Erro interno - template não encontrado", 500
 
 
-@app.route('/recuperar', methods=['GET'])
+@bp.route('/recuperar', methods=['GET'])
+@page_cache.cached()
 def recuperar():
     return render_template('recuperar_senha.html', logged_in=False)
 
 
-@app.route('/api/me')
+@bp.route('/api/me')
 def api_me():
     """Return minimal info about the current authenticated user as JSON.
     Returns 401 if not logged in.
@@ -951,18 +899,69 @@ def api_me():
     if not getattr(current_user, 'is_authenticated', False):
         return jsonify({'error': 'unauthorized'}), 401
     try:
-        return jsonify({'id': int(current_user.id), 'email': getattr(current_user, 'email', None), 'nome': getattr(current_user, 'nome', None)})
+        return jsonify(current_user_info())
     except Exception:
         return jsonify({'error': 'could not read user'}), 500
 
-@app.route('/email-submit', methods=['POST'])
+
+def current_user_info():
+    """The /api/me payload for the logged-in user, or None."""
+    if not getattr(current_user, 'is_authenticated', False):
+        return None
+    return {'id': int(current_user.id), 'email': getattr(current_user, 'email', None), 'nome': getattr(current_user, 'nome', None)}
+
+
+@bp.route('/api/bootstrap')
+def api_bootstrap():
+    """Dados iniciais da página de campanhas numa só requisição:
+    { user (como /api/me, ou null), participation_ids, campaigns, next_cursor }.
+    campaigns é a primeira página de /api/campaigns com os mesmos parâmetros
+    status, limit e fields. Tudo vem de uma transação de leitura; o ETag
+    depende da versão de campanhas (que também muda com inscrições) e do
+    usuário, então um If-None-Match igual responde 304 sem consultar o banco.
+    """
+    try:
+        user = current_user_info()
+        status = request.args.get('status')
+        limit = pagination.parse_limit(request.args.get('limit'))
+        fields = pagination.parse_fields(request.args.get('fields'), campaigns.COLUMNS)
+        raw = json.dumps([table_versions.get('campanhas')[0], user, status, limit, fields], ensure_ascii=False)
+        etag = 'bootstrap-' + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+        else:
+            conn = get_db()
+            with read_transaction(conn):
+                rows, next_cursor = campaigns.list_page(conn, status=status, limit=limit, fields=fields)
+                ids = campaigns.participation_ids(conn, user['id']) if user else []
+            response = jsonify({'user': user, 'participation_ids': ids, 'campaigns': rows, 'next_cursor': next_cursor})
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        return response
+    except pagination.InvalidPageRequest as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logging.exception('Erro ao montar bootstrap da página de campanhas')
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/email-submit', methods=['POST'])
 def email_submit():
     email = request.form['email']
+    usuario = get_db().execute('SELECT id FROM usuarios WHERE email = ?', (email,)).fetchone()
+    if usuario is None:
+        # same answer as for a known address, so the form does not reveal who is registered
+        logging.info('Recuperação de senha pedida para e-mail não cadastrado')
+        return render_template('recuperar_senha.html', sucesso=True, logged_in=False)
+    ttl = current_app.config['PASSWORD_RESET_TTL']
+    token = run_write(lambda conn: password_reset.issue(conn, usuario['id'], ttl))
+    link = url_for('main.redefinir_senha', token=token, _external=True)
     corpo = f"""
     Olá,
     Recebemos uma solicitação para redefinir sua senha.
     Clique no link abaixo para continuar:
-    http://seusite.com/redefinir_senha?email={email}
+    {link}
+    O link vale por {max(1, ttl // 60)} minutos e só pode ser usado uma vez.
     Se você não fez esta solicitação, ignore este e-mail.
     """
     resultado = enviar_email(email, 'Recuperação de Senha', corpo)
@@ -971,37 +970,50 @@ def email_submit():
     else:
         return render_template('recuperar_senha.html', erro=resultado['mensagem'], logged_in=False)
 
-@app.route('/enviar_email', methods=['POST'])
+
+@bp.route('/redefinir_senha', methods=['GET', 'POST'])
+def redefinir_senha():
+    """Define uma nova senha a partir do link de recuperação (ou do convite de
+    um doador importado). O token vale uma única vez."""
+    token = request.values.get('token', '')
+    if request.method == 'GET':
+        valido = password_reset.lookup(get_db(), token) is not None
+        return render_template('redefinir_senha.html', token=token, valido=valido, logged_in=False)
+    senha = request.form.get('senha', '')
+    if not senha or senha != request.form.get('confirmacao', ''):
+        return render_template('redefinir_senha.html', token=token, valido=True, logged_in=False,
+                               erro='As senhas não conferem.')
+    senha_hash = generate_password_hash(senha)
+    user_id = run_write(lambda conn: password_reset.consume(conn, token, senha_hash))
+    if user_id is None:
+        return render_template('redefinir_senha.html', token=token, valido=False, logged_in=False), 400
+    user_context.invalidate(user_id)
+    logging.info('Senha redefinida para usuário ID: %s', user_id)
+    return render_template('redefinir_senha.html', sucesso=True, logged_in=False)
+
+@bp.route('/enviar_email', methods=['POST'])
 def enviar_email_api():
     dados = request.get_json()
     resultado = enviar_email(dados['para'], dados['assunto'], dados['mensagem'])
     status = 200 if resultado['status'] == 'sucesso' else 500
     return jsonify(resultado), status
 
-@app.route('/conscientizacao')
+@bp.route('/conscientizacao')
+@page_cache.cached(vary=lambda: (cookie_logged_in(), request.args.get('nome', 'Doador')))
 def conscientizacao():
-    cookie_usuario_id = request.cookies.get('usuario_id')
-    login_time = request.cookies.get('login_time')
-    logged_in = False
-    if cookie_usuario_id and login_time:
-        try:
-            login_time_dt = datetime.fromisoformat(login_time)
-            if datetime.utcnow() - login_time_dt <= timedelta(days=4):
-                logged_in = True
-        except (ValueError, TypeError):
-            pass
     nome = request.args.get('nome', 'Doador')
-    return render_template('conscientizacao.html', nome=nome, pontos=0, logged_in=logged_in)
+    return render_template('conscientizacao.html', nome=nome, pontos=0, logged_in=cookie_logged_in())
 
 
 
 # Endpoint para envio segmentado de campanhas (email)
-@app.route('/api/admin/send_campaign', methods=['POST'])
+@bp.route('/api/admin/send_campaign', methods=['POST'])
 @login_required
 def api_admin_send_campaign():
     """Recebe um JSON com: { canal_disparo, remetente, conteudo, segmentacao }
     segmentacao pode conter: tipo_sanguineo: [..], genero, min_age, max_age, cidade: [..], classificacao, interesse
-    Retorna JSON com { sent: N, failed: [ {email, error} ] }
+    Enfileira o disparo e retorna 202 com { job_id, status, recipients_count };
+    o progresso fica em GET /api/admin/send_campaign/<job_id>.
     """
     try:
         payload = request.get_json() or {}
@@ -1010,225 +1022,302 @@ def api_admin_send_campaign():
         conteudo = payload.get('conteudo', '')
         segmentacao = payload.get('segmentacao', {}) or {}
 
-        tipos = segmentacao.get('tipo_sanguineo') or []
-        genero = segmentacao.get('genero') or None
-        cidade_list = segmentacao.get('cidade') or []
-        interesse = segmentacao.get('interesse') or None
-        classificacao = segmentacao.get('classificacao') or None
-        min_age = segmentacao.get('min_age')
-        max_age = segmentacao.get('max_age')
-
-        conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-
-        # Build dynamic query
-        query = "SELECT id, nome, email, tipo_sanguineo, genero, data_nascimento, endereco, ja_doou FROM usuarios WHERE email IS NOT NULL AND email != ''"
-        params = []
-        if tipos:
-            placeholders = ','.join('?' for _ in tipos)
-            query += f" AND tipo_sanguineo IN ({placeholders})"
-            params.extend(tipos)
-        if genero:
-            query += " AND genero = ?"
-            params.append(genero)
-        if cidade_list:
-            # match any cidade in endereco (simple LIKE)
-            city_clauses = []
-            for city in cidade_list:
-                city_clauses.append("endereco LIKE ?")
-                params.append(f"%{city}%")
-            query += " AND (" + " OR ".join(city_clauses) + ")"
-        if interesse and interesse != 'todos':
-            query += " AND interesse = ?"
-            params.append(interesse)
-        if classificacao and classificacao != 'todos':
-            query += " AND primeira_vez = ?"
-            params.append('sim' if classificacao == 'primeira_vez' else classificacao)
-
-        c.execute(query, params)
-        rows = c.fetchall()
-        conn.close()
-
-        # Filter by age if requested
-        recipients = []
-        now = datetime.utcnow().date()
-        for r in rows:
-            dob = r['data_nascimento']
-            age = None
-            if dob:
-                try:
-                    # Try ISO format first
-                    if '-' in dob:
-                        dob_dt = datetime.fromisoformat(dob).date()
-                    elif '/' in dob:
-                        # try DD/MM/YYYY
-                        parts = dob.split('/')
-                        if len(parts) == 3:
-                            day, month, year = parts
-                            dob_dt = datetime(int(year), int(month), int(day)).date()
-                        else:
-                            dob_dt = None
-                    else:
-                        dob_dt = None
-                    if dob_dt:
-                        age = (now - dob_dt).days // 365
-                except Exception:
-                    age = None
-
-            if min_age is not None or max_age is not None:
-                try:
-                    if age is None:
-                        # if we can't compute age, skip this recipient when age filter is requested
-                        continue
-                    if min_age is not None and age < int(min_age):
-                        continue
-                    if max_age is not None and age > int(max_age):
-                        continue
-                except Exception:
-                    continue
-
-            recipients.append({'id': r['id'], 'nome': r['nome'], 'email': r['email']})
-
-        sent = 0
-        failed = []
-
-        # Simple sending loop (synchronous). For many recipients, consider background job / queue.
+        # Sending happens in the dispatch workers (jobs.py); the request only
+        # records the job. Recipients are selected by one indexed query
+        # (segmentation.py) and streamed straight into the queue table.
+        # [nome_doador] is filled in per recipient at send time.
         subject = f"{remetente or 'Hemocentro'} - Comunicado"
-        for rec in recipients:
-            try:
-                # Customize content with name if desired
-                body = conteudo.replace('[nome_doador]', rec.get('nome') or '')
-                resultado = enviar_email(rec['email'], subject, body)
-                if resultado.get('status') == 'sucesso':
-                    sent += 1
-                else:
-                    failed.append({'email': rec['email'], 'error': resultado.get('mensagem')})
-            except Exception as e:
-                failed.append({'email': rec['email'], 'error': str(e)})
-
-        return jsonify({'sent': sent, 'failed': failed, 'recipients_count': len(recipients)})
+        job_id, total = run_write(lambda conn: dispatch.enqueue(
+            conn, segmentation.iter_recipients(conn, segmentacao), subject, conteudo,
+            admin_user_id=int(current_user.id),
+            payload={'canal_disparo': canal, 'segmentacao': segmentacao}))
+        dispatch.notify()
+
+        return jsonify({'job_id': job_id, 'status': 'queued', 'recipients_count': total}), 202
     except Exception as e:
         logging.exception('Erro ao enviar campanha')
         return jsonify({'error': str(e)}), 500
 
 
+@bp.route('/api/admin/send_campaign/<int:job_id>', methods=['GET'])
+@login_required
+def api_admin_send_campaign_status(job_id):
+    """Progresso de um disparo: { status, total, queued, sent, failed, errors }."""
+    status = dispatch.status(get_db(), job_id)
+    if status is None:
+        return jsonify({'error': 'Job não encontrado'}), 404
+    return jsonify(status)
+
+
+@bp.route('/api/admin/import_donors', methods=['POST'])
+@admin_required
+def api_admin_import_donors():
+    """Recebe um arquivo CSV ou JSON Lines (campo ``arquivo``) com doadores.
+    A importação roda em segundo plano; retorna 202 com { import_id, status } e
+    o progresso fica em GET /api/admin/import_donors/<import_id>.
+    """
+    arquivo = request.files.get('arquivo')
+    if arquivo is None or not arquivo.filename:
+        return jsonify({'error': 'Envie o arquivo no campo "arquivo"'}), 400
+    try:
+        fmt = request.form.get('formato') or detect_format(arquivo.filename)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({'error': 'Formato não suportado: use csv ou jsonl'}), 400
+
+    # keep the upload until the import finishes so it can be resumed
+    os.makedirs(current_app.config['IMPORT_DIR'], exist_ok=True)
+    path = os.path.join(current_app.config['IMPORT_DIR'], f'{uuid.uuid4().hex}.{fmt}')
+    arquivo.save(path)
+    import_id = run_write(lambda conn: donor_importer.create(conn, path, fmt, admin_user_id=int(current_user.id)))
+    donor_importer.start(import_id)
+    return jsonify({'import_id': import_id, 'status': 'queued'}), 202
+
+
+@bp.route('/api/admin/import_donors/<int:import_id>', methods=['GET'])
+@admin_required
+def api_admin_import_donors_status(import_id):
+    """Progresso de uma importação: { status, rows_read, inserted, rejected, invites, progress, rejects }.
+    invites conta os doadores importados sem senha que ainda não definiram uma."""
+    status = donor_importer.status(get_db(), import_id)
+    if status is None:
+        return jsonify({'error': 'Importação não encontrada'}), 404
+    return jsonify(status)
+
+
+@bp.route('/api/admin/import_donors/<int:import_id>/resume', methods=['POST'])
+@admin_required
+def api_admin_import_donors_resume(import_id):
+    """Retoma uma importação interrompida a partir do último lote gravado."""
+    status = donor_importer.status(get_db(), import_id)
+    if status is None:
+        return jsonify({'error': 'Importação não encontrada'}), 404
+    if status['status'] == 'done':
+        return jsonify({'error': 'Importação já concluída'}), 409
+    if donor_importer.is_running(get_db(), import_id):
+        return jsonify({'error': 'Importação já está em andamento'}), 409
+    donor_importer.start(import_id)
+    return jsonify({'import_id': import_id, 'status': 'running'}), 202
+
+
+@bp.route('/api/admin/import_donors/<int:import_id>/invites', methods=['POST'])
+@admin_required
+def api_admin_import_donors_invites(import_id):
+    """CSV email,link dos doadores importados sem senha que ainda não
+    definiram uma: cada link leva a /redefinir_senha e vale uma vez, por
+    IMPORT_INVITE_TTL segundos. Gerar de novo invalida os links anteriores,
+    e nada secreto fica guardado, então o CSV precisa ser repassado logo."""
+    if donor_importer.status(get_db(), import_id) is None:
+        return jsonify({'error': 'Importação não encontrada'}), 404
+    ttl = current_app.config['IMPORT_INVITE_TTL']
+    issued = run_write(lambda conn: donor_importer.issue_invites(conn, import_id, ttl))
+    rows = [(email, url_for('main.redefinir_senha', token=token, _external=True)) for email, token in issued]
+    logging.info('Importação %d: %d convites gerados', import_id, len(rows))
+    response = current_app.response_class(exports.csv_chunks(rows, ('email', 'link')),
+                                          mimetype=exports.MIMETYPES['csv'])
+    response.headers['Content-Disposition'] = f'attachment; filename="convites_importacao_{import_id}.csv"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+# -----------------------------
+# Exportações (CSV/XLSX em streaming)
+# -----------------------------
+DONOR_EXPORT_COLUMNS = ('id', 'nome', 'email', 'telefone', 'tipo_sanguineo', 'data_nascimento', 'genero',
+                        'cep', 'endereco', 'interesse', 'primeira_vez', 'autoriza_msg', 'nivel',
+                        'participation_count')
+PARTICIPANT_EXPORT_COLUMNS = ('participacao_id', 'usuario_id', 'nome', 'email', 'telefone',
+                              'tipo_sanguineo', 'joined_at')
+CITY_EXPORT_COLUMNS = ('Cidade', 'Estimativa', 'Engajamento(%)', 'Distância (km)', 'Score')
+
+
+def export_response(query, params, columns, fmt, filename, transform=None):
+    """Stream the rows of ``query`` as a CSV/XLSX download.
+
+    CSV is gzip-compressed on the fly for clients that accept it.
+    """
+    compress = fmt == 'csv' and request.accept_encodings.quality('gzip') > 0
+    body = exports.stream(db, query, params, columns, fmt, gzip=compress, sheet=filename, transform=transform)
+    response = current_app.response_class(body, mimetype=exports.MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}.{fmt}"'
+    response.headers['Cache-Control'] = 'no-store'
+    response.vary.add('Accept-Encoding')
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+@bp.route('/api/admin/export/donors.<any(csv, xlsx):fmt>')
+@admin_required
+def api_admin_export_donors(fmt):
+    """Doadores do segmento (mesmos filtros de /api/admin/send_campaign, na query string)."""
+    try:
+        segmentacao = segmentation.from_args(request.args)
+    except ValueError:
+        return jsonify({'error': 'min_age e max_age devem ser números'}), 400
+    query, params = segmentation.build_query(segmentacao, columns=', '.join(DONOR_EXPORT_COLUMNS), conn=get_db())
+    return export_response(query, params, DONOR_EXPORT_COLUMNS, fmt, 'doadores')
+
+
+@bp.route('/api/admin/export/campaigns/<int:campaign_id>/participants.<any(csv, xlsx):fmt>')
+@admin_required
+def api_admin_export_participants(campaign_id, fmt):
+    """Participantes de uma campanha, na ordem de inscrição."""
+    if campaigns.get(get_db(), campaign_id) is None:
+        return jsonify({'error': 'Campanha não encontrada'}), 404
+    query = '''
+        SELECT p.id, u.id, u.nome, u.email, u.telefone, u.tipo_sanguineo, p.joined_at
+        FROM participacoes p JOIN usuarios u ON u.id = p.usuario_id
+        WHERE p.campanha_id = ? ORDER BY p.id
+    '''
+    return export_response(query, (campaign_id,), PARTICIPANT_EXPORT_COLUMNS, fmt,
+                           f'participantes_campanha_{campaign_id}')
+
+
+@bp.route('/api/admin/export/cities.<any(csv, xlsx):fmt>')
+@login_required
+def api_admin_export_cities(fmt):
+    """Agregado por cidade do dashboard, com o score calculado como em
+    dashboard_admin.js (pesos peso_potencial, peso_engajamento, peso_logistica)."""
+    try:
+        weights = [float(request.args.get(name, default)) for name, default in
+                   (('peso_potencial', 6), ('peso_engajamento', 3), ('peso_logistica', 1))]
+    except ValueError:
+        return jsonify({'error': 'Pesos inválidos'}), 400
+    if not all(math.isfinite(w) for w in weights):
+        return jsonify({'error': 'Pesos inválidos'}), 400
+
+    def with_score(row):
+        city, potential, consent, distance, score = row
+        engage = round(consent / potential, 2) if potential else 0
+        return city, potential, round(engage * 100), distance, score
+
+    # ranked like the dashboard table: by the rounded score, ties in the
+    # order the dashboard receives the rows (potential, then city)
+    query = '''
+        SELECT city, potential, consent, distance, ROUND(
+            potential * 1.0 / (SELECT MAX(potential) FROM city_stats) * ?
+            + (CASE WHEN potential THEN ROUND(consent * 1.0 / potential, 2) ELSE 0 END) * ?
+            + 1.0 / (1 + distance) * ?, 2) AS score
+        FROM city_stats
+        ORDER BY score DESC, potential DESC, city
+    '''
+    return export_response(query, weights, CITY_EXPORT_COLUMNS, fmt, 'previsoes_coleta', transform=with_score)
+
+
+@bp.route('/api/admin/email_stats', methods=['GET'])
+@login_required
+def api_admin_email_stats():
+    """Entregas por disparo (job_id) a partir de email_logs; campaign_name
+    vem só como rótulo. Filtros opcionais: job_id, since, until (ISO 8601) e
+    bucket (hour|day|month).
+    """
+    try:
+        stats = delivery_stats(
+            get_db(),
+            job_id=request.args.get('job_id', type=int),
+            since=request.args.get('since'),
+            until=request.args.get('until'),
+            bucket=request.args.get('bucket'),
+        )
+        return jsonify(stats)
+    except Exception as e:
+        logging.exception('Erro ao consultar estatísticas de e-mail')
+        return jsonify({'error': str(e)}), 500
+
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition; requires a session or the METRICS_TOKEN."""
+    if not (current_user.is_authenticated or metrics.authorized(request)):
+        return make_response('unauthorized', 401)
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@bp.route('/api/admin/db_stats')
+@login_required
+def api_admin_db_stats():
+    """Pool usage, lock-wait counters and WAL checkpoint state for SQLite."""
+    return jsonify(db.stats())
+
+
 # -----------------------------
 # Participation endpoints
 # -----------------------------
-@app.route('/api/campaigns/<int:campaign_id>/participate', methods=['POST'])
+@bp.route('/api/campaigns/<int:campaign_id>/participate', methods=['POST'])
 @login_required
 def api_participate_campaign(campaign_id):
+    """Reserva uma vaga na campanha (reservations.py).
+    201 inscrito; 202 campanha lotada, usuário na lista de espera (com posição);
+    409 já inscrito (repetir a chamada é seguro); 404 campanha inexistente.
+    """
     user_id = int(current_user.id)
-    logging.debug(f"API participate called by user {user_id} for campaign {campaign_id}")
+    logging.debug('API participate called by user %s for campaign %s', user_id, campaign_id)
+
     try:
-        conn = sqlite3.connect('database.db')
-        c = conn.cursor()
-        # Check campaign exists
-        c.execute('SELECT id FROM campanhas WHERE id = ?', (campaign_id,))
-        row = c.fetchone()
-        if not row:
-            conn.close()
+        outcome, position = run_write(lambda conn: reservations.reserve(conn, user_id, campaign_id))
+        if outcome == reservations.NOT_FOUND:
             return jsonify({'error': 'Campanha não encontrada'}), 404
-
-        joined_at = datetime.utcnow().isoformat()
-        try:
-            # ensure user is not already subscribed (clear error message)
-            c.execute('SELECT 1 FROM participacoes WHERE usuario_id = ? AND campanha_id = ?', (user_id, campaign_id))
-            if c.fetchone():
-                conn.close()
-                return jsonify({'error': 'Você já está inscrito nesta campanha'}), 409
-
-            c.execute('INSERT INTO participacoes (usuario_id, campanha_id, joined_at) VALUES (?, ?, ?)',
-                      (user_id, campaign_id, joined_at))
-            # increment participantes counter in campanhas table
-            c.execute('UPDATE campanhas SET participantes = COALESCE(participantes,0) + 1 WHERE id = ?', (campaign_id,))
-            # Recompute user's donor level based on total participations and persist
-            c.execute('SELECT COUNT(*) FROM participacoes WHERE usuario_id = ?', (user_id,))
-            cnt = c.fetchone()[0] or 0
-            if cnt >= 6:
-                new_level = 'Doador Heróico'
-            elif cnt >= 3:
-                new_level = 'Doador Comprometido'
-            elif cnt >= 1:
-                new_level = 'Doador Iniciante'
-            else:
-                new_level = None
-            if new_level:
-                c.execute("UPDATE usuarios SET nivel = ? WHERE id = ?", (new_level, user_id))
-            conn.commit()
-            conn.close()
-            return jsonify({'message': 'Inscrição realizada com sucesso'}), 201
-        except sqlite3.IntegrityError:
-            # fallback: unique constraint violated
-            conn.close()
-            return jsonify({'error': 'Você já está inscrito nesta campanha'}), 409
+        if outcome == reservations.ALREADY_JOINED:
+            return jsonify({'error': 'Você já está inscrito nesta campanha', 'status': 'joined'}), 409
+        if outcome == reservations.WAITLISTED:
+            return jsonify({'message': 'Campanha lotada: você entrou na lista de espera',
+                            'status': 'waitlisted', 'position': position}), 202
+        user_context.invalidate(user_id)
+        return jsonify({'message': 'Inscrição realizada com sucesso', 'status': 'joined'}), 201
     except Exception as e:
         logging.exception('Erro ao inscrever usuário na campanha')
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/campaigns/<int:campaign_id>/participate', methods=['DELETE'])
+@bp.route('/api/campaigns/<int:campaign_id>/participate', methods=['DELETE'])
 @login_required
 def api_unparticipate_campaign(campaign_id):
     user_id = int(current_user.id)
+
     try:
-        conn = sqlite3.connect('database.db')
-        c = conn.cursor()
-        c.execute('DELETE FROM participacoes WHERE usuario_id = ? AND campanha_id = ?', (user_id, campaign_id))
-        if c.rowcount > 0:
-            # decrement participantes (avoid negative values)
-            c.execute('UPDATE campanhas SET participantes = CASE WHEN COALESCE(participantes,0) > 0 THEN participantes - 1 ELSE 0 END WHERE id = ?', (campaign_id,))
-            conn.commit()
-            # Recompute user's donor level after removal
-            c.execute('SELECT COUNT(*) FROM participacoes WHERE usuario_id = ?', (user_id,))
-            cnt = c.fetchone()[0] or 0
-            if cnt >= 6:
-                new_level = 'Doador Heróico'
-            elif cnt >= 3:
-                new_level = 'Doador Comprometido'
-            elif cnt >= 1:
-                new_level = 'Doador Iniciante'
-            else:
-                new_level = 'Não classificado'
-            c.execute('UPDATE usuarios SET nivel = ? WHERE id = ?', (new_level, user_id))
-            conn.commit()
-            conn.close()
+        outcome, promoted = run_write(lambda conn: reservations.release(conn, user_id, campaign_id))
+        # the freed seat may have gone to the first user on the waitlist
+        for promoted_id in [user_id] + promoted:
+            user_context.invalidate(promoted_id)
+        if outcome == reservations.LEFT:
             return jsonify({'message': 'Removido da campanha'}), 200
+        if outcome == reservations.LEFT_WAITLIST:
+            return jsonify({'message': 'Removido da lista de espera'}), 200
         else:
-            conn.close()
             return jsonify({'error': 'Inscrição não encontrada'}), 404
     except Exception as e:
         logging.exception('Erro ao remover inscrição')
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/my_participations', methods=['GET'])
+@bp.route('/api/my_participations', methods=['GET'])
 @login_required
 def api_my_participations():
+    """Participações do usuário, mais recentes primeiro; aceita os mesmos
+    parâmetros status, limit, cursor e fields de /api/campaigns."""
     user_id = int(current_user.id)
     try:
-        conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute('''
-            SELECT p.id as participacao_id, p.joined_at, c.*
-            FROM participacoes p
-            JOIN campanhas c ON p.campanha_id = c.id
-            WHERE p.usuario_id = ?
-            ORDER BY p.joined_at DESC
-        ''', (user_id,))
-        rows = c.fetchall()
-        conn.close()
-        participations = [dict(r) for r in rows]
-        return jsonify({'participations': participations})
+        rows, next_cursor = campaigns.participations_page(
+            get_db(), user_id,
+            status=request.args.get('status'),
+            limit=pagination.parse_limit(request.args.get('limit')),
+            after=pagination.decode_cursor(request.args.get('cursor')),
+            fields=pagination.parse_fields(request.args.get('fields'), campaigns.PARTICIPATION_COLUMNS),
+        )
+        return jsonify({'participations': rows, 'next_cursor': next_cursor})
+    except pagination.InvalidPageRequest as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logging.exception('Erro ao buscar participações do usuário')
         return jsonify({'error': str(e)}), 500
 
 
-
-
+# Development server only; production runs wsgi.py under gunicorn.conf.py.
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=os.getenv('FLASK_DEBUG', 'True') == 'True')
 
@@ -0,0 +1,261 @@
+"""Static asset build and serving: fingerprinted URLs and far-future caching.
+
+``python assets.py`` (or ``flask build-assets``) copies every file under
+static/ to static/build/ with a content hash in its name and writes
+static/build/manifest.json. For each file it also produces:
+
+- ``.gz`` and ``.br`` copies of text assets (CSS, JS, SVG, ICO, JSON);
+- WebP/AVIF versions and narrower responsive sizes of PNG/JPEG images;
+- the optional bundles listed in ``BUNDLES``, one concatenated file each.
+
+``brotli`` and Pillow are in requirements.txt, so the Docker build produces
+all of these. In an environment without them the build still runs, producing
+only ``.gz`` copies and no image variants.
+
+At runtime ``AssetPipeline`` rewrites ``url_for('static', filename=...)`` to
+the hashed name, and serves hashed files with ``Cache-Control: immutable``.
+It picks the best precompressed variant for ``Accept-Encoding`` and the best
+image format for ``Accept``. Without a manifest everything falls back to
+Flask's default static handling.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+
+from flask import request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # in requirements.txt; without it only gzip is produced
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # in requirements.txt; without it no image variants are built
+    Image = None
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ico', '.json', '.txt', '.map')
+RESIZABLE = ('.png', '.jpg', '.jpeg')
+RESPONSIVE_WIDTHS = (320, 640, 960)
+IMMUTABLE = 'public, max-age=31536000, immutable'
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# Optional concatenated bundles: output name -> files in load order. Templates
+# opt in with ``asset_urls('<name>')``, which falls back to the individual
+# files when the bundle was not built.
+BUNDLES = {
+    'index.css': ['styles/index.css', 'styles/global.css', 'styles/speaking_ballon.css'],
+    'index.js': ['scripts/global.js', 'scripts/index.js', 'scripts/carousel.js'],
+}
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()[:10]
+
+
+def _hashed_name(rel, digest, suffix=''):
+    stem, ext = os.path.splitext(rel)
+    return f'{BUILD_DIR}/{stem}.{digest}{suffix}{ext}'
+
+
+def _write(static_folder, rel, data):
+    path = os.path.join(static_folder, rel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fh:
+        fh.write(data)
+
+
+def _precompress(static_folder, rel, data, manifest):
+    encodings = []
+    if brotli is not None:
+        _write(static_folder, rel + SUFFIXES['br'], brotli.compress(data, quality=11))
+        encodings.append('br')
+    _write(static_folder, rel + SUFFIXES['gzip'], gzip.compress(data, compresslevel=9, mtime=0))
+    encodings.append('gzip')
+    manifest['encodings'][rel] = encodings
+
+
+def _image_variants(static_folder, rel, hashed, digest, manifest):
+    """WebP/AVIF siblings and responsive widths for one image."""
+    src = os.path.join(static_folder, rel)
+    with Image.open(src) as img:
+        img.load()
+        widths = [w for w in RESPONSIVE_WIDTHS if w < img.width]
+        srcset = []
+        for width in widths + [img.width]:
+            if width == img.width:
+                variant, target = img, hashed
+            else:
+                variant = img.resize((width, round(img.height * width / img.width)), Image.LANCZOS)
+                target = _hashed_name(rel, digest, f'-{width}w')
+                variant.save(os.path.join(static_folder, target), optimize=True)
+            srcset.append([width, target])
+            formats = {}
+            for fmt, mime, ext in (('AVIF', 'image/avif', '.avif'), ('WEBP', 'image/webp', '.webp')):
+                out = os.path.splitext(target)[0] + ext
+                try:
+                    variant.save(os.path.join(static_folder, out), fmt, quality=80)
+                except (KeyError, OSError, ValueError):
+                    continue  # this Pillow build cannot encode the format
+                if os.path.getsize(os.path.join(static_folder, out)) < os.path.getsize(os.path.join(static_folder, target)):
+                    formats[mime] = out
+                else:
+                    os.remove(os.path.join(static_folder, out))
+            if formats:
+                manifest['formats'][target] = formats
+        manifest['srcset'][rel] = srcset
+
+
+def build(static_folder, bundles=BUNDLES):
+    """Rebuild static/build/ and its manifest; returns the manifest."""
+    out = os.path.join(static_folder, BUILD_DIR)
+    shutil.rmtree(out, ignore_errors=True)
+    manifest = {'files': {}, 'encodings': {}, 'formats': {}, 'srcset': {}, 'bundles': {}}
+    if Image is None:
+        logging.warning('Pillow não instalado: variantes WebP/AVIF e tamanhos responsivos não serão gerados')
+
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        if os.path.abspath(dirpath) == os.path.abspath(static_folder):
+            dirnames[:] = [d for d in dirnames if d != BUILD_DIR]
+        for name in sorted(filenames):
+            rel = os.path.relpath(os.path.join(dirpath, name), static_folder).replace(os.sep, '/')
+            with open(os.path.join(dirpath, name), 'rb') as fh:
+                data = fh.read()
+            digest = _digest(data)
+            hashed = _hashed_name(rel, digest)
+            _write(static_folder, hashed, data)
+            manifest['files'][rel] = hashed
+            ext = os.path.splitext(rel)[1].lower()
+            if ext in COMPRESSIBLE:
+                _precompress(static_folder, hashed, data, manifest)
+            elif ext in RESIZABLE and Image is not None:
+                try:
+                    _image_variants(static_folder, rel, hashed, digest, manifest)
+                except OSError:
+                    logging.exception('Falha ao gerar variantes de %s', rel)
+
+    for bundle, members in (bundles or {}).items():
+        parts = []
+        for member in members:
+            with open(os.path.join(static_folder, member), 'rb') as fh:
+                parts.append(fh.read())
+        sep = b';\n' if bundle.endswith('.js') else b'\n'
+        data = sep.join(parts)
+        hashed = _hashed_name(f'bundles/{bundle}', _digest(data))
+        _write(static_folder, hashed, data)
+        _precompress(static_folder, hashed, data, manifest)
+        manifest['bundles'][bundle] = {'file': hashed, 'members': members}
+
+    manifest['version'] = _digest(json.dumps(manifest, sort_keys=True).encode('utf-8'))
+    with open(os.path.join(out, MANIFEST), 'w', encoding='utf-8') as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    return manifest
+
+
+class AssetPipeline:
+    """Flask extension serving the output of ``build``."""
+
+    def __init__(self, app=None):
+        self.manifest = None
+        self.version = ''
+        self.bundling = False
+        self._hashed = set()
+        self._default_static = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASSET_MANIFEST', os.path.join(app.static_folder, BUILD_DIR, MANIFEST))
+        app.config.setdefault('ASSET_BUNDLING', False)
+        self.static_folder = app.static_folder
+        self.bundling = bool(app.config['ASSET_BUNDLING'])
+        self.load(app.config['ASSET_MANIFEST'])
+        app.url_defaults(self._fingerprint)
+        self._default_static = app.view_functions['static']
+        app.view_functions['static'] = self._serve
+        app.add_template_global(self.srcset)
+        app.add_template_global(self.asset_urls)
+        app.extensions['assets'] = self
+
+        @app.cli.command('build-assets')
+        def build_assets_command():
+            """Fingerprint, precompress and resize everything under static/."""
+            manifest = build(app.static_folder)
+            self.load(app.config['ASSET_MANIFEST'])
+            print(f"{len(manifest['files'])} arquivos, {len(manifest['formats'])} variantes de imagem, "
+                  f"{len(manifest['bundles'])} bundles (versão {manifest['version']})")
+
+    def load(self, path):
+        try:
+            with open(path, encoding='utf-8') as fh:
+                self.manifest = json.load(fh)
+        except FileNotFoundError:
+            self.manifest, self.version, self._hashed = None, '', set()
+            return
+        self.version = self.manifest['version']
+        self._hashed = set(self.manifest['files'].values())
+        self._hashed.update(b['file'] for b in self.manifest['bundles'].values())
+        for srcset in self.manifest['srcset'].values():
+            self._hashed.update(target for _, target in srcset)
+
+    def _fingerprint(self, endpoint, values):
+        if endpoint == 'static' and self.manifest is not None:
+            hashed = self.manifest['files'].get(values.get('filename'))
+            if hashed:
+                values['filename'] = hashed
+
+    def _serve(self, filename):
+        if filename not in self._hashed:
+            return self._default_static(filename=filename)
+        served, encoding = filename, None
+        formats = self.manifest['formats'].get(filename)
+        if formats:
+            # only explicit support counts: browsers also send */* for images
+            accepted = {value for value, quality in request.accept_mimetypes if quality > 0}
+            served = next((formats[m] for m in ('image/avif', 'image/webp') if m in formats and m in accepted), filename)
+        else:
+            for name in self.manifest['encodings'].get(filename, ()):
+                if request.accept_encodings[name]:
+                    served, encoding = filename + SUFFIXES[name], name
+                    break
+        # a precompressed file keeps the type of the original
+        mimetype = mimetypes.guess_type(filename if encoding else served)[0]
+        response = send_from_directory(self.static_folder, served, mimetype=mimetype, max_age=31536000)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Cache-Control'] = IMMUTABLE
+        response.vary.add('Accept' if formats else 'Accept-Encoding')
+        return response
+
+    def srcset(self, filename):
+        """``srcset`` attribute value for a built image ('' without a build)."""
+        if self.manifest is None or filename not in self.manifest['srcset']:
+            return ''
+        return ', '.join(f"{url_for('static', filename=target)} {width}w"
+                         for width, target in self.manifest['srcset'][filename])
+
+    def asset_urls(self, bundle):
+        """URLs to include for ``bundle``: the bundle when built and enabled, else its members."""
+        if self.bundling and self.manifest is not None and bundle in self.manifest['bundles']:
+            return [url_for('static', filename=self.manifest['bundles'][bundle]['file'])]
+        return [url_for('static', filename=member) for member in BUNDLES.get(bundle, [])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('static_folder', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+    args = parser.parse_args()
+    manifest = build(args.static_folder)
+    print(json.dumps({'files': len(manifest['files']), 'image_variants': len(manifest['formats']),
+                      'bundles': len(manifest['bundles']), 'version': manifest['version']}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+"""Benchmarks and load-generation helpers. Run modules with ``python -m bench.<name>``."""
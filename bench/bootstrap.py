@@ -0,0 +1,101 @@
+"""Campaign list page: separate API calls versus one /api/bootstrap.
+
+    python -m bench.bootstrap --database /tmp/bench.db --views 300
+
+Replays the requests the campaign list page makes per view, as a logged-in
+donor, through the test client. ``separate`` is what list_campanhas.js used
+to fetch (/api/me and /api/my_participations twice each, plus the first page
+of /api/campaigns); ``bootstrap`` is the single composite call. The
+``revalidate`` variants send back the ETags from the previous view, as the
+browser does. Reports requests and server time per view (milliseconds).
+The database is a temporary copy of ``--database``.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from bench.datagen import PASSWORD
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PAGE = 'limit=20&fields=id,nome,tipo_sanguineo,status'
+SEPARATE = ('/api/me', '/api/my_participations?fields=id', f'/api/campaigns?{PAGE}',
+            '/api/me', '/api/my_participations?fields=id')
+BOOTSTRAP = (f'/api/bootstrap?{PAGE}',)
+
+
+def page_view(client, paths, etags):
+    """Request ``paths`` in order, revalidating against ``etags`` (updated in
+    place); returns (seconds, statuses)."""
+    statuses = []
+    start = time.perf_counter()
+    for path in paths:
+        headers = {'If-None-Match': etags[path]} if path in etags else {}
+        response = client.get(path, headers=headers)
+        response.get_data()
+        statuses.append(response.status_code)
+        if response.headers.get('ETag'):
+            etags[path] = response.headers['ETag']
+    return time.perf_counter() - start, statuses
+
+
+def run(database, views=300, joins=5):
+    import app
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'database.db')
+        shutil.copyfile(database, db_path)
+        application = app.create_app({'DATABASE': db_path, 'SECRET_KEY': 'bench', 'LOG_LEVEL': 'WARNING',
+                                      'BACKGROUND_WORKERS_AUTOSTART': False})
+        client = application.test_client()
+        with app.db.connection() as conn:
+            email = conn.execute("SELECT email FROM usuarios WHERE email LIKE '%@exemplo.com.br' "
+                                 'ORDER BY id LIMIT 1').fetchone()
+            campaign_ids = [r[0] for r in conn.execute(
+                "SELECT id FROM campanhas WHERE status = 'Ativa' ORDER BY id LIMIT ?", (joins,))]
+        if email is None:
+            raise SystemExit('banco sem doadores gerados: rode python -m bench.datagen primeiro')
+        client.post('/login', data={'email': email[0], 'password': PASSWORD})
+        for campaign_id in campaign_ids:
+            client.post(f'/api/campaigns/{campaign_id}/participate')
+
+        result = {'views': views, 'database': os.path.basename(database)}
+        for name, paths, revalidate in (('separate', SEPARATE, False), ('bootstrap', BOOTSTRAP, False),
+                                        ('separate_revalidate', SEPARATE, True),
+                                        ('bootstrap_revalidate', BOOTSTRAP, True)):
+            etags = {}
+            page_view(client, paths, etags)  # warm-up
+            samples, statuses = [], set()
+            for _ in range(views):
+                seconds, codes = page_view(client, paths, etags if revalidate else {})
+                samples.append(seconds * 1000)
+                statuses.update(codes)
+            samples.sort()
+            result[name] = {
+                'requests_per_view': len(paths),
+                'median_ms': round(statistics.median(samples), 3),
+                'p95_ms': round(samples[int(len(samples) * 0.95) - 1], 3),
+                'statuses': sorted(statuses),
+            }
+        result['speedup'] = round(result['separate']['median_ms'] / result['bootstrap']['median_ms'], 2)
+        result['speedup_revalidate'] = round(
+            result['separate_revalidate']['median_ms'] / result['bootstrap_revalidate']['median_ms'], 2)
+        app.db.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default=os.path.join(ROOT, 'database.db'))
+    parser.add_argument('--views', type=int, default=300)
+    parser.add_argument('--joins', type=int, default=5, help='campaigns the donor joins first')
+    args = parser.parse_args()
+    print(json.dumps(run(args.database, args.views, args.joins), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""Seeded synthetic database: donors, campaigns and participations.
+
+    python -m bench.datagen /tmp/bench.db --donors 100000 --campaigns 200 --seed 1
+
+Builds a migrated database at the given path (replacing it with
+``--force``). Donors get realistic Federal District and Goiás addresses and
+CEPs, a blood type following the Brazilian distribution, and birth dates in
+the formats the app actually stores (ISO from the form, ``DD/MM/YYYY`` from
+older rows, some missing or malformed). The same seed always produces the
+same rows. Every donor's password is ``PASSWORD`` (hashed once, so large
+databases build quickly). Afterwards the derived state is recomputed the
+way the app keeps it: participation counters and levels,
+``campanhas.participantes``, the segmentation columns and ``city_stats``.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+import city_stats
+import gamification
+import segmentation
+from migrations import migrate
+
+PASSWORD = 'senha123'
+CHUNK = 10000
+
+FIRST_NAMES = ('Ana', 'Maria', 'Francisca', 'Antônia', 'Adriana', 'Juliana', 'Márcia', 'Fernanda', 'Patrícia',
+               'Aline', 'José', 'João', 'Antônio', 'Francisco', 'Carlos', 'Paulo', 'Pedro', 'Lucas', 'Luiz',
+               'Marcos', 'Gabriel', 'Rafael', 'Daniel', 'Marcelo', 'Bruno', 'Eduardo', 'Felipe', 'Raimundo',
+               'Camila', 'Larissa', 'Beatriz', 'Letícia', 'Mateus', 'Thiago', 'Vitória', 'Sofia')
+LAST_NAMES = ('Silva', 'Santos', 'Oliveira', 'Souza', 'Rodrigues', 'Ferreira', 'Alves', 'Pereira', 'Lima',
+              'Gomes', 'Costa', 'Ribeiro', 'Martins', 'Carvalho', 'Almeida', 'Lopes', 'Soares', 'Fernandes',
+              'Vieira', 'Barbosa', 'Rocha', 'Dias', 'Nascimento', 'Andrade', 'Moreira', 'Nunes', 'Marques')
+
+# (region, CEP prefix, address patterns) -- weights roughly follow population
+DF_REGIONS = (
+    ('Ceilândia', '722', 14, ('QNM {n} Conjunto {c} Casa {h}', 'QNN {n} Conjunto {c} Lote {h}')),
+    ('Samambaia Sul (Samambaia)', '723', 9, ('Quadra QR {n} Conjunto {c} Casa {h}',)),
+    ('Taguatinga Sul (Taguatinga)', '720', 8, ('Área QSE Área Especial {n}', 'QSD {n} Casa {h}')),
+    ('Taguatinga Norte (Taguatinga)', '721', 6, ('QNL {n} Bloco {c} Apartamento {h}',)),
+    ('Plano Piloto', '703', 8, ('SQS {n}0{c} Bloco {c} Apartamento {h}0{c}', 'SQN {n}0{c} Bloco {c}')),
+    ('Gama', '724', 5, ('Quadra {n} Conjunto {c} Casa {h}',)),
+    ('Santa Maria', '725', 5, ('Quadra QR {n}0{c} Conjunto {c}',)),
+    ('Sobradinho', '730', 4, ('Quadra {n} Conjunto {c} Casa {h}',)),
+    ('Planaltina', '733', 6, ('Setor Residencial Leste Quadra {n} Casa {h}',)),
+    ('Águas Claras', '719', 5, ('Rua {n} Sul Lote {h}', 'Avenida das Araucárias Lote {h}')),
+    ('Guará I (Guará)', '710', 4, ('QE {n} Conjunto {c} Casa {h}',)),
+    ('Recanto das Emas', '726', 4, ('Quadra {n}0{c} Conjunto {c} Casa {h}',)),
+    ('Setor de Habitações Individuais Norte', '715', 2, ('Quadra SHIN QL {n}',)),
+)
+OTHER_CITIES = (
+    ('Goiânia', 'GO', '740', 6), ('Valparaíso de Goiás', 'GO', '728', 3), ('Luziânia', 'GO', '728', 2),
+    ('Águas Lindas de Goiás', 'GO', '729', 3), ('Formosa', 'GO', '738', 1), ('Anápolis', 'GO', '750', 2),
+)
+BLOOD_TYPES = (('O+', 36), ('A+', 34), ('O-', 9), ('A-', 8), ('B+', 8), ('B-', 2), ('AB+', 2.5), ('AB-', 0.5))
+GENDERS = (('Feminino', 50), ('Masculino', 47), ('Outro', 2), ('Prefiro não informar', 1))
+INTERESTS = ('sim', 'nao', 'talvez', '')
+CAMPAIGN_NAMES = ('Junho Vermelho', 'Doe Vida', 'Estoque Baixo', 'Carnaval Solidário', 'Natal Solidário',
+                  'Semana do Doador', 'Campanha Universitária', 'Hemocentro Itinerante')
+
+
+def _weighted(rng, options):
+    return rng.choices([o[0] for o in options], weights=[o[-1] for o in options])[0]
+
+
+def _poisson(rng, lam):
+    # Knuth; fine for the small means used here
+    limit, k, p = math.exp(-lam), 0, rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
+
+
+def _cep(rng, prefix):
+    digits = prefix + ''.join(str(rng.randrange(10)) for _ in range(8 - len(prefix)))
+    # the form accepts both 12345-678 and 12345678
+    return f'{digits[:5]}-{digits[5:]}' if rng.random() < 0.6 else digits
+
+
+def _address(rng):
+    roll = rng.random()
+    if roll < 0.02:
+        return '', ''
+    if roll < 0.04:
+        return rng.choice(('Rua X', 'Brasília', 'asdf')), rng.choice(('00000', ''))
+    fill = {'n': rng.randint(1, 40), 'c': rng.choice('ABCDEFGH'), 'h': rng.randint(1, 60)}
+    if roll < 0.82:
+        region = rng.choices(DF_REGIONS, weights=[r[2] for r in DF_REGIONS])[0]
+        street = rng.choice(region[3]).format(**fill)
+        city = 'Brasília/DF' if rng.random() < 0.9 else 'Brasilia/DF'
+        return f'{street}, {region[0]} - {city}', _cep(rng, region[1])
+    name, uf, prefix, _ = rng.choices(OTHER_CITIES, weights=[c[3] for c in OTHER_CITIES])[0]
+    return f'Rua {fill["n"]}, Centro - {name}/{uf}', _cep(rng, prefix)
+
+
+def _birth_date(rng, today):
+    born = today - timedelta(days=rng.randint(16 * 365, 69 * 365))
+    roll = rng.random()
+    if roll < 0.85:
+        return born.isoformat()
+    if roll < 0.97:
+        return born.strftime('%d/%m/%Y')
+    return rng.choice(('', None, '31/02/1990', 'ontem'))
+
+
+def _donor(rng, n, today, password_hash):
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    endereco, cep = _address(rng)
+    ja_doou = 'sim' if rng.random() < 0.45 else 'nao'
+    primeira_vez = (today - timedelta(days=rng.randint(1, 3650))).isoformat() if ja_doou == 'sim' else ''
+    data_nascimento = _birth_date(rng, today)
+    return (
+        f'{first} {last}', f'{first.lower()}.{last.lower()}.{n}@exemplo.com.br',
+        f'(61) 9{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}',
+        _weighted(rng, BLOOD_TYPES), data_nascimento, _weighted(rng, GENDERS), cep, endereco,
+        ja_doou, primeira_vez, rng.choice(INTERESTS),
+        1 if rng.random() < 0.6 else 0, 1 if rng.random() < 0.7 else 0, password_hash,
+        *segmentation.normalized_fields(data_nascimento, endereco),
+    )
+
+
+def _campaign(rng, i, now):
+    created = now - timedelta(days=rng.randint(0, 730), seconds=rng.randint(0, 86399))
+    tipo = 'Todos' if rng.random() < 0.4 else _weighted(rng, BLOOD_TYPES)
+    vagas = 0 if rng.random() < 0.15 else rng.choice((50, 100, 200, 500, 1000, 5000))
+    status = 'Ativa' if rng.random() < 0.7 else 'Encerrada'
+    return (f'{rng.choice(CAMPAIGN_NAMES)} {i}', tipo, vagas, status, created.isoformat())
+
+
+def generate(path, donors=10000, campaigns=100, participations=2.0, seed=1, force=False):
+    """Build the database at ``path``; returns a summary dict."""
+    if os.path.exists(path):
+        if not force:
+            raise FileExistsError(f'{path} já existe (use --force para substituir)')
+        for suffix in ('', '-wal', '-shm', '-versions'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    rng = random.Random(seed)
+    today = date(2025, 11, 1)  # fixed, so ages do not drift between runs
+    now = datetime(2025, 11, 1, 12, 0, 0)
+    started = time.perf_counter()
+
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    migrate(conn)
+    password_hash = generate_password_hash(PASSWORD)
+
+    for start in range(0, donors, CHUNK):
+        rows = [_donor(rng, n, today, password_hash) for n in range(start, min(start + CHUNK, donors))]
+        with conn:
+            conn.executemany('''
+                INSERT INTO usuarios (
+                    nome, email, telefone, tipo_sanguineo, data_nascimento, genero,
+                    cep, endereco, ja_doou, primeira_vez, interesse,
+                    autoriza_msg, autoriza_dados, senha, data_nascimento_iso, cidade_norm
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+    with conn:
+        conn.executemany('''
+            INSERT INTO campanhas (nome, tipo_sanguineo, vagas, status, created_at) VALUES (?, ?, ?, ?, ?)
+        ''', [_campaign(rng, i, now) for i in range(1, campaigns + 1)])
+    capacity = {r['id']: (r['vagas'], r['created_at'])
+                for r in conn.execute('SELECT id, vagas, created_at FROM campanhas')}
+
+    # each donor joins ~Poisson(participations) distinct campaigns with free seats
+    seated = dict.fromkeys(capacity, 0)
+    campaign_ids = list(capacity)
+    batch = []
+    for user_id in range(1, donors + 1) if campaign_ids else ():
+        k = min(len(campaign_ids), _poisson(rng, participations))
+        for cid in rng.sample(campaign_ids, k):
+            vagas, created_at = capacity[cid]
+            if vagas and seated[cid] >= vagas:
+                continue
+            seated[cid] += 1
+            joined = datetime.fromisoformat(created_at) + timedelta(minutes=rng.randint(1, 60 * 24 * 30))
+            batch.append((user_id, cid, joined.isoformat()))
+        if len(batch) >= CHUNK:
+            with conn:
+                conn.executemany('INSERT INTO participacoes (usuario_id, campanha_id, joined_at) VALUES (?, ?, ?)', batch)
+            batch = []
+    with conn:
+        conn.executemany('INSERT INTO participacoes (usuario_id, campanha_id, joined_at) VALUES (?, ?, ?)', batch)
+
+    # derived state, as the app maintains it
+    conn.create_function('level_for', 1, gamification.level_for, deterministic=True)
+    with conn:
+        conn.execute('''
+            UPDATE usuarios SET participation_count = (
+                SELECT COUNT(*) FROM participacoes p WHERE p.usuario_id = usuarios.id
+            )
+        ''')
+        conn.execute('UPDATE usuarios SET nivel = level_for(participation_count)')
+        conn.execute('''
+            UPDATE campanhas SET participantes = (
+                SELECT COUNT(*) FROM participacoes p WHERE p.campanha_id = campanhas.id
+            )
+        ''')
+        cities = city_stats.rebuild(conn)
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    total_participations = conn.execute('SELECT COUNT(*) FROM participacoes').fetchone()[0]
+    conn.close()
+    return {
+        'path': path, 'seed': seed, 'donors': donors, 'campaigns': campaigns,
+        'participations': total_participations, 'cities': cities,
+        'password': PASSWORD, 'seconds': round(time.perf_counter() - started, 2),
+        'size_mb': round(os.path.getsize(path) / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--donors', type=int, default=10000)
+    parser.add_argument('--campaigns', type=int, default=100)
+    parser.add_argument('--participations', type=float, default=2.0, help='mean campaigns joined per donor')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--force', action='store_true', help='replace an existing database')
+    args = parser.parse_args()
+    try:
+        result = generate(args.path, args.donors, args.campaigns, args.participations, args.seed, args.force)
+    except FileExistsError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
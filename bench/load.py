@@ -0,0 +1,318 @@
+"""Mixed read/write load with per-route latency percentiles and throughput.
+
+    python -m bench.datagen /tmp/bench.db --donors 100000
+    python -m bench.load --database /tmp/bench.db --scenario mixed --threads 8 --duration 20 --out before.json
+    python -m bench.load --database /tmp/bench.db --scenario mixed --compare before.json
+
+By default requests go through the Flask test client of an app built on a
+temporary copy of ``--database``, so writes do not change the source file.
+With ``--url`` they go over HTTP to a running server instead, and
+``--database`` is then only read to pick accounts and campaigns. Each
+thread keeps an anonymous session and one logged in as a random generated
+donor (password ``bench.datagen.PASSWORD``).
+
+The report has count, errors, throughput and p50/p95/p99/max latency (ms)
+per operation. ``--out`` saves it as JSON together with the git commit, and
+``--compare`` prints the change against an earlier report.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+import segmentation
+from bench.datagen import PASSWORD
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# operation -> weight, per scenario
+SCENARIOS = {
+    'read': {'home': 20, 'campanhas_api': 25, 'campaigns_page': 20, 'dashboard': 25, 'campanhas_html': 10},
+    'mixed': {'home': 10, 'campanhas_api': 15, 'campaigns_page': 10, 'dashboard': 10, 'campanhas_html': 15,
+              'perfil': 15, 'my_participations': 15, 'participate': 5, 'leave': 5},
+    'write': {'participate': 45, 'leave': 45, 'perfil': 10},
+    'admin': {'segment_dispatch': 20, 'dashboard': 40, 'campaigns_page': 40},
+}
+SEGMENTS = (
+    {'tipo_sanguineo': ['O-', 'O+']},
+    {'cidade': ['Brasília', 'Goiânia'], 'min_age': 18, 'max_age': 60},
+    {'tipo_sanguineo': ['AB-'], 'genero': 'Feminino'},
+    {'min_age': 18, 'max_age': 29},
+)
+
+
+class ClientSession:
+    """Flask test client wrapper."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, json_body=None, form=None):
+        response = self.client.open(path, method=method, json=json_body, data=form)
+        response.get_data()
+        return response.status_code
+
+
+class HTTPSession:
+    """urllib session with its own cookie jar; redirects are not followed."""
+
+    class _NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self._NoRedirect())
+
+    def request(self, method, path, json_body=None, form=None):
+        headers, data = {}, None
+        if json_body is not None:
+            data, headers['Content-Type'] = json.dumps(json_body).encode(), 'application/json'
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with self.opener.open(req, timeout=30) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+class Worker:
+    """One load thread: picks weighted operations until the deadline."""
+
+    def __init__(self, new_session, fixtures, weights, seed):
+        self.rng = random.Random(seed)
+        self.fixtures = fixtures
+        self.ops, self.weights = zip(*weights.items())
+        self.anon = new_session()
+        self.user = new_session()
+        self.email = self.rng.choice(fixtures['emails'])
+        self.joined = []
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.errors = Counter()
+
+    def login(self):
+        return self.user.request('POST', '/login', form={'email': self.email, 'password': PASSWORD})
+
+    def run_op(self, op):
+        rng, fx = self.rng, self.fixtures
+        if op == 'home':
+            return self.anon.request('GET', '/')
+        if op == 'campanhas_api':
+            return self.anon.request('GET', '/api/campanhas')
+        if op == 'campaigns_page':
+            return self.anon.request('GET', '/api/campaigns?limit=50&status=Ativa')
+        if op == 'dashboard':
+            return self.anon.request('GET', '/api/dashboard_data')
+        if op == 'campanhas_html':
+            return self.user.request('GET', '/campanhas')
+        if op == 'perfil':
+            return self.user.request('GET', '/perfil/')
+        if op == 'my_participations':
+            return self.user.request('GET', '/api/my_participations?limit=50')
+        if op == 'participate':
+            cid = rng.choice(fx['campaigns'])
+            status = self.user.request('POST', f'/api/campaigns/{cid}/participate')
+            if status in (201, 202):
+                self.joined.append(cid)
+            return status
+        if op == 'leave':
+            cid = self.joined.pop(rng.randrange(len(self.joined))) if self.joined else rng.choice(fx['campaigns'])
+            return self.user.request('DELETE', f'/api/campaigns/{cid}/participate')
+        if op == 'segment_dispatch':
+            return self.user.request('POST', '/api/admin/send_campaign', json_body={
+                'canal_disparo': 'email', 'remetente': 'Bench', 'conteudo': 'Olá [nome_doador]',
+                'segmentacao': rng.choice(SEGMENTS)})
+        raise ValueError(op)
+
+    def run(self, deadline, record_after):
+        self.login()
+        while True:
+            op = self.rng.choices(self.ops, weights=self.weights)[0]
+            start = time.perf_counter()
+            if start >= deadline:
+                return
+            try:
+                status = self.run_op(op)
+            except Exception as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+            if start < record_after:
+                continue
+            self.latencies[op].append(elapsed)
+            self.statuses[op][str(status)] += 1
+            if not isinstance(status, int) or status >= 500:
+                self.errors[op] += 1
+
+
+def load_fixtures(database, accounts=2000, seed=1):
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        emails = [r[0] for r in conn.execute(
+            'SELECT email FROM usuarios WHERE email LIKE ? ORDER BY id LIMIT ?', ('%@exemplo.com.br', accounts * 10))]
+        campaigns = [r[0] for r in conn.execute("SELECT id FROM campanhas WHERE status = 'Ativa'")]
+        donors = conn.execute('SELECT COUNT(*) FROM usuarios').fetchone()[0]
+        # an empty segment would time a query that returns nothing
+        segment_sizes = [conn.execute(*segmentation.build_query(s, columns='COUNT(*)', conn=conn)).fetchone()[0]
+                         for s in SEGMENTS]
+    finally:
+        conn.close()
+    if not emails or not campaigns:
+        raise SystemExit('banco sem doadores/campanhas gerados: rode python -m bench.datagen primeiro')
+    empty = [s for s, size in zip(SEGMENTS, segment_sizes) if not size]
+    if empty:
+        raise SystemExit(f'segmentos sem destinatários neste banco: {empty}')
+    rng = random.Random(seed)
+    return {'emails': rng.sample(emails, min(accounts, len(emails))), 'campaigns': campaigns, 'donors': donors,
+            'segment_sizes': segment_sizes}
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, statuses, errors, seconds):
+    ms = sorted(v * 1000 for v in latencies)
+    return {
+        'count': len(ms),
+        'errors': errors,
+        'rps': round(len(ms) / seconds, 1) if seconds else None,
+        'p50_ms': round(percentile(ms, 50), 3) if ms else None,
+        'p95_ms': round(percentile(ms, 95), 3) if ms else None,
+        'p99_ms': round(percentile(ms, 99), 3) if ms else None,
+        'max_ms': round(ms[-1], 3) if ms else None,
+        'statuses': dict(statuses),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(database, scenario='mixed', threads=8, duration=20.0, warmup=2.0, url=None, seed=1):
+    fixtures = load_fixtures(database, seed=seed)
+    tmp = None
+    if url:
+        def new_session():
+            return HTTPSession(url)
+        target = url
+    else:
+        from app import create_app
+        tmp = tempfile.mkdtemp(prefix='bench-load-')
+        db_copy = os.path.join(tmp, 'database.db')
+        shutil.copyfile(database, db_copy)
+        app = create_app({'DATABASE': db_copy, 'SECRET_KEY': 'bench', 'APP_ENV': 'testing',
+                          'BACKGROUND_WORKERS_AUTOSTART': False, 'DB_POOL_SIZE': max(8, threads + 2)})
+
+        def new_session():
+            return ClientSession(app)
+        target = 'test-client'
+
+    try:
+        workers = [Worker(new_session, fixtures, SCENARIOS[scenario], seed * 1000 + i) for i in range(threads)]
+        record_after = time.perf_counter() + warmup
+        deadline = record_after + duration
+        pool = [threading.Thread(target=w.run, args=(deadline, record_after)) for w in workers]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+    finally:
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    routes, all_latencies, all_statuses, all_errors = {}, [], Counter(), 0
+    for op in SCENARIOS[scenario]:
+        latencies = [v for w in workers for v in w.latencies[op]]
+        statuses = sum((w.statuses[op] for w in workers), Counter())
+        errors = sum(w.errors[op] for w in workers)
+        routes[op] = summarize(latencies, statuses, errors, duration)
+        all_latencies += latencies
+        all_statuses += statuses
+        all_errors += errors
+    return {
+        'meta': {
+            'commit': git_commit(), 'at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'target': target, 'scenario': scenario,
+            'threads': threads, 'duration_s': duration, 'warmup_s': warmup, 'seed': seed,
+            'donors': fixtures['donors'], 'campaigns_active': len(fixtures['campaigns']),
+            'segment_sizes': fixtures['segment_sizes'],
+        },
+        'overall': summarize(all_latencies, all_statuses, all_errors, duration),
+        'routes': routes,
+    }
+
+
+def compare(current, previous):
+    """Text table of p50/p95/rps changes between two reports."""
+    lines = [f"comparando com {previous['meta'].get('commit')} ({previous['meta'].get('at')})",
+             f"{'operação':<20}{'p50 ms':>18}{'p95 ms':>18}{'req/s':>18}"]
+
+    def cell(old, new):
+        if old is None or new is None:
+            return f'{new}'
+        change = (new - old) / old * 100 if old else 0.0
+        return f'{new:.1f} ({change:+.0f}%)'
+
+    rows = [('overall', current['overall'], previous.get('overall', {}))]
+    rows += [(op, stats, previous['routes'].get(op, {})) for op, stats in current['routes'].items()]
+    for op, new, old in rows:
+        lines.append(f"{op:<20}{cell(old.get('p50_ms'), new['p50_ms']):>18}"
+                     f"{cell(old.get('p95_ms'), new['p95_ms']):>18}{cell(old.get('rps'), new['rps']):>18}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', required=True, help='database built by bench.datagen')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='mixed')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20.0, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=2.0, help='unmeasured seconds first')
+    parser.add_argument('--url', help='load a running server instead of the test client')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='save the JSON report here')
+    parser.add_argument('--compare', help='earlier JSON report to compare against')
+    args = parser.parse_args()
+
+    result = run(args.database, args.scenario, args.threads, args.duration, args.warmup, args.url, args.seed)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as fh:
+            json.dump(result, fh, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as fh:
+            print(compare(result, json.load(fh)))
+    else:
+        print(json.dumps(result, indent=2))
+    sys.exit(1 if result['overall']['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Many threads reserving seats on one campaign; checks the counters stay exact.
+
+    python -m bench.reservation_stress --users 200 --vagas 50 --threads 32
+
+Every user reserves twice (a client retry), and a share of them then leaves,
+which promotes users from the waitlist. At the end the campaign must have
+``participantes == COUNT(participacoes) <= vagas``, each user's
+``participation_count`` must match their rows, and nobody may be both seated
+and waitlisted. Exits with status 1 if any invariant fails.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+
+import reservations
+from database import Database
+from migrations import migrate
+
+
+def _setup(path, users, vagas, pool_size):
+    app = Flask(__name__)
+    app.config.update(DATABASE=path, DB_POOL_SIZE=pool_size, DB_POOL_TIMEOUT=30, DB_WRITE_RETRIES=50)
+    db = Database(app)
+    with db.connection() as conn:
+        migrate(conn)
+
+        def seed(conn):
+            conn.executemany('INSERT INTO usuarios (nome, email) VALUES (?, ?)',
+                             [(f'Doador {i}', f'doador{i}@example.com') for i in range(users)])
+            return conn.execute("INSERT INTO campanhas (nome, vagas, participantes, status) VALUES ('Stress', ?, 0, 'Ativa')",
+                                (vagas,)).lastrowid
+
+        campaign_id = db.run_write(conn, seed)
+        user_ids = [r[0] for r in conn.execute('SELECT id FROM usuarios ORDER BY id')]
+    return db, campaign_id, user_ids
+
+
+def _check(db, campaign_id, vagas):
+    with db.connection() as conn:
+        participantes = conn.execute('SELECT participantes FROM campanhas WHERE id = ?', (campaign_id,)).fetchone()[0]
+        seated = conn.execute('SELECT COUNT(*) FROM participacoes WHERE campanha_id = ?', (campaign_id,)).fetchone()[0]
+        waiting = conn.execute('SELECT COUNT(*) FROM lista_espera WHERE campanha_id = ?', (campaign_id,)).fetchone()[0]
+        both = conn.execute('''
+            SELECT COUNT(*) FROM participacoes p JOIN lista_espera w
+            ON w.usuario_id = p.usuario_id AND w.campanha_id = p.campanha_id
+        ''').fetchone()[0]
+        counter_mismatches = conn.execute('''
+            SELECT COUNT(*) FROM usuarios u
+            WHERE u.participation_count != (SELECT COUNT(*) FROM participacoes p WHERE p.usuario_id = u.id)
+        ''').fetchone()[0]
+    failures = []
+    if participantes != seated:
+        failures.append(f'participantes={participantes} but {seated} participacoes')
+    if seated > vagas:
+        failures.append(f'{seated} seated for {vagas} vagas')
+    if both:
+        failures.append(f'{both} users both seated and waitlisted')
+    if counter_mismatches:
+        failures.append(f'{counter_mismatches} users with a wrong participation_count')
+    if waiting and seated < vagas:
+        failures.append(f'{waiting} waiting while {vagas - seated} seats are free')
+    return {'participantes': participantes, 'seated': seated, 'waitlisted': waiting}, failures
+
+
+def run(users, vagas, threads, leave_ratio, seed):
+    rng = random.Random(seed)
+    path = os.path.join(tempfile.mkdtemp(prefix='reservation-stress-'), 'stress.db')
+    db, campaign_id, user_ids = _setup(path, users, vagas, threads)
+    leavers = set(rng.sample(user_ids, int(len(user_ids) * leave_ratio)))
+    outcomes = {}
+    lock = threading.Lock()
+
+    def worker(user_id):
+        with db.connection() as conn:
+            for _ in range(2):
+                outcome, _ = db.run_write(conn, lambda conn: reservations.reserve(conn, user_id, campaign_id))
+                with lock:
+                    outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if user_id in leavers:
+                outcome, _ = db.run_write(conn, lambda conn: reservations.release(conn, user_id, campaign_id))
+                with lock:
+                    outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, user_ids))
+    elapsed = time.perf_counter() - start
+
+    counts, failures = _check(db, campaign_id, vagas)
+    result = {
+        'users': users, 'vagas': vagas, 'threads': threads, 'leavers': len(leavers),
+        'seconds': round(elapsed, 3), 'requests_per_sec': round((users * 2 + len(leavers)) / elapsed, 1),
+        'outcomes': outcomes, 'final': counts, 'locks': db.stats()['locks'], 'failures': failures,
+    }
+    db.pool.close_all()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--vagas', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--leave-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    result = run(args.users, args.vagas, args.threads, args.leave_ratio, args.seed)
+    print(json.dumps(result, indent=2))
+    sys.exit(1 if result['failures'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Minimal local SMTP server that accepts and discards every message.
+
+Stand-in for a real relay when benchmarking the mail path. ``connect_delay``
+holds the greeting back to model the TCP + TLS handshake and login cost of a
+remote server, which is what connection reuse saves.
+
+    python -m bench.smtp_sink --port 8025 --connect-delay 0.05
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def _reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        if server.connect_delay:
+            time.sleep(server.connect_delay)
+        with server.lock:
+            server.connections += 1
+        self._reply('220 sink ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.strip().split(b' ', 1)[0].upper()
+            if verb == b'EHLO':
+                self.wfile.write(b'250-sink\r\n250 8BITMIME\r\n')
+            elif verb == b'DATA':
+                self._reply('354 end with <CRLF>.<CRLF>')
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b'.\r\n':
+                        break
+                with server.lock:
+                    server.messages += 1
+                self._reply('250 queued')
+            elif verb == b'QUIT':
+                self._reply('221 bye')
+                return
+            else:
+                # HELO, MAIL, RCPT, RSET, NOOP...
+                self._reply('250 ok')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, connect_delay=0.0):
+        super().__init__((host, port), _Handler)
+        self.connect_delay = connect_delay
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--connect-delay', type=float, default=0.0)
+    args = parser.parse_args()
+    sink = SMTPSink(args.host, args.port, args.connect_delay)
+    print(f'SMTP sink listening on {args.host}:{sink.port}')
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f'{sink.messages} messages over {sink.connections} connections')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Messages per second: one SMTP connection per message vs mailer.SMTPSession.
+
+    python -m bench.smtp_throughput --messages 300 --connect-delay 0.02
+"""
+import argparse
+import json
+import time
+
+from flask import Flask
+from flask_mail import Mail, Message
+
+from bench.smtp_sink import SMTPSink
+from mailer import SMTPSession
+
+
+def _message(i):
+    return Message(subject=f'Campanha {i}', recipients=[f'doador{i}@example.com'],
+                   body='Olá, doador!', sender=('Hemocentro', 'noreply@example.com'))
+
+
+def run(messages, connect_delay, rotate_after):
+    sink = SMTPSink(connect_delay=connect_delay).start()
+    app = Flask(__name__)
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=sink.port, MAIL_USE_TLS=False)
+    mail = Mail(app)
+    results = {}
+    with app.app_context():
+        start = time.perf_counter()
+        for i in range(messages):
+            mail.send(_message(i))
+        elapsed = time.perf_counter() - start
+        results['per_message'] = {'seconds': round(elapsed, 4), 'msgs_per_sec': round(messages / elapsed, 1),
+                                  'connections': sink.connections}
+
+        opened_before = sink.connections
+        start = time.perf_counter()
+        with SMTPSession(mail, rotate_after=rotate_after) as session:
+            for i in range(messages):
+                session.send(_message(i))
+        elapsed = time.perf_counter() - start
+        results['session'] = {'seconds': round(elapsed, 4), 'msgs_per_sec': round(messages / elapsed, 1),
+                              'connections': sink.connections - opened_before}
+    sink.shutdown()
+    results['speedup'] = round(results['session']['msgs_per_sec'] / results['per_message']['msgs_per_sec'], 2)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=300)
+    parser.add_argument('--connect-delay', type=float, default=0.02,
+                        help='seconds the sink waits before its greeting (models TLS + login)')
+    parser.add_argument('--rotate-after', type=int, default=100)
+    args = parser.parse_args()
+    print(json.dumps(run(args.messages, args.connect_delay, args.rotate_after), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Cold-start latency: process start to the first served request.
+
+    python -m bench.startup_time --runs 10 --path /api/campanhas
+
+Each run is a fresh interpreter that imports app.py, calls ``create_app``
+and serves one GET through the test client, timing each phase. The database
+is a temporary copy of ``--database`` (or an empty file with ``--fresh``, so
+the first request also pays for the migrations). Reports min/median/max per
+phase in seconds.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import json, sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+application = app.create_app({'DATABASE': sys.argv[1], 'SECRET_KEY': 'bench', 'LOG_LEVEL': 'WARNING',
+                              'BACKGROUND_WORKERS_AUTOSTART': False})
+t2 = time.perf_counter()
+status = application.test_client().get(sys.argv[2]).status_code
+t3 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'create_app': t2 - t1, 'first_request': t3 - t2,
+                  'total': t3 - t0, 'status': status}))
+'''
+
+PHASES = ('import', 'create_app', 'first_request', 'total')
+
+
+def run_once(database, path, fresh):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'database.db')
+        if not fresh:
+            shutil.copyfile(database, db_path)
+        out = subprocess.run([sys.executable, '-c', CHILD, db_path, path], cwd=ROOT,
+                             capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def run(runs, database, path, fresh=False):
+    samples = [run_once(database, path, fresh) for _ in range(runs)]
+    result = {'runs': runs, 'path': path, 'fresh': fresh,
+              'statuses': sorted({s['status'] for s in samples})}
+    for phase in PHASES:
+        values = [s[phase] for s in samples]
+        result[phase] = {'min': round(min(values), 4), 'median': round(statistics.median(values), 4),
+                         'max': round(max(values), 4)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--database', default=os.path.join(ROOT, 'database.db'))
+    parser.add_argument('--path', default='/')
+    parser.add_argument('--fresh', action='store_true', help='start from an empty database')
+    args = parser.parse_args()
+    print(json.dumps(run(args.runs, args.database, args.path, args.fresh), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""Live campaign changes pushed to browsers over Server-Sent Events.
+
+One watcher thread per process follows the ``campanhas`` version counter
+(versions.py). A commit in this process wakes it at once; commits made by
+other worker processes are seen through the shared stamp file, which the
+watcher checks every ``SSE_POLL_INTERVAL`` seconds at the cost of a
+``stat``. On a change it reads the (small) ``campanhas`` table once, diffs it
+against the previous snapshot and publishes only the changed fields. Any
+number of open streams costs that same single read.
+
+Each stream has a bounded queue. A client too slow to drain it is not
+allowed to hold memory or block the others: its backlog is dropped and it
+gets a ``reset`` event telling it to reload the list. Idle streams send a
+comment line every ``SSE_HEARTBEAT`` seconds, which also detects clients
+that went away. Streams end after ``SSE_MAX_DURATION`` seconds; the browser
+reconnects by itself and sends the last event id (the campaign version), so a
+missed change turns into a ``reset``.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+FIELDS = ('nome', 'tipo_sanguineo', 'vagas', 'participantes', 'status')
+RETRY_MS = 3000
+
+
+def format_event(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+def diff(before, after):
+    """Compact changes between two ``{id: row}`` snapshots.
+
+    New campaigns carry ``'created': True`` and all ``FIELDS``, changed ones
+    only what changed, removed ones ``{'id': ..., 'deleted': True}``.
+    """
+    changes = []
+    for campaign_id, row in after.items():
+        old = before.get(campaign_id)
+        if old is None:
+            changes.append({'id': campaign_id, 'created': True, **row})
+            continue
+        changed = {k: v for k, v in row.items() if old.get(k) != v}
+        if changed:
+            changes.append({'id': campaign_id, **changed})
+    changes.extend({'id': campaign_id, 'deleted': True} for campaign_id in before if campaign_id not in after)
+    return changes
+
+
+class Subscriber:
+    __slots__ = ('queue',)
+
+    def __init__(self, size):
+        self.queue = queue.Queue(size)
+
+
+class CampaignBroadcaster:
+    """Flask extension fanning campaign changes out to SSE subscribers."""
+
+    def __init__(self, app=None, database=None, table_versions=None):
+        self.database = database
+        self.table_versions = table_versions
+        self.queue_size = 64
+        self.heartbeat = 15.0
+        self.poll_interval = 1.0
+        self.max_clients = 32
+        self.max_duration = 300.0
+        self.published = 0
+        self.resets = 0
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._version = None
+        self._snapshot = None
+        if app is not None:
+            self.init_app(app, database, table_versions)
+
+    def init_app(self, app, database, table_versions):
+        app.config.setdefault('SSE_QUEUE_SIZE', 64)
+        app.config.setdefault('SSE_HEARTBEAT', 15)
+        app.config.setdefault('SSE_POLL_INTERVAL', 1.0)
+        app.config.setdefault('SSE_MAX_CLIENTS', 32)
+        app.config.setdefault('SSE_MAX_DURATION', 300)
+        self.database = database
+        self.table_versions = table_versions
+        self.queue_size = int(app.config['SSE_QUEUE_SIZE'])
+        self.heartbeat = float(app.config['SSE_HEARTBEAT'])
+        self.poll_interval = float(app.config['SSE_POLL_INTERVAL'])
+        self.max_clients = int(app.config['SSE_MAX_CLIENTS'])
+        self.max_duration = float(app.config['SSE_MAX_DURATION'])
+        table_versions.add_listener(self.notify)
+        app.extensions['broadcast'] = self
+
+    # -- subscribers -----------------------------------------------------------
+
+    def subscribe(self, last_event_id=None):
+        """A new Subscriber, or None when this process already serves ``max_clients``."""
+        self.start()
+        sub = Subscriber(self.queue_size)
+        with self._lock:
+            if len(self._subscribers) >= self.max_clients:
+                return None
+            self._subscribers.add(sub)
+        current = self.table_versions.get('campanhas')[0]
+        if last_event_id is not None and last_event_id != str(current):
+            self._reset(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def stream(self, sub):
+        """Generator of SSE bytes for ``sub``; unsubscribes when closed."""
+        deadline = time.monotonic() + self.max_duration
+        try:
+            # the id sets the browser's Last-Event-ID even if no event follows,
+            # so reconnecting after max_duration on a quiet stream is checked too
+            yield f'id: {self._version}\nretry: {RETRY_MS}\n\n'.encode('ascii')
+            while not self._stop.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    message = sub.queue.get(timeout=min(self.heartbeat, remaining))
+                except queue.Empty:
+                    yield b': ping\n\n'
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.unsubscribe(sub)
+
+    def publish(self, event, data, event_id=None):
+        message = format_event(event, data, event_id)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            try:
+                sub.queue.put_nowait(message)
+            except queue.Full:
+                self._reset(sub)
+        self.published += 1
+
+    def _reset(self, sub):
+        # drop the backlog and tell the client to reload instead
+        while True:
+            try:
+                sub.queue.get_nowait()
+            except queue.Empty:
+                break
+        try:
+            sub.queue.put_nowait(format_event('reset', {}, self.table_versions.get('campanhas')[0]))
+        except queue.Full:
+            pass
+        self.resets += 1
+
+    def stats(self):
+        with self._lock:
+            subscribers = len(self._subscribers)
+        return {'subscribers': subscribers, 'published': self.published, 'resets': self.resets}
+
+    # -- watcher -----------------------------------------------------------------
+
+    def notify(self):
+        """Wake the watcher (called after a local commit that bumped a counter)."""
+        self._wake.set()
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._version, self._snapshot = self._load()
+            self._thread = threading.Thread(target=self._run, name='campaign-broadcaster', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def stop(self, timeout=5.0):
+        """Stop the watcher and end every open stream."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._wake.set()
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            try:
+                sub.queue.put_nowait(None)
+            except queue.Full:
+                pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _load(self):
+        version = self.table_versions.get('campanhas')[0]
+        with self.database.connection() as conn:
+            rows = conn.execute(f"SELECT id, {', '.join(FIELDS)} FROM campanhas").fetchall()
+        return version, {r['id']: {k: r[k] for k in FIELDS} for r in rows}
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            try:
+                self.check()
+            except Exception:
+                logging.exception('Erro ao acompanhar mudanças de campanhas')
+
+    def check(self):
+        """Publish the campaign changes since the last check, if any."""
+        if self.table_versions.get('campanhas')[0] == self._version:
+            return 0
+        version, snapshot = self._load()
+        changes = diff(self._snapshot, snapshot)
+        self._version, self._snapshot = version, snapshot
+        if changes:
+            self.publish('campaigns', changes, version)
+        return len(changes)
@@ -0,0 +1,121 @@
+"""Campaign repository on the ``campanhas`` table.
+
+Both campaign APIs go through here: ``/api/campaigns`` (campaign list and
+admin page) and ``/api/campanhas`` (campanhas_admin.js). Every worker process
+therefore sees the same data. Write functions take the connection of an open
+write transaction (``run_write``) and bump the ``campanhas`` version counter
+(versions.py) that cached responses depend on; reads take any connection.
+"""
+from datetime import datetime
+
+import reservations
+import versions
+from pagination import keyset_page
+
+COLUMNS = ('id', 'nome', 'tipo_sanguineo', 'vagas', 'participantes', 'status', 'created_at')
+PARTICIPATION_COLUMNS = ('participacao_id', 'joined_at') + COLUMNS
+UPDATABLE = ('nome', 'tipo_sanguineo', 'vagas', 'status')
+
+STATISTICS_SQL = '''
+    SELECT COUNT(*) AS total_campanhas,
+           COALESCE(SUM(participantes), 0) AS total_participantes,
+           COALESCE(SUM(vagas), 0) AS total_vagas
+    FROM campanhas
+'''
+
+
+def list_campaigns(conn):
+    return [dict(r) for r in conn.execute(f'''
+        SELECT {', '.join(COLUMNS)} FROM campanhas ORDER BY created_at DESC, id DESC
+    ''')]
+
+
+def list_page(conn, status=None, limit=None, after=None, fields=COLUMNS):
+    """One page of campaigns, newest first; returns ``(rows, next_cursor)``."""
+    where, params = [], []
+    if status:
+        where.append('status = ?')
+        params.append(status)
+    select = f'''
+        SELECT {', '.join(fields)}, created_at AS _ts, id AS _id FROM campanhas
+    '''
+    return keyset_page(conn, select, where, params, ('created_at', 'id'), fields, limit, after)
+
+
+def participations_page(conn, user_id, status=None, limit=None, after=None, fields=PARTICIPATION_COLUMNS):
+    """One page of a user's participations joined with their campaigns."""
+    where, params = ['p.usuario_id = ?'], [user_id]
+    if status:
+        where.append('c.status = ?')
+        params.append(status)
+    # participacao_id/joined_at/id come from participacoes itself
+    own = {'participacao_id': 'p.id AS participacao_id', 'joined_at': 'p.joined_at', 'id': 'p.campanha_id AS id'}
+    columns = ', '.join(own.get(f, f'c.{f}') for f in fields)
+    select = f'''
+        SELECT {columns}, p.joined_at AS _ts, p.id AS _id
+        FROM participacoes p JOIN campanhas c ON p.campanha_id = c.id
+    '''
+    return keyset_page(conn, select, where, params, ('p.joined_at', 'p.id'), fields, limit, after)
+
+
+def participation_ids(conn, user_id):
+    """Ids of the campaigns ``user_id`` takes part in."""
+    return [r[0] for r in conn.execute(
+        'SELECT campanha_id FROM participacoes WHERE usuario_id = ? ORDER BY campanha_id', (user_id,))]
+
+
+def get(conn, campaign_id):
+    row = conn.execute(f'SELECT {", ".join(COLUMNS)} FROM campanhas WHERE id = ?', (campaign_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def create(conn, nome, tipo_sanguineo=None, vagas=0, status='Ativa'):
+    """Insert a campaign and return it as a dict."""
+    created_at = datetime.utcnow().isoformat()
+    campaign_id = conn.execute('''
+        INSERT INTO campanhas (nome, tipo_sanguineo, vagas, participantes, status, created_at)
+        VALUES (?, ?, ?, 0, ?, ?)
+    ''', (nome, tipo_sanguineo, int(vagas or 0), status or 'Ativa', created_at)).lastrowid
+    versions.bump(conn, 'campanhas')
+    return {'id': campaign_id, 'nome': nome, 'tipo_sanguineo': tipo_sanguineo, 'vagas': int(vagas or 0),
+            'participantes': 0, 'status': status or 'Ativa', 'created_at': created_at}
+
+
+def update(conn, campaign_id, changes):
+    """Apply the UPDATABLE keys present (and not None) in ``changes``.
+
+    Returns ``(found, promoted_user_ids)``: raising ``vagas`` may seat users
+    from the waitlist.
+    """
+    fields = [(k, int(changes[k]) if k == 'vagas' else changes[k])
+              for k in UPDATABLE if changes.get(k) is not None]
+    if fields:
+        found = conn.execute(
+            'UPDATE campanhas SET ' + ', '.join(f'{k} = ?' for k, _ in fields) + ' WHERE id = ?',
+            (*[v for _, v in fields], campaign_id)).rowcount > 0
+    else:
+        found = conn.execute('SELECT 1 FROM campanhas WHERE id = ?', (campaign_id,)).fetchone() is not None
+    if not found:
+        return False, []
+    versions.bump(conn, 'campanhas')
+    if changes.get('vagas') is not None:
+        return found, reservations.promote(conn, campaign_id)
+    return found, []
+
+
+def delete(conn, campaign_id):
+    conn.execute('DELETE FROM lista_espera WHERE campanha_id = ?', (campaign_id,))
+    if conn.execute('DELETE FROM campanhas WHERE id = ?', (campaign_id,)).rowcount == 0:
+        return False
+    versions.bump(conn, 'campanhas')
+    return True
+
+
+def statistics(conn):
+    """totalCampanhas/totalParticipantes/vagasDisponiveis from one aggregate query."""
+    row = conn.execute(STATISTICS_SQL).fetchone()
+    return {
+        'totalCampanhas': row['total_campanhas'],
+        'totalParticipantes': row['total_participantes'],
+        'vagasDisponiveis': row['total_vagas'] - row['total_participantes'],
+    }
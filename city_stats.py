@@ -0,0 +1,120 @@
+"""Per-city aggregate behind ``/api/dashboard_data``.
+
+``city_stats`` holds one row per dashboard city label with the number of
+users there (``potential``) and how many accepted messages (``consent``).
+Signup and profile updates adjust it inside the same write transaction as
+the ``usuarios`` change, so the dashboard reads a handful of rows instead of
+scanning every user. ``flask rebuild-city-stats`` recomputes it from scratch.
+
+Each change also bumps the ``city_stats`` counter (versions.py); the
+endpoint uses that number as its ETag.
+"""
+import versions
+
+
+def city_label(endereco, cep):
+    """City shown on the dashboard for a user (heuristic: last token after a comma)."""
+    endereco = endereco or ''
+    if ',' in endereco:
+        return endereco.split(',')[-1].strip()
+    if endereco.strip():
+        return endereco.strip()
+    if cep:
+        return f'CEP {cep}'
+    return 'Desconhecido'
+
+
+def distance_for(city):
+    # deterministic pseudo-distance: sum of char codes mod 30 + 1
+    return (sum(ord(ch) for ch in city) % 30) + 1
+
+
+def _consented(autoriza_msg):
+    try:
+        return 1 if int(autoriza_msg) == 1 else 0
+    except (TypeError, ValueError):
+        return 0
+
+
+def snapshot(conn, user_id):
+    """The fields of a user that feed the aggregate, read before an update."""
+    return conn.execute('SELECT endereco, cep, autoriza_msg FROM usuarios WHERE id = ?', (user_id,)).fetchone()
+
+
+def _adjust(conn, city, potential, consent):
+    conn.execute('''
+        INSERT INTO city_stats (city, potential, consent, distance) VALUES (?, ?, ?, ?)
+        ON CONFLICT(city) DO UPDATE SET
+            potential = potential + excluded.potential,
+            consent = consent + excluded.consent
+    ''', (city, potential, consent, distance_for(city)))
+    if potential < 0:
+        conn.execute('DELETE FROM city_stats WHERE city = ? AND potential <= 0', (city,))
+
+
+def apply_change(conn, old, new):
+    """Move one user from ``old`` to ``new`` in the aggregate.
+
+    Both are ``(endereco, cep, autoriza_msg)`` rows or tuples; ``None`` means
+    the user did not exist before (signup) or no longer exists. Call inside the
+    transaction that writes the user.
+    """
+    before = (city_label(old[0], old[1]), _consented(old[2])) if old is not None else None
+    after = (city_label(new[0], new[1]), _consented(new[2])) if new is not None else None
+    if before == after:
+        return False
+    if before is not None:
+        _adjust(conn, before[0], -1, -before[1])
+    if after is not None:
+        _adjust(conn, after[0], 1, after[1])
+    versions.bump(conn, 'city_stats')
+    return True
+
+
+def add_many(conn, rows):
+    """Count new users in bulk: one upsert per city and a single version bump.
+
+    ``rows`` are ``(endereco, cep, autoriza_msg)`` tuples of users just
+    inserted in the current transaction.
+    """
+    totals = {}
+    for endereco, cep, autoriza_msg in rows:
+        city = city_label(endereco, cep)
+        potential, consent = totals.get(city, (0, 0))
+        totals[city] = (potential + 1, consent + _consented(autoriza_msg))
+    for city, (potential, consent) in totals.items():
+        _adjust(conn, city, potential, consent)
+    if totals:
+        versions.bump(conn, 'city_stats')
+    return len(totals)
+
+
+def rebuild(conn):
+    """Recompute the whole table from ``usuarios``; returns the number of cities."""
+    conn.create_function('city_label', 2, city_label, deterministic=True)
+    conn.create_function('city_distance', 1, distance_for, deterministic=True)
+    conn.execute('DELETE FROM city_stats')
+    conn.execute('''
+        INSERT INTO city_stats (city, potential, consent, distance)
+        SELECT city, COUNT(*), SUM(consent), city_distance(city)
+        FROM (
+            SELECT city_label(endereco, cep) AS city,
+                   CASE WHEN autoriza_msg = 1 THEN 1 ELSE 0 END AS consent
+            FROM usuarios
+        )
+        GROUP BY city
+    ''')
+    versions.bump(conn, 'city_stats')
+    return conn.execute('SELECT COUNT(*) FROM city_stats').fetchone()[0]
+
+
+def dashboard_rows(conn):
+    """Rows for the dashboard, largest donor pool first."""
+    results = []
+    for r in conn.execute('''
+        SELECT city, potential, consent, distance FROM city_stats ORDER BY potential DESC, city
+    '''):
+        engage = (r['consent'] / r['potential']) if r['potential'] else 0
+        results.append({'city': r['city'], 'potential': r['potential'],
+                        'engage': round(engage, 2), 'distance': r['distance']})
+    return results
@@ -0,0 +1,376 @@
+"""Pooled SQLite connections tied to the Flask app context.
+
+Routes call ``get_db()`` to borrow a connection for the duration of the
+request; it goes back to the pool on app-context teardown. Code running
+outside a request (startup, CLI, background threads) uses
+``Database.connection()`` as a context manager instead.
+
+Writes go through ``run_write()``, which opens an IMMEDIATE transaction and
+retries the whole unit with backoff when SQLite reports the file as busy.
+Several reads that must agree with each other go inside
+``read_transaction(conn)``.
+"""
+import logging
+import queue
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g
+
+# Applied to every connection the pool opens. ``journal_mode`` is persistent
+# and is set once by ``bootstrap()`` instead.
+DEFAULT_PRAGMAS = (
+    ('foreign_keys', 'ON'),
+    ('busy_timeout', 5000),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16000),
+    ('mmap_size', 134217728),
+    ('temp_store', 'MEMORY'),
+    ('wal_autocheckpoint', 1000),
+    ('journal_size_limit', 67108864),
+)
+
+BUSY_MESSAGES = ('database is locked', 'database is busy', 'database table is locked')
+
+
+def is_busy_error(exc):
+    return isinstance(exc, sqlite3.OperationalError) and any(m in str(exc) for m in BUSY_MESSAGES)
+
+
+def bootstrap(path, journal_mode='WAL'):
+    """Switch the database file to ``journal_mode`` and return the active mode."""
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(f'PRAGMA journal_mode = {journal_mode}').fetchone()[0]
+    finally:
+        conn.close()
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became available in time."""
+
+
+class ConnectionPool:
+    """Bounded pool of open SQLite connections.
+
+    Connections are opened lazily up to ``size`` and then reused; callers
+    block for up to ``timeout`` seconds when every connection is checked out.
+    """
+
+    def __init__(self, path, size=8, timeout=5.0, pragmas=DEFAULT_PRAGMAS):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = tuple(pragmas)
+        # connection class for new connections (metrics.py swaps in a timed one)
+        self.factory = sqlite3.Connection
+        # optional ``observer(seconds)`` called with each blocking wait
+        self.observer = None
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._acquired = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, factory=self.factory)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas:
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _reserve_slot(self):
+        with self._lock:
+            if self._created >= self.size:
+                return False
+            self._created += 1
+            return True
+
+    def _open_reserved(self):
+        try:
+            return self._open()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def prefill(self):
+        """Open connections until the pool is full."""
+        while self._reserve_slot():
+            self._idle.put(self._open_reserved())
+
+    def acquire(self):
+        start = time.perf_counter()
+        blocked = False
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            if self._reserve_slot():
+                conn = self._open_reserved()
+            else:
+                blocked = True
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise PoolTimeout(f'no database connection available after {self.timeout}s')
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+            if blocked:
+                self._waits += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+        if blocked and self.observer is not None:
+            self.observer(waited)
+        return conn
+
+    def release(self, conn):
+        with self._lock:
+            self._in_use -= 1
+        try:
+            if conn.in_transaction:
+                # never hand a half-finished transaction to the next borrower
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'open': self._created,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize(),
+                'acquired_total': self._acquired,
+                'waits_total': self._waits,
+                'wait_seconds_total': round(self._wait_total, 6),
+                'wait_seconds_max': round(self._wait_max, 6),
+                'timeouts_total': self._timeouts,
+            }
+
+
+class LockStats:
+    """Counters for SQLITE_BUSY handling in ``Database.run_write``."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.busy_errors = 0
+        self.retries = 0
+        self.retry_wait_seconds = 0.0
+        self.gave_up = 0
+
+    def record(self, retried=False, waited=0.0, gave_up=False):
+        with self._lock:
+            self.busy_errors += 1
+            if retried:
+                self.retries += 1
+                self.retry_wait_seconds += waited
+            if gave_up:
+                self.gave_up += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'busy_errors_total': self.busy_errors,
+                'retries_total': self.retries,
+                'retry_wait_seconds_total': round(self.retry_wait_seconds, 6),
+                'gave_up_total': self.gave_up,
+            }
+
+
+class Database:
+    """Flask extension owning the connection pool."""
+
+    def __init__(self, app=None):
+        self.pool = None
+        self.journal_mode = None
+        self.lock_stats = LockStats()
+        self.write_retries = 5
+        self.retry_base_delay = 0.01
+        self.retry_max_delay = 0.5
+        self.last_checkpoint = None
+        self._transaction_hooks = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DATABASE', 'database.db')
+        app.config.setdefault('DB_POOL_SIZE', 8)
+        app.config.setdefault('DB_POOL_TIMEOUT', 5.0)
+        app.config.setdefault('DB_POOL_PREFILL', False)
+        app.config.setdefault('DB_JOURNAL_MODE', 'WAL')
+        app.config.setdefault('DB_BUSY_TIMEOUT_MS', 5000)
+        app.config.setdefault('DB_CACHE_SIZE_KB', 16000)
+        app.config.setdefault('DB_MMAP_SIZE', 134217728)
+        app.config.setdefault('DB_WAL_AUTOCHECKPOINT', 1000)
+        app.config.setdefault('DB_WRITE_RETRIES', 5)
+        app.config.setdefault('DB_RETRY_BASE_DELAY', 0.01)
+
+        self.write_retries = int(app.config['DB_WRITE_RETRIES'])
+        self.retry_base_delay = float(app.config['DB_RETRY_BASE_DELAY'])
+        self.journal_mode = bootstrap(app.config['DATABASE'], app.config['DB_JOURNAL_MODE'])
+        overrides = {
+            'busy_timeout': int(app.config['DB_BUSY_TIMEOUT_MS']),
+            'cache_size': -int(app.config['DB_CACHE_SIZE_KB']),
+            'mmap_size': int(app.config['DB_MMAP_SIZE']),
+            'wal_autocheckpoint': int(app.config['DB_WAL_AUTOCHECKPOINT']),
+        }
+        pragmas = [(name, overrides.get(name, value)) for name, value in DEFAULT_PRAGMAS]
+        self.pool = ConnectionPool(
+            app.config['DATABASE'],
+            size=int(app.config['DB_POOL_SIZE']),
+            timeout=float(app.config['DB_POOL_TIMEOUT']),
+            pragmas=pragmas,
+        )
+        if app.config['DB_POOL_PREFILL']:
+            self.pool.prefill()
+        app.extensions['database'] = self
+        app.teardown_appcontext(self._teardown)
+
+        @app.cli.command('db-checkpoint')
+        def db_checkpoint_command():
+            """Fold the WAL back into the database file and truncate it."""
+            print(self.checkpoint('TRUNCATE'))
+
+    def run_write(self, conn, work):
+        """Run ``work(conn)`` inside an IMMEDIATE transaction and commit.
+
+        The whole unit is retried with jittered exponential backoff when the
+        database is busy, so ``work`` must be safe to re-run from scratch.
+        """
+        for attempt in range(self.write_retries + 1):
+            try:
+                if not conn.in_transaction:
+                    conn.execute('BEGIN IMMEDIATE')
+                result = work(conn)
+                conn.commit()
+                self._transaction_ended(conn, True)
+                return result
+            except Exception as exc:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._transaction_ended(conn, False)
+                if not is_busy_error(exc):
+                    raise
+                if attempt == self.write_retries:
+                    self.lock_stats.record(gave_up=True)
+                    logging.warning('Escrita abandonada após %d tentativas: %s', attempt + 1, exc)
+                    raise
+                delay = min(self.retry_max_delay, self.retry_base_delay * (2 ** attempt))
+                delay *= 0.5 + random.random()
+                self.lock_stats.record(retried=True, waited=delay)
+                time.sleep(delay)
+
+    def on_transaction_end(self, hook):
+        """Call ``hook(conn, committed)`` after every ``run_write`` commit or rollback."""
+        self._transaction_hooks.append(hook)
+
+    def _transaction_ended(self, conn, committed):
+        for hook in self._transaction_hooks:
+            try:
+                hook(conn, committed)
+            except Exception:
+                logging.exception('Erro em hook de fim de transação')
+
+    def checkpoint(self, mode='PASSIVE'):
+        """Run a WAL checkpoint; returns (busy, wal_frames, checkpointed_frames)."""
+        with self.connection() as conn:
+            busy, log_frames, checkpointed = conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+        self.last_checkpoint = {
+            'mode': mode,
+            'busy': busy,
+            'wal_frames': log_frames,
+            'checkpointed_frames': checkpointed,
+            'at': time.time(),
+        }
+        return self.last_checkpoint
+
+    def close(self):
+        """Close every idle pooled connection.
+
+        A pre-forking server calls this in the master before starting
+        workers: SQLite connections must not be shared across ``fork()``, so
+        each worker opens its own on first use.
+        """
+        self.pool.close_all()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection outside of a request."""
+        conn = self.pool.acquire()
+        try:
+            yield conn
+        finally:
+            self.pool.release(conn)
+
+    def stats(self):
+        return {
+            'pool': self.pool.stats(),
+            'locks': self.lock_stats.snapshot(),
+            'journal_mode': self.journal_mode,
+            'last_checkpoint': self.last_checkpoint,
+        }
+
+    def _teardown(self, exc):
+        conn = g.pop('_db_conn', None)
+        if conn is not None:
+            self.pool.release(conn)
+
+
+def get_db():
+    """Return the connection bound to the current app context."""
+    conn = g.get('_db_conn')
+    if conn is None:
+        conn = current_app.extensions['database'].pool.acquire()
+        g._db_conn = conn
+    return conn
+
+
+def run_write(work):
+    """Run ``work(conn)`` as a retried write transaction on the request connection."""
+    return current_app.extensions['database'].run_write(get_db(), work)
+
+
+@contextmanager
+def read_transaction(conn):
+    """Run the reads in the block against one snapshot of the database.
+
+    A deferred transaction in WAL mode sees the database as of its first read
+    and does not block writers. Nested use joins the open transaction.
+    """
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute('BEGIN')
+    try:
+        yield conn
+    finally:
+        conn.commit()
@@ -0,0 +1,473 @@
+"""Bulk donor import from CSV or JSON Lines files.
+
+A file is read one record at a time (constant memory, whatever its size),
+each record is validated against the ``usuarios`` columns, and accepted rows
+are inserted with ``executemany`` in transactions of ``IMPORT_BATCH_SIZE``
+rows. ``city_stats`` is adjusted once per batch.
+
+Password hashing (scrypt, ~0.1 s per row) dominates the cost, so it runs in
+a process pool of ``IMPORT_HASH_WORKERS`` processes while the previous batch
+is being written. Rows without a ``senha`` get an unusable password and a
+row in ``donor_import_invites`` (written in the same transaction as the
+donor). Nothing secret is stored: ``issue_invites`` creates password reset
+tokens (password_reset.py) for the invited donors who have not set a
+password yet, and the admin hands out the links from
+``POST /api/admin/import_donors/<id>/invites`` (or ``flask import-donors
+--invites``) as soon as they are generated.
+
+Progress lives in ``donor_imports``: every batch commits its rows together
+with the number of records consumed, so an interrupted import resumes from
+the last committed batch without inserting anything twice. Rejected records
+(line number and reason, never the data itself) go to
+``donor_import_rejects``.
+"""
+import csv
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+import city_stats
+import password_reset
+import segmentation
+
+FIELDS = ('nome', 'email', 'telefone', 'tipo_sanguineo', 'data_nascimento', 'genero', 'cep',
+          'endereco', 'ja_doou', 'primeira_vez', 'interesse', 'autoriza_msg', 'autoriza_dados')
+BLOOD_TYPES = {'A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-', 'Não sei meu tipo de sangue'}
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+YES = {'sim', 's', '1', 'true', 'yes', 'on'}
+MAX_LENGTH = 255
+# rejected rows kept per import; the counter keeps counting past it
+STORED_REJECTS = 1000
+
+_EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+INSERT_SQL = '''
+    INSERT INTO usuarios (
+        nome, email, telefone, tipo_sanguineo, data_nascimento, genero,
+        cep, endereco, ja_doou, primeira_vez, interesse,
+        autoriza_msg, autoriza_dados, pontos, senha,
+        data_nascimento_iso, cidade_norm
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?)
+'''
+
+
+class ImportBusy(Exception):
+    """The import is already running (here or in another process)."""
+
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+
+def detect_format(filename):
+    """``'csv'`` or ``'jsonl'`` from the file extension."""
+    ext = os.path.splitext(filename or '')[1].lower()
+    if ext not in FORMATS:
+        raise ValueError('Formato não suportado: use .csv, .jsonl ou .ndjson')
+    return FORMATS[ext]
+
+
+def iter_records(text, fmt):
+    """Yield ``(line, record, error)`` for each record of a text stream.
+
+    ``record`` is a dict (or None when the record could not be parsed, with
+    ``error`` saying why). CSV files may use ``,`` or ``;`` and must have a
+    header row.
+    """
+    if fmt == 'csv':
+        header = text.readline()
+        delimiter = ';' if header.count(';') > header.count(',') else ','
+        names = next(csv.reader([header], delimiter=delimiter), [])
+        reader = csv.DictReader(text, fieldnames=names, delimiter=delimiter)
+        for record in reader:
+            yield reader.line_num + 1, record, None
+    else:
+        for line, raw in enumerate(text, 1):
+            if not raw.strip():
+                continue
+            try:
+                record = json.loads(raw)
+            except ValueError:
+                yield line, None, 'JSON inválido'
+                continue
+            if not isinstance(record, dict):
+                yield line, None, 'registro não é um objeto JSON'
+                continue
+            yield line, record, None
+
+
+def _clean(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        value = 'sim' if value else 'nao'
+    value = str(value).strip()
+    return value or None
+
+
+def validate(record):
+    """Map a raw record to ``usuarios`` values; raises ValueError with the reason.
+
+    Returns ``(values, senha)`` where ``values`` follows ``FIELDS`` and
+    ``senha`` is None when the record has no password.
+    """
+    data = {str(k).strip().lower(): _clean(v) for k, v in record.items() if k is not None}
+    for name in FIELDS + ('senha',):
+        if data.get(name) and len(data[name]) > MAX_LENGTH:
+            raise ValueError(f'{name} muito longo')
+    if not data.get('nome'):
+        raise ValueError('nome ausente')
+    if not data.get('email') or not _EMAIL_RE.match(data['email']):
+        raise ValueError('e-mail inválido')
+    tipo = data.get('tipo_sanguineo')
+    if tipo:
+        if tipo.upper().replace(' ', '') in BLOOD_TYPES:
+            tipo = data['tipo_sanguineo'] = tipo.upper().replace(' ', '')
+        if tipo not in BLOOD_TYPES:
+            raise ValueError('tipo sanguíneo inválido')
+    if data.get('data_nascimento') and segmentation.normalize_birth_date(data['data_nascimento']) is None:
+        raise ValueError('data de nascimento inválida')
+    for name in ('autoriza_msg', 'autoriza_dados'):
+        data[name] = 1 if (data.get(name) or '').lower() in YES else 0
+    return tuple(data.get(name) for name in FIELDS), data.get('senha')
+
+
+def hash_passwords(passwords):
+    """Worker-process entry point: hash a chunk of passwords."""
+    return [generate_password_hash(p) for p in passwords]
+
+
+def _existing_emails(conn, emails):
+    found = set()
+    emails = list(emails)
+    for i in range(0, len(emails), 500):
+        chunk = emails[i:i + 500]
+        marks = ','.join('?' * len(chunk))
+        found.update(r[0] for r in conn.execute(f'SELECT email FROM usuarios WHERE email IN ({marks})', chunk))
+    return found
+
+
+class _Batch:
+    __slots__ = ('items', 'rejects', 'position', 'bytes_read', 'hashes')
+
+    def __init__(self):
+        self.items = []      # (line, values, senha, invite)
+        self.rejects = []    # (line, reason)
+        self.position = 0    # records consumed up to the end of this batch
+        self.bytes_read = 0
+        self.hashes = None
+
+
+class DonorImporter:
+    """Flask extension running bulk imports (CLI or a background thread)."""
+
+    def __init__(self, app=None, database=None):
+        self.database = None
+        self.batch_size = 500
+        self.hash_workers = 1
+        self.directory = 'imports'
+        self.stale_after = 300
+        self._threads = {}
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app, database)
+
+    def init_app(self, app, database):
+        app.config.setdefault('IMPORT_BATCH_SIZE', 500)
+        app.config.setdefault('IMPORT_HASH_WORKERS', os.cpu_count() or 1)
+        app.config.setdefault('IMPORT_DIR', 'imports')
+        app.config.setdefault('IMPORT_STALE_AFTER', 300)
+        self.database = database
+        self.batch_size = max(1, int(app.config['IMPORT_BATCH_SIZE']))
+        self.hash_workers = int(app.config['IMPORT_HASH_WORKERS'])
+        self.directory = app.config['IMPORT_DIR']
+        self.stale_after = float(app.config['IMPORT_STALE_AFTER'])
+        app.extensions['donor_import'] = self
+
+    # -- jobs ----------------------------------------------------------------
+
+    def create(self, conn, source, fmt=None, admin_user_id=None):
+        """Record a new import of the file at ``source``; call inside a write transaction."""
+        fmt = fmt or detect_format(source)
+        now = _now()
+        c = conn.execute('''
+            INSERT INTO donor_imports (source, format, status, bytes_total, admin_user_id, created_at, updated_at)
+            VALUES (?, ?, 'queued', ?, ?, ?, ?)
+        ''', (os.path.abspath(source), fmt, os.path.getsize(source), admin_user_id, now, now))
+        return c.lastrowid
+
+    def status(self, conn, import_id):
+        job = conn.execute('SELECT * FROM donor_imports WHERE id = ?', (import_id,)).fetchone()
+        if job is None:
+            return None
+        rejects = [dict(r) for r in conn.execute('''
+            SELECT line, reason FROM donor_import_rejects WHERE import_id = ? ORDER BY id LIMIT 100
+        ''', (import_id,))]
+        invites = conn.execute('''
+            SELECT COUNT(*) FROM donor_import_invites i JOIN usuarios u ON u.id = i.usuario_id
+            WHERE i.import_id = ? AND u.senha LIKE ?
+        ''', (import_id, password_reset.UNUSABLE_PREFIX + '%')).fetchone()[0]
+        progress = job['bytes_read'] / job['bytes_total'] if job['bytes_total'] else 1.0
+        return {
+            'import_id': job['id'],
+            'status': job['status'],
+            'format': job['format'],
+            'rows_read': job['rows_read'],
+            'inserted': job['inserted'],
+            'rejected': job['rejected'],
+            'invites': invites,
+            'progress': round(min(progress, 1.0), 4),
+            'error': job['error'],
+            'rejects': rejects,
+            'created_at': job['created_at'],
+            'updated_at': job['updated_at'],
+            'finished_at': job['finished_at'],
+        }
+
+    def issue_invites(self, conn, import_id, ttl):
+        """Reset tokens, as ``[(email, token)]``, for the donors of an import who
+        still have no password; call inside a write transaction. Tokens issued
+        before for the same donors stop working."""
+        rows = conn.execute('''
+            SELECT u.id, u.email FROM donor_import_invites i JOIN usuarios u ON u.id = i.usuario_id
+            WHERE i.import_id = ? AND u.senha LIKE ?
+            ORDER BY i.id
+        ''', (import_id, password_reset.UNUSABLE_PREFIX + '%')).fetchall()
+        return [(email, password_reset.issue(conn, user_id, ttl)) for user_id, email in rows]
+
+    def is_running(self, conn, import_id):
+        """True while the import runs in this process, or in another one that
+        refreshed it within ``stale_after`` seconds."""
+        t = self._threads.get(import_id)
+        if t is not None and t.is_alive():
+            return True
+        job = conn.execute('SELECT status, updated_at FROM donor_imports WHERE id = ?', (import_id,)).fetchone()
+        return job is not None and job['status'] == 'running' and job['updated_at'] >= self._cutoff()
+
+    def _cutoff(self):
+        # a running job refreshes updated_at every batch; one that stopped
+        # doing so for stale_after seconds lost its process and may be resumed
+        return (datetime.utcnow() - timedelta(seconds=self.stale_after)).isoformat()
+
+    def start(self, import_id):
+        """Run the import in a background thread of this process."""
+        self._stop.clear()
+        t = threading.Thread(target=self._run_logged, args=(import_id,), name=f'donor-import-{import_id}',
+                             daemon=True)
+        self._threads[import_id] = t
+        t.start()
+        return t
+
+    def stop(self, timeout=30.0):
+        """Ask running imports to stop after their current batch (they can be resumed)."""
+        self._stop.set()
+        for t in list(self._threads.values()):
+            t.join(timeout)
+        self._threads = {}
+
+    def _run_logged(self, import_id):
+        try:
+            self.run(import_id)
+        except ImportBusy:
+            logging.warning('Importação %d já está em andamento', import_id)
+        except Exception:
+            logging.exception('Importação %d falhou', import_id)
+        finally:
+            self._threads.pop(import_id, None)
+
+    # -- import loop ---------------------------------------------------------
+
+    def run(self, import_id, rejects=None, progress=None):
+        """Import (or resume) ``import_id``; returns its final status dict.
+
+        ``rejects(line, reason)`` receives every rejected record and
+        ``progress(status)`` the status after each batch.
+        """
+        job = self._claim(import_id)
+        logging.info('Importação %d iniciada (%s, a partir do registro %d)',
+                     import_id, job['format'], job['rows_read'])
+        try:
+            with open(job['source'], 'rb') as raw, self._pool() as pool:
+                text = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+                pending = None
+                for batch in self._batches(iter_records(text, job['format']), job['rows_read'], raw):
+                    self._submit(pool, batch)
+                    if pending is not None:
+                        self._commit(import_id, pending, rejects, progress)
+                    pending = batch
+                    if self._stop.is_set():
+                        break
+                if pending is not None:
+                    self._commit(import_id, pending, rejects, progress)
+        except Exception as exc:
+            self._finish(import_id, 'failed', str(exc))
+            raise
+        except KeyboardInterrupt:
+            self._finish(import_id, 'interrupted')
+            raise
+        final = 'interrupted' if self._stop.is_set() else 'done'
+        self._finish(import_id, final)
+        if final == 'done' and os.path.dirname(job['source']) == os.path.abspath(self.directory):
+            # an upload saved by the admin endpoint is no longer needed
+            os.remove(job['source'])
+        with self.database.connection() as conn:
+            status = self.status(conn, import_id)
+        logging.info('Importação %d: %s, %d inseridos, %d rejeitados',
+                     import_id, final, status['inserted'], status['rejected'])
+        return status
+
+    def _claim(self, import_id):
+        now = _now()
+        cutoff = self._cutoff()
+
+        def claim(conn):
+            job = conn.execute('SELECT * FROM donor_imports WHERE id = ?', (import_id,)).fetchone()
+            if job is None:
+                raise ValueError(f'Importação {import_id} não encontrada')
+            if job['status'] == 'done':
+                raise ValueError(f'Importação {import_id} já concluída')
+            if job['status'] == 'running' and job['updated_at'] >= cutoff:
+                raise ImportBusy(import_id)
+            conn.execute('''
+                UPDATE donor_imports SET status = 'running', error = NULL, updated_at = ? WHERE id = ?
+            ''', (now, import_id))
+            return job
+
+        with self.database.connection() as conn:
+            return self.database.run_write(conn, claim)
+
+    def _finish(self, import_id, status, error=None):
+        now = _now()
+        with self.database.connection() as conn:
+            self.database.run_write(conn, lambda conn: conn.execute('''
+                UPDATE donor_imports SET status = ?, error = ?, updated_at = ?,
+                    finished_at = CASE WHEN ? = 'done' THEN ? ELSE finished_at END
+                WHERE id = ?
+            ''', (status, error, now, status, now, import_id)))
+
+    def _pool(self):
+        if self.hash_workers <= 0:
+            return _InlinePool()
+        # spawn, not fork: the app process runs threads (log writer, dispatch
+        # workers) that a forked child would inherit in an unknown state. As
+        # with any spawned pool, a script calling run() needs the
+        # ``if __name__ == '__main__'`` guard (flask and gunicorn have it).
+        return ProcessPoolExecutor(self.hash_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _batches(self, records, skip, raw):
+        """Group validated records into batches, skipping ``skip`` already imported."""
+        batch = _Batch()
+        position = 0
+        for line, record, error in records:
+            position += 1
+            if position <= skip:
+                continue
+            if error is None:
+                try:
+                    values, senha = validate(record)
+                except ValueError as exc:
+                    error = str(exc)
+            if error is not None:
+                batch.rejects.append((line, error))
+            else:
+                batch.items.append((line, values, senha, senha is None))
+            if len(batch.items) + len(batch.rejects) >= self.batch_size:
+                batch.position, batch.bytes_read = position, raw.tell()
+                yield self._drop_duplicates(batch)
+                batch = _Batch()
+        if batch.items or batch.rejects:
+            batch.position, batch.bytes_read = position, raw.tell()
+            yield self._drop_duplicates(batch)
+
+    def _drop_duplicates(self, batch):
+        # reject known e-mails before paying for their hashes; _commit checks
+        # again inside the write transaction
+        with self.database.connection() as conn:
+            existing = _existing_emails(conn, (item[1][1] for item in batch.items))
+        items = []
+        for item in batch.items:
+            email = item[1][1]
+            if email in existing:
+                batch.rejects.append((item[0], 'e-mail já cadastrado'))
+            else:
+                existing.add(email)
+                items.append(item)
+        batch.items = items
+        return batch
+
+    def _submit(self, pool, batch):
+        passwords = [item[2] for item in batch.items if not item[3]]
+        step = max(1, -(-len(passwords) // max(1, self.hash_workers)))
+        batch.hashes = [pool.submit(hash_passwords, passwords[i:i + step])
+                        for i in range(0, len(passwords), step)]
+
+    def _commit(self, import_id, batch, rejects, progress):
+        hashes = iter([h for future in batch.hashes for h in future.result()])
+        batch.hashes = None
+
+        def write(conn):
+            existing = _existing_emails(conn, (item[1][1] for item in batch.items))
+            rows, inserted, rejected = [], [], list(batch.rejects)
+            for item in batch.items:
+                line, values, _, invite = item
+                senha_hash = password_reset.unusable_password() if invite else next(hashes)
+                if values[1] in existing:
+                    rejected.append((line, 'e-mail já cadastrado'))
+                    continue
+                rows.append(values + (senha_hash,) + segmentation.normalized_fields(values[4], values[7]))
+                inserted.append(item)
+            conn.executemany(INSERT_SQL, rows)
+            conn.executemany('''
+                INSERT INTO donor_import_invites (import_id, usuario_id) SELECT ?, id FROM usuarios WHERE email = ?
+            ''', ((import_id, values[1]) for _, values, _, invite in inserted if invite))
+            city_stats.add_many(conn, ((values[7], values[6], values[11]) for _, values, _, _ in inserted))
+            stored = conn.execute('SELECT rejected FROM donor_imports WHERE id = ?', (import_id,)).fetchone()[0]
+            room = max(0, STORED_REJECTS - stored)
+            conn.executemany('INSERT INTO donor_import_rejects (import_id, line, reason) VALUES (?, ?, ?)',
+                             ((import_id, line, reason) for line, reason in rejected[:room]))
+            conn.execute('''
+                UPDATE donor_imports SET rows_read = ?, bytes_read = ?, inserted = inserted + ?,
+                    rejected = rejected + ?, updated_at = ?
+                WHERE id = ?
+            ''', (batch.position, batch.bytes_read, len(inserted), len(rejected), _now(), import_id))
+            return inserted, rejected
+
+        with self.database.connection() as conn:
+            inserted, rejected = self.database.run_write(conn, write)
+            status = self.status(conn, import_id) if progress else None
+        if rejects:
+            for line, reason in rejected:
+                rejects(line, reason)
+        if progress:
+            progress(status)
+
+
+class _Future:
+
+    def __init__(self, value):
+        self._value = value
+
+    def result(self):
+        return self._value
+
+
+class _InlinePool:
+    """Hash in the calling thread (``IMPORT_HASH_WORKERS=0``)."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def submit(self, fn, *args):
+        return _Future(fn(*args))
@@ -0,0 +1,153 @@
+"""Buffered writes to ``email_logs`` and delivery statistics queries.
+
+Dispatch workers call ``EmailLogBuffer.add`` once per message. Rows are held
+in memory and written with one ``executemany`` transaction when
+``flush_rows`` accumulate or the oldest row has waited ``flush_interval``
+seconds, so logging does not add a commit per e-mail.
+"""
+import atexit
+import logging
+import threading
+import time
+
+INSERT_SQL = '''
+    INSERT INTO email_logs (campaign_name, recipient_email, status, error, sent_at, admin_user_id, job_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Bucket widths for delivery_stats, as prefixes of the ISO sent_at timestamp.
+BUCKETS = {'hour': 13, 'day': 10, 'month': 7}
+
+
+class EmailLogBuffer:
+
+    def __init__(self, database, flush_rows=200, flush_interval=2.0, max_rows=50000):
+        self.database = database
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self._rows = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.dropped_rows = 0
+
+    def init_app(self, app):
+        app.config.setdefault('EMAIL_LOG_FLUSH_ROWS', 200)
+        app.config.setdefault('EMAIL_LOG_FLUSH_INTERVAL', 2.0)
+        self.flush_rows = int(app.config['EMAIL_LOG_FLUSH_ROWS'])
+        self.flush_interval = float(app.config['EMAIL_LOG_FLUSH_INTERVAL'])
+        app.extensions['email_log'] = self
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='email-log-flusher', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def add(self, campaign_name, recipient_email, status, error, sent_at, admin_user_id=None, job_id=None):
+        with self._lock:
+            if not self._rows:
+                self._oldest = time.monotonic()
+            self._rows.append((campaign_name, recipient_email, status, error, sent_at, admin_user_id, job_id))
+            full = len(self._rows) >= self.flush_rows
+        if full:
+            self.flush()
+
+    def _run(self):
+        while not self._stop.wait(min(self.flush_interval, 1.0)):
+            with self._lock:
+                due = self._rows and time.monotonic() - self._oldest >= self.flush_interval
+            if due:
+                self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows, self._oldest = self._rows, [], None
+            if not rows:
+                return 0
+            try:
+                with self.database.connection() as conn:
+                    self.database.run_write(conn, lambda conn: conn.executemany(INSERT_SQL, rows))
+            except Exception:
+                logging.exception('Falha ao gravar %d registros em email_logs', len(rows))
+                with self._lock:
+                    # keep them for the next attempt, up to max_rows
+                    self._rows = rows + self._rows
+                    overflow = len(self._rows) - self.max_rows
+                    if overflow > 0:
+                        del self._rows[:overflow]
+                        self.dropped_rows += overflow
+                    self._oldest = self._oldest or time.monotonic()
+                return 0
+            self.flushes += 1
+            self.flushed_rows += len(rows)
+            return len(rows)
+
+
+def _window(job_id, since, until):
+    where, params = [], []
+    if job_id is not None:
+        where.append('job_id = ?')
+        params.append(job_id)
+    if since:
+        where.append('sent_at >= ?')
+        params.append(since)
+    if until:
+        where.append('sent_at < ?')
+        params.append(until)
+    return (' WHERE ' + ' AND '.join(where)) if where else '', params
+
+
+# One dispatch job is one campaign send. campaign_name is only the e-mail
+# subject ("<remetente> - Comunicado"), shared by every send from the same
+# sender, so it is just a label; rows logged before job_id existed are still
+# told apart by it.
+_CAMPAIGN_KEY = 'job_id, CASE WHEN job_id IS NULL THEN campaign_name END'
+
+
+def delivery_stats(conn, job_id=None, since=None, until=None, bucket=None, top_errors=10):
+    """Delivery counts per dispatch job (and per time bucket) plus top failure reasons.
+
+    ``since``/``until`` are ISO timestamps; ``bucket`` is one of BUCKETS.
+    """
+    where, params = _window(job_id, since, until)
+    if bucket in BUCKETS:
+        bucket_expr = f'substr(sent_at, 1, {BUCKETS[bucket]})'
+    else:
+        bucket_expr = 'NULL'
+    rows = conn.execute(f'''
+        SELECT job_id, MAX(campaign_name) AS campaign_name, {bucket_expr} AS bucket,
+               COUNT(*) AS total,
+               SUM(status = 'sent') AS sent,
+               SUM(status = 'failed') AS failed,
+               MIN(sent_at) AS first_sent_at,
+               MAX(sent_at) AS last_sent_at
+        FROM email_logs{where}
+        GROUP BY {_CAMPAIGN_KEY}, bucket
+        ORDER BY job_id, campaign_name, bucket
+    ''', params).fetchall()
+
+    failure_where = (where + ' AND ' if where else ' WHERE ') + "status = 'failed'"
+    errors = conn.execute(f'''
+        SELECT job_id, MAX(campaign_name) AS campaign_name, error, COUNT(*) AS count
+        FROM email_logs{failure_where}
+        GROUP BY {_CAMPAIGN_KEY}, error
+        ORDER BY count DESC
+        LIMIT ?
+    ''', params + [top_errors]).fetchall()
+
+    stats = [dict(r) for r in rows]
+    if bucket not in BUCKETS:
+        for s in stats:
+            s.pop('bucket')
+    return {'campaigns': stats, 'failure_reasons': [dict(r) for r in errors]}
@@ -0,0 +1,133 @@
+"""Donor levels and badges (selos), defined once as data.
+
+``usuarios.participation_count`` is a denormalized counter kept in step with
+``participacoes`` by ``apply_participation_delta`` inside the same write
+transaction, so profile pages derive everything here from the user row alone.
+The badge lists depend only on (level tier, first-donation flag), so they are
+built once per combination and shared.
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+Level = namedtuple('Level', 'min_participations nome')
+Badge = namedtuple('Badge', 'nome caminhoImagem min_participations first_donation')
+
+# Ascending by threshold. The first entry is the level for donors with no
+# participations yet.
+LEVELS = (
+    Level(0, 'Não classificado'),
+    Level(1, 'Doador Iniciante'),
+    Level(3, 'Doador Comprometido'),
+    Level(6, 'Doador Heróico'),
+)
+MAX_LEVEL_NAME = 'Nível Máximo'
+
+# Catalogue of emblems, in display order. A badge unlocks when the donor
+# reaches ``min_participations`` or, for ``first_donation`` badges, when the
+# profile says they have donated before. Badges with neither are not
+# awardable yet and always show as locked.
+BADGES = (
+    Badge('Primeira Doação', 'assets/selo-primeira-doacao.png', None, True),
+    Badge('Iniciante', 'assets/emblemas/1.png', 1, False),
+    Badge('Comprometido', 'assets/emblemas/2.png', 3, False),
+    Badge('Heróico', 'assets/emblemas/3.png', 6, False),
+    Badge('Salvador de Vidas', 'assets/emblemas/4.png', None, False),
+    Badge('Tipo O Universal', 'assets/emblemas/5.png', None, False),
+    Badge('Fidelidade', 'assets/emblemas/6.png', None, False),
+)
+
+
+def _tier(participation_count):
+    """Index into LEVELS for ``participation_count``."""
+    tier = 0
+    for i, level in enumerate(LEVELS):
+        if participation_count >= level.min_participations:
+            tier = i
+    return tier
+
+
+def level_for(participation_count):
+    return LEVELS[_tier(participation_count)].nome
+
+
+def has_first_donation(usuario):
+    return usuario.get('ja_doou') == 'sim' or bool(usuario.get('primeira_vez'))
+
+
+@lru_cache(maxsize=None)
+def _badges(tier, first_donation):
+    count = LEVELS[tier].min_participations
+    selos = []
+    all_selos = []
+    for badge in BADGES:
+        unlocked = (
+            (badge.first_donation and first_donation)
+            or (badge.min_participations is not None and count >= badge.min_participations)
+        )
+        entry = {'nome': badge.nome, 'caminhoImagem': badge.caminhoImagem}
+        if unlocked:
+            selos.append(entry)
+        all_selos.append(dict(entry, unlocked=bool(unlocked)))
+    return tuple(selos), tuple(all_selos)
+
+
+# Built at import time: every (tier, flag) combination is known up front.
+for _t in range(len(LEVELS)):
+    _badges(_t, False)
+    _badges(_t, True)
+
+
+def progress(usuario):
+    """Level, progress and badge fields for a ``usuarios`` row (as a dict).
+
+    Returns ``(fields, all_selos)``; ``fields`` is meant to be merged into the
+    template ``usuario`` dict.
+    """
+    count = usuario.get('participation_count') or 0
+    tier = _tier(count)
+    if tier + 1 < len(LEVELS):
+        next_threshold = LEVELS[tier + 1].min_participations
+        next_level_name = LEVELS[tier + 1].nome
+    else:
+        next_threshold = LEVELS[tier].min_participations
+        next_level_name = MAX_LEVEL_NAME
+
+    stored_level = usuario.get('nivel')
+    if not stored_level or not stored_level.strip() or stored_level == 'None':
+        stored_level = LEVELS[tier].nome
+
+    selos, all_selos = _badges(tier, has_first_donation(usuario))
+    fields = {
+        'nivel': stored_level,
+        'participation_count': count,
+        'next_threshold': next_threshold,
+        'next_level_name': next_level_name,
+        'participations_to_next': max(0, next_threshold - count),
+        'progress_text': f"{count}/{next_threshold}",
+        'progressoPercentual': int(min(100, (count / next_threshold) * 100)) if next_threshold else 0,
+        'selos': list(selos),
+    }
+    return fields, list(all_selos)
+
+
+def anonymous_all_selos():
+    return list(_badges(0, False)[1])
+
+
+# New level as a SQL expression of the post-update counter, generated from LEVELS.
+_LEVEL_CASE = 'CASE ' + ' '.join(
+    f"WHEN MAX(0, participation_count + :delta) >= {level.min_participations} THEN '{level.nome}'"
+    for level in reversed(LEVELS)
+) + ' END'
+
+_APPLY_DELTA_SQL = f'''
+    UPDATE usuarios SET
+        participation_count = MAX(0, participation_count + :delta),
+        nivel = {_LEVEL_CASE}
+    WHERE id = :id
+'''
+
+
+def apply_participation_delta(conn, user_id, delta):
+    """Adjust the counter and stored level; call inside the participacoes write."""
+    conn.execute(_APPLY_DELTA_SQL, {'delta': delta, 'id': user_id})
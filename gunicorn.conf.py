@@ -0,0 +1,78 @@
+"""gunicorn settings for wsgi:app, overridable through environment variables.
+
+WEB_CONCURRENCY  worker processes (default: 2 x CPUs + 1, at most 8)
+WEB_THREADS      threads per worker, gthread worker class (default: 4)
+PORT             listen port on all interfaces (default: 5000)
+WEB_TIMEOUT      seconds before a silent worker is killed (default: 60)
+GRACEFUL_TIMEOUT seconds a worker gets to finish requests on shutdown (default: 30)
+MAX_REQUESTS     recycle a worker after this many requests, 0 = never (default: 0)
+SSE_MAX_CLIENTS  open /api/campaigns/stream connections per worker; each holds
+                 a thread (default: half of WEB_THREADS)
+
+Live campaign lists are capped at WEB_CONCURRENCY x SSE_MAX_CLIENTS pages at
+once: with the defaults that is 2 per worker, e.g. 16 on a 4-CPU host. Every
+open stream occupies a request thread for up to SSE_MAX_DURATION seconds, so
+this worker class cannot serve them any cheaper. Pages over the cap get a 503
+on the stream and fall back to reloading the list after each action. For more
+live pages, raise WEB_THREADS (SSE_MAX_CLIENTS follows at half) or set
+SSE_MAX_CLIENTS directly, leaving threads free for ordinary requests.
+
+The app is created once in the master (``preload_app``): migrations run
+there before the first fork and the workers share the loaded code. The master never serves
+requests, so it closes its pooled SQLite connections before forking and each
+worker starts its own dispatch and email_logs threads. On SIGTERM a worker
+stops accepting, finishes in-flight requests, stops the dispatch pool and
+flushes the buffered email_logs rows before exiting; open campaign streams are
+ended as soon as the signal arrives so they do not hold up the shutdown.
+"""
+import multiprocessing
+import os
+import signal
+
+# read by app.py at import: background threads must not start in the master
+os.environ['BACKGROUND_WORKERS_AUTOSTART'] = 'False'
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+threads = int(os.getenv('WEB_THREADS', 4))
+# keep threads free for ordinary requests; this is the per-worker cap on live
+# campaign lists (see the module docstring)
+os.environ.setdefault('SSE_MAX_CLIENTS', str(max(1, threads // 2)))
+worker_class = 'gthread'
+preload_app = True
+timeout = int(os.getenv('WEB_TIMEOUT', 60))
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('WEB_KEEPALIVE', 5))
+max_requests = int(os.getenv('MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+accesslog = os.getenv('WEB_ACCESS_LOG') or None
+errorlog = '-'
+
+
+def when_ready(server):
+    # runs in the master after the preload, before the first fork
+    import app
+    if server.app.wsgi().config['AUTO_MIGRATE']:
+        app.ensure_schema()
+    app.db.close()
+
+
+def post_fork(server, worker):
+    import app
+    app.start_background_workers()
+
+
+def post_worker_init(worker):
+    import app
+    handle_exit = worker.handle_exit
+
+    def end_streams(sig, frame):
+        app.broadcaster.stop()
+        handle_exit(sig, frame)
+    signal.signal(signal.SIGTERM, end_streams)
+
+
+def worker_exit(server, worker):
+    import app
+    app.stop_background_workers()
+    app.db.close()
@@ -0,0 +1,256 @@
+"""SQLite-backed queue for campaign e-mail dispatch.
+
+``/api/admin/send_campaign`` stores one ``dispatch_jobs`` row plus one
+``dispatch_recipients`` row per target and returns at once. A pool of worker
+threads claims recipients in batches, sends them and records the outcome on
+each row. Because all state lives in the database, work left ``queued`` or
+stuck in ``sending`` by a process that died is picked up again: rows whose
+claim is older than ``DISPATCH_STALE_AFTER`` go back to the queue at start
+and every half of that period while the workers run (delivery is
+at-least-once for rows that were mid-send).
+
+Each worker thread keeps one SMTP session (see mailer.py) open while there is
+work and closes it when the queue drains. Per-message outcomes also go to
+``email_logs`` through the buffered writer in email_log.py.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+
+class DispatchQueue:
+    """Flask extension running the dispatch worker pool."""
+
+    def __init__(self, app=None, database=None, send=None, open_session=None, email_log=None):
+        self.app = None
+        self.database = database
+        self.send = send
+        self.open_session = open_session
+        self.email_log = email_log
+        self.workers = 2
+        self.batch_size = 50
+        self.poll_interval = 1.0
+        self.stale_after = 300
+        self._threads = []
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._requeue_lock = threading.Lock()
+        self._next_requeue = 0.0
+        if app is not None:
+            self.init_app(app, database, send, open_session, email_log)
+
+    def init_app(self, app, database, send, open_session=None, email_log=None):
+        app.config.setdefault('DISPATCH_WORKERS', 2)
+        app.config.setdefault('DISPATCH_BATCH_SIZE', 50)
+        app.config.setdefault('DISPATCH_POLL_INTERVAL', 1.0)
+        app.config.setdefault('DISPATCH_STALE_AFTER', 300)
+        self.app = app
+        self.database = database
+        self.send = send
+        if open_session is not None:
+            self.open_session = open_session
+        if email_log is not None:
+            self.email_log = email_log
+        self.workers = int(app.config['DISPATCH_WORKERS'])
+        self.batch_size = int(app.config['DISPATCH_BATCH_SIZE'])
+        self.poll_interval = float(app.config['DISPATCH_POLL_INTERVAL'])
+        self.stale_after = float(app.config['DISPATCH_STALE_AFTER'])
+        app.extensions['dispatch'] = self
+
+    # -- producer side ---------------------------------------------------
+
+    def enqueue(self, conn, recipients, subject, body, admin_user_id=None, payload=None):
+        """Insert a job and its recipients; call inside a write transaction.
+
+        ``recipients`` is an iterable of dicts with ``id``, ``email`` and ``nome``.
+        Returns ``(job_id, recipients_count)``.
+        """
+        created_at = _now()
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO dispatch_jobs (status, subject, body, payload, admin_user_id, created_at)
+            VALUES ('queued', ?, ?, ?, ?, ?)
+        ''', (subject, body, json.dumps(payload or {}), admin_user_id, created_at))
+        job_id = c.lastrowid
+        c.executemany('''
+            INSERT INTO dispatch_recipients (job_id, usuario_id, email, nome, status, updated_at)
+            VALUES (?, ?, ?, ?, 'queued', ?)
+        ''', ((job_id, r.get('id'), r['email'], r.get('nome'), created_at) for r in recipients))
+        total = conn.execute('SELECT COUNT(*) FROM dispatch_recipients WHERE job_id = ?', (job_id,)).fetchone()[0]
+        if total:
+            c.execute('UPDATE dispatch_jobs SET total = ? WHERE id = ?', (total, job_id))
+        else:
+            c.execute("UPDATE dispatch_jobs SET status = 'done', finished_at = ? WHERE id = ?", (created_at, job_id))
+        return job_id, total
+
+    def notify(self):
+        """Wake idle workers after a commit that enqueued work."""
+        self._wake.set()
+
+    def status(self, conn, job_id):
+        job = conn.execute('SELECT * FROM dispatch_jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None:
+            return None
+        counts = {'queued': 0, 'sending': 0, 'sent': 0, 'failed': 0}
+        for row in conn.execute('''
+            SELECT status, COUNT(*) AS n FROM dispatch_recipients WHERE job_id = ? GROUP BY status
+        ''', (job_id,)):
+            counts[row['status']] = row['n']
+        errors = [dict(r) for r in conn.execute('''
+            SELECT email, error FROM dispatch_recipients
+            WHERE job_id = ? AND status = 'failed' ORDER BY id LIMIT 50
+        ''', (job_id,))]
+        return {
+            'job_id': job['id'],
+            'status': job['status'],
+            'total': job['total'],
+            'queued': counts['queued'] + counts['sending'],
+            'sent': counts['sent'],
+            'failed': counts['failed'],
+            'errors': errors,
+            'created_at': job['created_at'],
+            'started_at': job['started_at'],
+            'finished_at': job['finished_at'],
+        }
+
+    # -- worker side -----------------------------------------------------
+
+    def start(self):
+        if self._threads or self.workers <= 0:
+            return
+        self._stop.clear()
+        self.requeue_stale()
+        self._next_requeue = time.monotonic() + self.stale_after / 2
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f'dispatch-worker-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def requeue_stale(self):
+        """Return rows stuck in ``sending`` (their worker died) to the queue."""
+        cutoff = (datetime.utcnow() - timedelta(seconds=self.stale_after)).isoformat()
+        with self.database.connection() as conn:
+            n = self.database.run_write(conn, lambda conn: conn.execute('''
+                UPDATE dispatch_recipients SET status = 'queued', claimed_by = NULL
+                WHERE status = 'sending' AND claimed_at < ?
+            ''', (cutoff,)).rowcount)
+        if n:
+            logging.warning('%d destinatários reenfileirados após falha de worker', n)
+        return n
+
+    def _requeue_if_due(self):
+        # a worker that died after this process started (or in another one,
+        # restarted sooner than stale_after) leaves its rows in 'sending';
+        # whichever worker gets here first requeues them every stale_after/2
+        now = time.monotonic()
+        with self._requeue_lock:
+            if now < self._next_requeue:
+                return
+            self._next_requeue = now + self.stale_after / 2
+        self.requeue_stale()
+
+    def _run(self):
+        session = None
+        while not self._stop.is_set():
+            if session is None and self.open_session is not None:
+                session = self.open_session()
+            try:
+                self._requeue_if_due()
+                worked = self.run_once(session)
+            except Exception:
+                logging.exception('Erro no worker de disparo')
+                worked = False
+            if not worked:
+                # queue drained: don't hold an idle SMTP connection open
+                if session is not None:
+                    session.close()
+                    session = None
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+        if session is not None:
+            session.close()
+
+    def run_once(self, session=None):
+        """Claim and send one batch; returns False when the queue was empty."""
+        token = uuid.uuid4().hex
+        with self.database.connection() as conn:
+            batch = self.database.run_write(conn, lambda conn: self._claim(conn, token))
+        if not batch:
+            return False
+
+        results = []
+        with self.app.app_context():
+            for row in batch:
+                body = (row['body'] or '').replace('[nome_doador]', row['nome'] or '')
+                try:
+                    if session is None:
+                        resultado = self.send(row['email'], row['subject'], body)
+                    else:
+                        resultado = self.send(row['email'], row['subject'], body, session=session)
+                    ok = resultado.get('status') == 'sucesso'
+                    error = None if ok else resultado.get('mensagem')
+                except Exception as e:
+                    ok, error = False, str(e)
+                status, sent_at = ('sent' if ok else 'failed'), _now()
+                results.append((status, error, sent_at, row['id']))
+                if self.email_log is not None:
+                    self.email_log.add(row['subject'], row['email'], status, error, sent_at,
+                                       row['admin_user_id'], row['job_id'])
+
+        job_ids = sorted(set(row['job_id'] for row in batch))
+        with self.database.connection() as conn:
+            self.database.run_write(conn, lambda conn: self._record(conn, results, job_ids))
+        return True
+
+    def _claim(self, conn, token):
+        now = _now()
+        conn.execute('''
+            UPDATE dispatch_recipients SET status = 'sending', claimed_by = ?, claimed_at = ?,
+                attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM dispatch_recipients WHERE status = 'queued' ORDER BY id LIMIT ?
+            )
+        ''', (token, now, self.batch_size))
+        batch = conn.execute('''
+            SELECT r.id, r.job_id, r.email, r.nome, j.subject, j.body, j.admin_user_id
+            FROM dispatch_recipients r JOIN dispatch_jobs j ON j.id = r.job_id
+            WHERE r.claimed_by = ? AND r.status = 'sending'
+        ''', (token,)).fetchall()
+        if batch:
+            job_ids = sorted(set(row['job_id'] for row in batch))
+            conn.execute(f'''
+                UPDATE dispatch_jobs SET status = 'running', started_at = COALESCE(started_at, ?)
+                WHERE status = 'queued' AND id IN ({','.join('?' for _ in job_ids)})
+            ''', (now, *job_ids))
+        return batch
+
+    def _record(self, conn, results, job_ids):
+        conn.executemany('''
+            UPDATE dispatch_recipients SET status = ?, error = ?, updated_at = ?, claimed_by = NULL
+            WHERE id = ?
+        ''', results)
+        now = _now()
+        for job_id in job_ids:
+            pending = conn.execute('''
+                SELECT 1 FROM dispatch_recipients
+                WHERE job_id = ? AND status IN ('queued', 'sending') LIMIT 1
+            ''', (job_id,)).fetchone()
+            if not pending:
+                conn.execute('''
+                    UPDATE dispatch_jobs SET status = 'done', finished_at = ?
+                    WHERE id = ? AND status != 'done'
+                ''', (now, job_id))
@@ -0,0 +1,76 @@
+"""Reusable SMTP connection for bulk sends.
+
+``mail.send(msg)`` opens a connection, negotiates TLS and logs in for every
+message. ``SMTPSession`` keeps one Flask-Mail ``Connection`` open across many
+messages, reconnects when the server drops it, and rotates it after
+``rotate_after`` messages so long campaigns don't hit per-connection limits.
+The connection is only opened on the first ``send``.
+"""
+import logging
+import smtplib
+
+# Errors that mean the connection itself is unusable; anything else (e.g. a
+# refused recipient) is about the message and is raised to the caller as is.
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError)
+
+
+class SMTPSession:
+
+    def __init__(self, mail, rotate_after=100, retries=1):
+        self.mail = mail
+        self.rotate_after = rotate_after
+        self.retries = retries
+        self._conn = None
+        self._sent_on_conn = 0
+        self.connections_opened = 0
+        self.messages_sent = 0
+        self.reconnects = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _open(self):
+        conn = self.mail.connect()
+        conn.__enter__()
+        self._conn = conn
+        self._sent_on_conn = 0
+        self.connections_opened += 1
+
+    def _drop(self):
+        # the socket is already broken; don't try to QUIT politely
+        if self._conn is not None and self._conn.host is not None:
+            try:
+                self._conn.host.close()
+            except Exception:
+                pass
+        self._conn = None
+
+    def close(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.__exit__(None, None, None)
+        except Exception:
+            self._drop()
+        self._conn = None
+
+    def send(self, msg):
+        for attempt in range(self.retries + 1):
+            try:
+                if self._conn is None:
+                    self._open()
+                self._conn.send(msg)
+                break
+            except CONNECTION_ERRORS as e:
+                self._drop()
+                if attempt == self.retries:
+                    raise
+                self.reconnects += 1
+                logging.warning('Conexão SMTP perdida (%s); reconectando', e)
+        self.messages_sent += 1
+        self._sent_on_conn += 1
+        if self.rotate_after and self._sent_on_conn >= self.rotate_after:
+            self.close()
@@ -0,0 +1,309 @@
+"""Request, SQL and e-mail instrumentation exported in Prometheus text format.
+
+``Metrics.init_app(app, database)`` adds request hooks and swaps the pool's
+connection class for ``InstrumentedConnection``, whose ``execute`` and
+``executemany`` (and those of its cursors) are timed. It records:
+
+- per-endpoint latency, response size and SQL statement count/time
+  histograms, and a request counter by status;
+- every SQL statement (also from background threads) and the time callers
+  blocked waiting for a pooled connection;
+- ``enviar_email`` outcomes and latency, through the ``track_email``
+  decorator;
+- point-in-time gauges registered with ``gauge()`` (pool, caches, queues).
+
+``render()`` produces the text served by ``/metrics``. With
+``METRICS_SLOW_REQUEST_MS`` set, requests slower than that are logged with
+the SQL statements they ran (statements only, never parameters).
+
+Values are kept per process: under gunicorn each scrape is answered by one
+worker.
+"""
+import bisect
+import logging
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import request
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+SLOW_LOG_STATEMENTS = 50
+
+# per-thread stats of the request being served (None outside requests)
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            yield self.name + _labels(self.label_names, labels), value
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = sorted((labels, (list(e[0]), e[1], e[2])) for labels, e in self._values.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                yield self.name + '_bucket' + _labels(self.label_names, labels, f'le="{_number(bound)}"'), cumulative
+            yield self.name + '_sum' + _labels(self.label_names, labels), round(total, 6)
+            yield self.name + '_count' + _labels(self.label_names, labels), count
+
+
+class Gauge:
+    """Read at scrape time from ``fn()``: a number or a {label value: number} dict."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn, label=None):
+        self.name, self.help, self.fn, self.label = name, help, fn, label
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, dict):
+            for key, v in sorted(value.items()):
+                if isinstance(v, (int, float)):
+                    yield self.name + _labels((self.label,), (key,)), v
+        elif value is not None:
+            yield self.name, value
+
+
+class RequestStats:
+    __slots__ = ('started', 'sql_count', 'sql_seconds', 'statements', 'status', 'size')
+
+    def __init__(self, keep_statements):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.statements = [] if keep_statements else None
+        self.status = 500
+        self.size = None
+
+
+class _Timed:
+    """Shared ``execute``/``executemany`` timing for connections and cursors."""
+
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            _record_sql(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            _record_sql(sql, time.perf_counter() - start)
+
+
+class InstrumentedCursor(_Timed, sqlite3.Cursor):
+    pass
+
+
+class InstrumentedConnection(_Timed, sqlite3.Connection):
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+
+# the instance InstrumentedConnection reports to (one app per process)
+_active = None
+
+
+def _record_sql(sql, seconds):
+    metrics = _active
+    if metrics is None:
+        return
+    metrics.sql_seconds.observe(seconds)
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.sql_count += 1
+        stats.sql_seconds += seconds
+        if stats.statements is not None and len(stats.statements) < SLOW_LOG_STATEMENTS:
+            stats.statements.append((' '.join(sql.split())[:200], round(seconds * 1000, 3)))
+
+
+class Metrics:
+    """Flask extension collecting the metrics and rendering ``/metrics``."""
+
+    def __init__(self, app=None, database=None):
+        self.enabled = True
+        self.token = None
+        self.slow_request_ms = None
+        self._collectors = []
+        self.requests = self._add(Counter(
+            'http_requests_total', 'Requests served.', ('endpoint', 'method', 'status')))
+        self.latency = self._add(Histogram(
+            'http_request_duration_seconds', 'Request latency.', ('endpoint', 'method')))
+        self.response_size = self._add(Histogram(
+            'http_response_size_bytes', 'Response body size.', ('endpoint',), SIZE_BUCKETS))
+        self.request_sql_count = self._add(Histogram(
+            'http_request_sql_statements', 'SQL statements run per request.', ('endpoint',), COUNT_BUCKETS))
+        self.request_sql_seconds = self._add(Histogram(
+            'http_request_sql_duration_seconds', 'Time spent in SQL per request.', ('endpoint',)))
+        self.sql_seconds = self._add(Histogram(
+            'sql_statement_duration_seconds', 'Duration of every SQL statement, background work included.'))
+        self.pool_wait = self._add(Histogram(
+            'db_pool_wait_seconds', 'Time spent waiting for a pooled connection.'))
+        self.emails = self._add(Counter(
+            'emails_sent_total', 'enviar_email calls by outcome.', ('status',)))
+        self.email_latency = self._add(Histogram(
+            'email_send_duration_seconds', 'enviar_email latency.', ('status',)))
+        if app is not None:
+            self.init_app(app, database)
+
+    def _add(self, collector):
+        self._collectors.append(collector)
+        return collector
+
+    def init_app(self, app, database):
+        global _active
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('METRICS_SLOW_REQUEST_MS', None)
+        self.enabled = bool(app.config['METRICS_ENABLED'])
+        self.token = app.config['METRICS_TOKEN']
+        slow = app.config['METRICS_SLOW_REQUEST_MS']
+        self.slow_request_ms = float(slow) if slow else None
+        app.extensions['metrics'] = self
+        if not self.enabled:
+            return
+        _active = self
+        # connections opened from now on are timed; drop untimed idle ones
+        database.pool.factory = InstrumentedConnection
+        database.pool.close_all()
+        database.pool.observer = self.pool_wait.observe
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def gauge(self, name, help, fn, label=None):
+        """Export ``fn()`` as a gauge, read at scrape time."""
+        self._add(Gauge(name, help, fn, label))
+
+    def authorized(self, req):
+        """True when ``req`` carries the configured ``METRICS_TOKEN``."""
+        return bool(self.token) and req.headers.get('Authorization') == f'Bearer {self.token}'
+
+    # -- request hooks ---------------------------------------------------
+
+    def _before_request(self):
+        _local.stats = RequestStats(keep_statements=self.slow_request_ms is not None)
+
+    def _after_request(self, response):
+        stats = getattr(_local, 'stats', None)
+        if stats is not None:
+            stats.status = response.status_code
+            # calculate_content_length() would buffer a streamed body
+            stats.size = None if response.is_streamed else response.calculate_content_length()
+        return response
+
+    def _teardown_request(self, exc):
+        stats = getattr(_local, 'stats', None)
+        _local.stats = None
+        if stats is None:
+            return
+        elapsed = time.perf_counter() - stats.started
+        endpoint = request.endpoint or 'unmatched'
+        self.requests.inc(endpoint, request.method, str(stats.status))
+        self.latency.observe(elapsed, endpoint, request.method)
+        if stats.size is not None:
+            self.response_size.observe(stats.size, endpoint)
+        self.request_sql_count.observe(stats.sql_count, endpoint)
+        self.request_sql_seconds.observe(stats.sql_seconds, endpoint)
+        if self.slow_request_ms is not None and elapsed * 1000 >= self.slow_request_ms:
+            logging.getLogger('slow_request').warning(
+                'Requisição lenta: %s %s %.1f ms, %d comandos SQL (%.1f ms)',
+                request.method, request.path, elapsed * 1000, stats.sql_count, stats.sql_seconds * 1000,
+                extra={'duration_ms': round(elapsed * 1000, 2), 'sql_count': stats.sql_count,
+                       'sql_ms': round(stats.sql_seconds * 1000, 2), 'statements': stats.statements})
+
+    # -- e-mail ------------------------------------------------------------
+
+    def track_email(self, send):
+        """Decorator for ``enviar_email``-style functions returning ``{'status': ...}``."""
+        @wraps(send)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            status = 'erro'
+            try:
+                result = send(*args, **kwargs)
+                status = result.get('status', 'erro') if isinstance(result, dict) else 'erro'
+                return result
+            finally:
+                self.emails.inc(status)
+                self.email_latency.observe(time.perf_counter() - start, status)
+        return wrapper
+
+    # -- export ------------------------------------------------------------
+
+    def render(self):
+        lines = []
+        for collector in self._collectors:
+            try:
+                samples = list(collector.samples())
+            except Exception:
+                logging.exception('Falha ao coletar a métrica %s', collector.name)
+                continue
+            lines.append(f'# HELP {collector.name} {collector.help}')
+            lines.append(f'# TYPE {collector.name} {collector.kind}')
+            lines.extend(f'{name} {_number(value)}' for name, value in samples)
+        return '\n'.join(lines) + '\n'
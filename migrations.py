@@ -0,0 +1,418 @@
+"""Versioned schema migrations for database.db.
+
+The applied version is kept in ``PRAGMA user_version``, so a database that is
+already up to date costs a single PRAGMA read at startup. Each migration runs
+in its own IMMEDIATE transaction and re-checks the version after taking the
+write lock, which keeps concurrent workers from applying the same step twice.
+
+Migrations do not call into the live application modules: the SQL and
+normalization a step needs are copied here as they were when it shipped, so
+a later change to segmentation.py or city_stats.py cannot alter what an old
+migration does on a fresh database.
+"""
+import logging
+import unicodedata
+from datetime import date, datetime
+
+
+def _baseline(conn):
+    # Tables as originally created by init_db / init_campaigns_table /
+    # init_participations_table, plus the columns later added with ALTER.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT,
+            email TEXT,
+            telefone TEXT,
+            tipo_sanguineo TEXT,
+            data_nascimento TEXT,
+            genero TEXT,
+            cep TEXT,
+            endereco TEXT,
+            ja_doou TEXT,
+            primeira_vez TEXT,
+            interesse TEXT,
+            autoriza_msg INTEGER,
+            autoriza_dados INTEGER,
+            pontos INTEGER DEFAULT 0,
+            senha TEXT
+        )
+    ''')
+    columns = [col[1] for col in conn.execute('PRAGMA table_info(usuarios)')]
+    if 'senha' not in columns:
+        conn.execute('ALTER TABLE usuarios ADD COLUMN senha TEXT')
+    if 'nivel' not in columns:
+        conn.execute("ALTER TABLE usuarios ADD COLUMN nivel TEXT DEFAULT 'Doador Iniciante'")
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS email_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_name TEXT,
+            recipient_email TEXT,
+            status TEXT,
+            error TEXT,
+            sent_at TEXT,
+            admin_user_id INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS campanhas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT NOT NULL,
+            tipo_sanguineo TEXT,
+            vagas INTEGER DEFAULT 0,
+            participantes INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'Ativa',
+            created_at TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS participacoes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER NOT NULL,
+            campanha_id INTEGER NOT NULL,
+            joined_at TEXT,
+            UNIQUE(usuario_id, campanha_id)
+        )
+    ''')
+
+
+def _secondary_indexes(conn):
+    duplicated = conn.execute('''
+        SELECT email FROM usuarios
+        WHERE email IS NOT NULL
+        GROUP BY email HAVING COUNT(*) > 1
+    ''').fetchall()
+    if duplicated:
+        # Existing duplicates must be resolved by hand; index without the
+        # constraint so lookups are still fast in the meantime.
+        logging.warning('Emails duplicados em usuarios (%d); índice criado sem UNIQUE', len(duplicated))
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_usuarios_email ON usuarios(email)')
+    else:
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS ux_usuarios_email ON usuarios(email)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_campanhas_status_created ON campanhas(status, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_participacoes_usuario_joined ON participacoes(usuario_id, joined_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_participacoes_campanha ON participacoes(campanha_id)')
+    conn.execute('ANALYZE')
+
+
+def _participation_counter(conn):
+    columns = [col[1] for col in conn.execute('PRAGMA table_info(usuarios)')]
+    if 'participation_count' not in columns:
+        conn.execute('ALTER TABLE usuarios ADD COLUMN participation_count INTEGER NOT NULL DEFAULT 0')
+    conn.execute('''
+        UPDATE usuarios SET participation_count = (
+            SELECT COUNT(*) FROM participacoes p WHERE p.usuario_id = usuarios.id
+        )
+    ''')
+
+
+def _dispatch_queue(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS dispatch_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            subject TEXT,
+            body TEXT,
+            payload TEXT,
+            admin_user_id INTEGER,
+            total INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT,
+            started_at TEXT,
+            finished_at TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS dispatch_recipients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER NOT NULL,
+            usuario_id INTEGER,
+            email TEXT NOT NULL,
+            nome TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            claimed_by TEXT,
+            claimed_at TEXT,
+            updated_at TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_dispatch_recipients_status ON dispatch_recipients(status, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_dispatch_recipients_job ON dispatch_recipients(job_id, status)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_dispatch_recipients_claim ON dispatch_recipients(claimed_by)')
+
+
+def _email_log_indexes(conn):
+    columns = [col[1] for col in conn.execute('PRAGMA table_info(email_logs)')]
+    if 'job_id' not in columns:
+        conn.execute('ALTER TABLE email_logs ADD COLUMN job_id INTEGER')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_email_logs_campaign_sent ON email_logs(campaign_name, sent_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_email_logs_sent ON email_logs(sent_at)')
+
+
+def _v6_birth_date(value):
+    # segmentation.normalize_birth_date as of migration 6
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        if '-' in value:
+            return datetime.fromisoformat(value).date().isoformat()
+        if '/' in value:
+            day, month, year = value.split('/')
+            return date(int(year), int(month), int(day)).isoformat()
+    except ValueError:
+        return None
+    return None
+
+
+def _v6_city(endereco):
+    # segmentation.normalize_city as of migration 6
+    if not endereco or not endereco.strip():
+        return None
+    city = endereco
+    if ' - ' in city:
+        city = city.rsplit(' - ', 1)[1]
+    elif ',' in city:
+        city = city.rsplit(',', 1)[1]
+    city = city.split('/', 1)[0]
+    decomposed = unicodedata.normalize('NFKD', city)
+    city = ''.join(ch for ch in decomposed if not unicodedata.combining(ch)).strip().lower()
+    return city or None
+
+
+def _segmentation_columns(conn):
+    columns = [col[1] for col in conn.execute('PRAGMA table_info(usuarios)')]
+    if 'data_nascimento_iso' not in columns:
+        conn.execute('ALTER TABLE usuarios ADD COLUMN data_nascimento_iso TEXT')
+    if 'cidade_norm' not in columns:
+        conn.execute('ALTER TABLE usuarios ADD COLUMN cidade_norm TEXT')
+    last_id = 0
+    while True:
+        rows = conn.execute('''
+            SELECT id, data_nascimento, endereco FROM usuarios WHERE id > ? ORDER BY id LIMIT 1000
+        ''', (last_id,)).fetchall()
+        if not rows:
+            break
+        conn.executemany('''
+            UPDATE usuarios SET data_nascimento_iso = ?, cidade_norm = ? WHERE id = ?
+        ''', [(_v6_birth_date(r['data_nascimento']), _v6_city(r['endereco']), r['id']) for r in rows])
+        last_id = rows[-1]['id']
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_usuarios_cidade_nasc ON usuarios(cidade_norm, data_nascimento_iso)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_usuarios_nasc ON usuarios(data_nascimento_iso)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_usuarios_tipo ON usuarios(tipo_sanguineo)')
+
+
+def _v7_city_label(endereco, cep):
+    # city_stats.city_label as of migration 7
+    endereco = endereco or ''
+    if ',' in endereco:
+        return endereco.split(',')[-1].strip()
+    if endereco.strip():
+        return endereco.strip()
+    if cep:
+        return f'CEP {cep}'
+    return 'Desconhecido'
+
+
+def _v7_city_distance(city):
+    # city_stats.distance_for as of migration 7
+    return (sum(ord(ch) for ch in city) % 30) + 1
+
+
+def _city_stats(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS city_stats (
+            city TEXT PRIMARY KEY,
+            potential INTEGER NOT NULL DEFAULT 0,
+            consent INTEGER NOT NULL DEFAULT 0,
+            distance INTEGER NOT NULL
+        )
+    ''')
+    conn.create_function('v7_city_label', 2, _v7_city_label, deterministic=True)
+    conn.create_function('v7_city_distance', 1, _v7_city_distance, deterministic=True)
+    conn.execute('DELETE FROM city_stats')
+    conn.execute('''
+        INSERT INTO city_stats (city, potential, consent, distance)
+        SELECT city, COUNT(*), SUM(consent), v7_city_distance(city)
+        FROM (
+            SELECT v7_city_label(endereco, cep) AS city,
+                   CASE WHEN autoriza_msg = 1 THEN 1 ELSE 0 END AS consent
+            FROM usuarios
+        )
+        GROUP BY city
+    ''')
+    conn.execute('''
+        INSERT INTO table_versions (name, version) VALUES ('city_stats', 1)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1
+    ''')
+
+
+def _waitlist(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS lista_espera (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER NOT NULL,
+            campanha_id INTEGER NOT NULL,
+            joined_at TEXT,
+            UNIQUE(usuario_id, campanha_id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_lista_espera_campanha ON lista_espera(campanha_id, id)')
+    # participantes was maintained by separate, unguarded updates; start the
+    # seat counter from the real number of participations
+    conn.execute('''
+        UPDATE campanhas SET participantes = (
+            SELECT COUNT(*) FROM participacoes p WHERE p.campanha_id = campanhas.id
+        )
+    ''')
+
+
+
+def _pagination_keys(conn):
+    # keyset cursors compare (timestamp, id); a NULL timestamp would make a
+    # row unreachable, so give legacy rows the epoch instead
+    conn.execute("UPDATE campanhas SET created_at = '1970-01-01T00:00:00' WHERE created_at IS NULL")
+    conn.execute("UPDATE participacoes SET joined_at = '1970-01-01T00:00:00' WHERE joined_at IS NULL")
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_campanhas_created ON campanhas(created_at)')
+
+
+def _donor_imports(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS donor_imports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT NOT NULL,
+            format TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            rows_read INTEGER NOT NULL DEFAULT 0,
+            inserted INTEGER NOT NULL DEFAULT 0,
+            rejected INTEGER NOT NULL DEFAULT 0,
+            bytes_read INTEGER NOT NULL DEFAULT 0,
+            bytes_total INTEGER,
+            error TEXT,
+            admin_user_id INTEGER,
+            created_at TEXT,
+            updated_at TEXT,
+            finished_at TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS donor_import_rejects (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            import_id INTEGER NOT NULL,
+            line INTEGER,
+            reason TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_donor_import_rejects_import ON donor_import_rejects(import_id, id)')
+
+
+def _email_log_job_index(conn):
+    # delivery_stats groups and filters by dispatch job
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_email_logs_job_sent ON email_logs(job_id, sent_at)')
+
+
+def _donor_import_invites(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS donor_import_invites (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            import_id INTEGER NOT NULL,
+            email TEXT NOT NULL,
+            token TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_donor_import_invites_import ON donor_import_invites(import_id, id)')
+
+
+def _admins_and_reset_tokens(conn):
+    columns = [col[1] for col in conn.execute('PRAGMA table_info(usuarios)')]
+    if 'is_admin' not in columns:
+        conn.execute('ALTER TABLE usuarios ADD COLUMN is_admin INTEGER NOT NULL DEFAULT 0')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS password_reset_tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER NOT NULL,
+            token_hash TEXT NOT NULL UNIQUE,
+            created_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL,
+            used_at TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_password_reset_tokens_usuario ON password_reset_tokens(usuario_id)')
+    # donor_import_invites held the plaintext initial passwords of imported
+    # donors. Those passwords were readable, so they are replaced with
+    # unusable ones (the donors get reset links instead), and the table
+    # keeps only who was invited.
+    conn.execute('''
+        UPDATE usuarios SET senha = '!' || lower(hex(randomblob(16)))
+        WHERE email IN (SELECT email FROM donor_import_invites)
+    ''')
+    conn.execute('''
+        CREATE TABLE donor_import_invites_v13 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            import_id INTEGER NOT NULL,
+            usuario_id INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO donor_import_invites_v13 (id, import_id, usuario_id)
+        SELECT i.id, i.import_id, u.id FROM donor_import_invites i JOIN usuarios u ON u.email = i.email
+    ''')
+    conn.execute('DROP TABLE donor_import_invites')
+    conn.execute('ALTER TABLE donor_import_invites_v13 RENAME TO donor_import_invites')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_donor_import_invites_import ON donor_import_invites(import_id, id)')
+
+
+# (version, description, apply). Append only; never renumber or edit a
+# migration that has shipped.
+MIGRATIONS = [
+    (1, 'baseline schema', _baseline),
+    (2, 'secondary indexes for login, campaign and participation lookups', _secondary_indexes),
+    (3, 'denormalized usuarios.participation_count', _participation_counter),
+    (4, 'persistent campaign dispatch queue', _dispatch_queue),
+    (5, 'email_logs.job_id and delivery-stats indexes', _email_log_indexes),
+    (6, 'normalized birth date and city for segmentation', _segmentation_columns),
+    (7, 'city_stats dashboard aggregate and table_versions', _city_stats),
+    (8, 'campaign waitlist and exact participantes counter', _waitlist),
+    (9, 'keyset pagination index and non-null sort keys', _pagination_keys),
+    (10, 'bulk donor import jobs and rejected rows', _donor_imports),
+    (11, 'email_logs index for per-job delivery stats', _email_log_job_index),
+    (12, 'invite tokens of donors imported without a password', _donor_import_invites),
+    (13, 'admin flag, hashed password reset tokens, no plaintext invites', _admins_and_reset_tokens),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, target=LATEST_VERSION):
+    """Apply pending migrations up to ``target``; returns the versions applied."""
+    if current_version(conn) >= target:
+        return []
+    applied = []
+    for version, description, apply in MIGRATIONS:
+        if version > target:
+            break
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if current_version(conn) >= version:
+                conn.rollback()
+                continue
+            apply(conn)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logging.info('Migração %d aplicada: %s', version, description)
+        applied.append(version)
+    return applied
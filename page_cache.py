@@ -0,0 +1,102 @@
+"""Rendered-output cache for the public pages.
+
+For anonymous visitors ``index``, ``cadastro``, ``conscientizacao``, the
+``login`` form and ``recuperar`` depend only on a few request inputs (the
+``logged_in`` cookie check and, for conscientizacao, ``nome``). The first
+render for each combination is stored with its gzip (and, when the optional
+``brotli`` package is installed, brotli) encoding precomputed, so later hits
+skip Jinja and compression entirely. Requests from a logged-in session bypass
+the cache. Templates are only read at render time, so a restart picks up
+template changes.
+"""
+import gzip
+import hashlib
+from functools import wraps
+
+from flask import make_response, request, session
+
+from response_cache import LRUCache
+
+try:
+    import brotli
+except ImportError:  # in requirements.txt; without it only gzip is produced
+    brotli = None
+
+
+def _encodings(body):
+    encoded = {'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoded['br'] = brotli.compress(body, quality=11)
+    return encoded
+
+
+class PageCache:
+    """Flask extension providing the ``cached`` decorator for anonymous pages."""
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.entries = LRUCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PAGE_CACHE_ENABLED', True)
+        app.config.setdefault('PAGE_CACHE_ENTRIES', 128)
+        app.config.setdefault('PAGE_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+        self.enabled = bool(app.config['PAGE_CACHE_ENABLED'])
+        self.entries = LRUCache(int(app.config['PAGE_CACHE_ENTRIES']),
+                                int(app.config['PAGE_CACHE_MAX_BYTES']))
+        app.extensions['page_cache'] = self
+
+    def _choose_encoding(self, encoded):
+        accepted = request.accept_encodings
+        for name in ('br', 'gzip'):
+            if name in encoded and accepted[name]:
+                return name
+        return None
+
+    def cached(self, vary=None):
+        """Cache GET renders of an anonymous page.
+
+        ``vary`` returns the request inputs the output depends on (e.g.
+        ``lambda: (cookie_logged_in(), request.args.get('nome'))``).
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if (not self.enabled or request.method not in ('GET', 'HEAD')
+                        or session.get('_user_id')):
+                    return view(*args, **kwargs)
+                key = (request.endpoint, vary() if vary else None)
+                entry = self.entries.get(key)
+                if entry is None:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    body = response.get_data()
+                    encoded = _encodings(body)
+                    entry = {
+                        'etag': hashlib.sha1(body).hexdigest(),
+                        'mimetype': response.mimetype,
+                        'identity': body,
+                        **encoded,
+                    }
+                    self.entries.set(key, entry, len(body) + sum(len(v) for v in encoded.values()))
+
+                encoding = self._choose_encoding(entry)
+                # each encoding is a distinct representation with its own ETag
+                etag = f"{entry['etag']}-{encoding}" if encoding else entry['etag']
+                if request.if_none_match.contains(etag):
+                    response = make_response('', 304)
+                else:
+                    response = make_response(entry[encoding or 'identity'])
+                    response.mimetype = entry['mimetype']
+                    if encoding:
+                        response.headers['Content-Encoding'] = encoding
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = 'no-cache'
+                response.vary.add('Accept-Encoding')
+                response.vary.add('Cookie')
+                return response
+            return wrapper
+        return decorator
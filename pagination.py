@@ -0,0 +1,84 @@
+"""Keyset pagination helpers shared by the list endpoints.
+
+A page is ordered by ``(timestamp, id)`` descending. The cursor is the
+position of the page's last row, wrapped in an opaque URL-safe token, so
+fetching page N costs the same as page 1 (no OFFSET scan).
+"""
+import base64
+import json
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 200
+
+
+class InvalidPageRequest(ValueError):
+    """Bad ``limit``, ``cursor`` or ``fields`` parameter; answered with 400."""
+
+
+def encode_cursor(timestamp, row_id):
+    raw = json.dumps([timestamp, row_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """``(timestamp, id)`` from a token produced by ``encode_cursor``, or None."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        timestamp, row_id = json.loads(raw)
+        return str(timestamp), int(row_id)
+    except (ValueError, TypeError):
+        raise InvalidPageRequest('cursor inválido')
+
+
+def parse_limit(value):
+    """``limit`` query parameter; None (no pagination) when absent."""
+    if value in (None, ''):
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        raise InvalidPageRequest('limit deve ser um inteiro')
+    if limit < 1:
+        raise InvalidPageRequest('limit deve ser positivo')
+    return min(limit, MAX_LIMIT)
+
+
+def parse_fields(value, allowed):
+    """``fields=a,b`` projection restricted to ``allowed``; all of them when absent."""
+    if not value:
+        return tuple(allowed)
+    fields = tuple(f.strip() for f in value.split(',') if f.strip())
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise InvalidPageRequest(f"campos desconhecidos: {', '.join(unknown)}")
+    return fields
+
+
+def keyset_page(conn, select, where, params, order_cols, fields, limit=None, after=None):
+    """Run ``select`` (a SELECT ... FROM ... without WHERE/ORDER BY) as one page.
+
+    ``order_cols`` are the SQL expressions for (timestamp, id), selected as
+    ``_ts``/``_id`` by the caller. Returns ``(rows, next_cursor)`` with each
+    row projected to ``fields``.
+    """
+    ts_col, id_col = order_cols
+    where, params = list(where), list(params)
+    if after is not None:
+        # the first term lets the index seek; the second breaks timestamp ties
+        where.append(f'{ts_col} <= ? AND ({ts_col} < ? OR {id_col} < ?)')
+        params.extend([after[0], after[0], after[1]])
+    sql = select
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += f' ORDER BY {ts_col} DESC, {id_col} DESC'
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit + 1)
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['_ts'], rows[-1]['_id'])
+    return [{f: r[f] for f in fields} for r in rows], next_cursor
@@ -0,0 +1,70 @@
+"""Single-use password reset tokens.
+
+A token is 32 random bytes handed to the user once, inside a link to
+``/redefinir_senha``. Only its SHA-256 digest is stored in
+``password_reset_tokens``: the token is random, so a fast hash is enough, and
+a leaked table gives nobody a way in. Issuing a token for a user replaces
+the unused ones they already had; consuming one sets the new password and
+marks the token used in the same transaction.
+
+Donors imported without a password (donor_import.py) get an unusable
+password from ``unusable_password()`` and a long-lived token as their
+invitation.
+"""
+import hashlib
+import secrets
+from datetime import datetime, timedelta
+
+# ``check_password_hash`` never accepts a value without a "method$" prefix
+UNUSABLE_PREFIX = '!'
+
+
+def _now():
+    return datetime.utcnow().isoformat(timespec='seconds')
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def unusable_password():
+    """A ``usuarios.senha`` value no password matches."""
+    return UNUSABLE_PREFIX + secrets.token_hex(16)
+
+
+def issue(conn, user_id, ttl):
+    """A new token for ``user_id`` valid for ``ttl`` seconds; call inside a write transaction."""
+    # hex: a token never starts with a character spreadsheets read as a
+    # formula, so CSVs of invitation links keep it intact
+    token = secrets.token_hex(32)
+    now = datetime.utcnow()
+    conn.execute('DELETE FROM password_reset_tokens WHERE usuario_id = ? AND used_at IS NULL', (user_id,))
+    conn.execute('''
+        INSERT INTO password_reset_tokens (usuario_id, token_hash, created_at, expires_at)
+        VALUES (?, ?, ?, ?)
+    ''', (user_id, hash_token(token), now.isoformat(timespec='seconds'),
+          (now + timedelta(seconds=ttl)).isoformat(timespec='seconds')))
+    return token
+
+
+def lookup(conn, token):
+    """The user id a still-valid ``token`` belongs to, or None."""
+    if not token:
+        return None
+    row = conn.execute('''
+        SELECT usuario_id FROM password_reset_tokens
+        WHERE token_hash = ? AND used_at IS NULL AND expires_at > ?
+    ''', (hash_token(token), _now())).fetchone()
+    return row[0] if row else None
+
+
+def consume(conn, token, senha_hash):
+    """Set the password of the token's user and spend the token; call inside a
+    write transaction. Returns the user id, or None for an invalid token."""
+    user_id = lookup(conn, token)
+    if user_id is None:
+        return None
+    conn.execute('UPDATE password_reset_tokens SET used_at = ? WHERE token_hash = ?', (_now(), hash_token(token)))
+    conn.execute('DELETE FROM password_reset_tokens WHERE usuario_id = ? AND used_at IS NULL', (user_id,))
+    conn.execute('UPDATE usuarios SET senha = ? WHERE id = ?', (senha_hash, user_id))
+    return user_id
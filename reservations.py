@@ -0,0 +1,112 @@
+"""Seat reservation for campaign participation.
+
+A seat is claimed with one conditional update,
+
+    UPDATE campanhas SET participantes = participantes + 1
+    WHERE id = ? AND participantes < vagas
+
+run inside the IMMEDIATE transaction opened by ``run_write``, so two requests
+can never both take the last seat and ``participantes`` always equals the
+number of ``participacoes`` rows. Campaigns with ``vagas <= 0`` have no limit.
+
+When a campaign is full the user goes on ``lista_espera`` instead, and the
+oldest waiting user is promoted whenever a seat frees up (someone leaves or
+``vagas`` is raised). Every function here is idempotent per (user, campaign):
+repeating a request returns the state it already produced.
+"""
+from datetime import datetime
+
+import gamification
+import versions
+
+JOINED = 'joined'
+ALREADY_JOINED = 'already_joined'
+WAITLISTED = 'waitlisted'
+NOT_FOUND = 'not_found'
+LEFT = 'left'
+LEFT_WAITLIST = 'left_waitlist'
+NOT_PARTICIPATING = 'not_participating'
+
+CLAIM_SEAT_SQL = '''
+    UPDATE campanhas SET participantes = COALESCE(participantes, 0) + 1
+    WHERE id = ? AND (COALESCE(vagas, 0) <= 0 OR COALESCE(participantes, 0) < vagas)
+'''
+
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+
+def waitlist_position(conn, user_id, campaign_id):
+    """1-based position of the user on the campaign's waitlist, or None."""
+    row = conn.execute('''
+        SELECT (SELECT COUNT(*) FROM lista_espera w2
+                WHERE w2.campanha_id = w.campanha_id AND w2.id <= w.id) AS position
+        FROM lista_espera w WHERE w.usuario_id = ? AND w.campanha_id = ?
+    ''', (user_id, campaign_id)).fetchone()
+    return row[0] if row else None
+
+
+def _seat(conn, user_id, campaign_id, joined_at):
+    conn.execute('INSERT INTO participacoes (usuario_id, campanha_id, joined_at) VALUES (?, ?, ?)',
+                 (user_id, campaign_id, joined_at))
+    gamification.apply_participation_delta(conn, user_id, 1)
+    # participantes changed: cached campaign listings are stale
+    versions.bump(conn, 'campanhas')
+
+
+def reserve(conn, user_id, campaign_id):
+    """Claim a seat or a waitlist spot; call inside a write transaction.
+
+    Returns ``(outcome, position)`` where position is set for WAITLISTED.
+    """
+    if conn.execute('SELECT 1 FROM participacoes WHERE usuario_id = ? AND campanha_id = ?',
+                    (user_id, campaign_id)).fetchone():
+        return ALREADY_JOINED, None
+    position = waitlist_position(conn, user_id, campaign_id)
+    if position is not None:
+        return WAITLISTED, position
+
+    if conn.execute(CLAIM_SEAT_SQL, (campaign_id,)).rowcount:
+        _seat(conn, user_id, campaign_id, _now())
+        return JOINED, None
+    if not conn.execute('SELECT 1 FROM campanhas WHERE id = ?', (campaign_id,)).fetchone():
+        return NOT_FOUND, None
+    conn.execute('INSERT INTO lista_espera (usuario_id, campanha_id, joined_at) VALUES (?, ?, ?)',
+                 (user_id, campaign_id, _now()))
+    return WAITLISTED, waitlist_position(conn, user_id, campaign_id)
+
+
+def promote(conn, campaign_id):
+    """Fill free seats from the waitlist, oldest first; returns promoted user ids."""
+    promoted = []
+    while True:
+        waiting = conn.execute('''
+            SELECT id, usuario_id FROM lista_espera WHERE campanha_id = ? ORDER BY id LIMIT 1
+        ''', (campaign_id,)).fetchone()
+        if waiting is None or not conn.execute(CLAIM_SEAT_SQL, (campaign_id,)).rowcount:
+            return promoted
+        conn.execute('DELETE FROM lista_espera WHERE id = ?', (waiting['id'],))
+        _seat(conn, waiting['usuario_id'], campaign_id, _now())
+        promoted.append(waiting['usuario_id'])
+
+
+def release(conn, user_id, campaign_id):
+    """Give up a seat (or a waitlist spot); call inside a write transaction.
+
+    Returns ``(outcome, promoted_user_ids)``.
+    """
+    if conn.execute('DELETE FROM participacoes WHERE usuario_id = ? AND campanha_id = ?',
+                    (user_id, campaign_id)).rowcount:
+        conn.execute('''
+            UPDATE campanhas SET participantes = CASE WHEN COALESCE(participantes, 0) > 0
+                THEN participantes - 1 ELSE 0 END
+            WHERE id = ?
+        ''', (campaign_id,))
+        gamification.apply_participation_delta(conn, user_id, -1)
+        versions.bump(conn, 'campanhas')
+        return LEFT, promote(conn, campaign_id)
+    if conn.execute('DELETE FROM lista_espera WHERE usuario_id = ? AND campanha_id = ?',
+                    (user_id, campaign_id)).rowcount:
+        return LEFT_WAITLIST, []
+    return NOT_PARTICIPATING, []
@@ -0,0 +1,150 @@
+"""Conditional GET and an in-process response cache for read-mostly routes.
+
+A route decorated with ``@response_cache.cached('campanhas')`` gets a strong
+ETag derived from its path, query string, the session user (when the page is
+personalised) and the current versions of the tables it reads. The versions
+come from versions.py without a query, so a matching ``If-None-Match`` is
+answered with 304 before the view or the database is touched. Otherwise the
+rendered body is kept in a bounded LRU and reused for as long as the ETag
+stays the same; any write that bumps one of the tables changes the ETag in
+every worker process.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import make_response, request, session
+
+
+class LRUCache:
+    """Thread-safe mapping that evicts the least recently used entry.
+
+    Bounded by ``max_entries`` and, when given, by ``max_bytes`` summed over
+    the ``size`` passed to ``set``.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=0):
+        with self._lock:
+            self._bytes += size - self._sizes.get(key, 0)
+            self._data[key] = value
+            self._sizes[key] = size
+            self._data.move_to_end(key)
+            while self._data and (len(self._data) > self.max_entries or
+                                  (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                old_key, _ = self._data.popitem(last=False)
+                self._bytes -= self._sizes.pop(old_key)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._data), 'max_entries': self.max_entries,
+                    'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def _templates_fingerprint(app):
+    # a deploy that changes templates must not be answered with old 304s
+    root = os.path.join(app.root_path, app.template_folder or 'templates')
+    digest = hashlib.sha1()
+    for dirpath, _, filenames in sorted(os.walk(root)):
+        for name in sorted(filenames):
+            st = os.stat(os.path.join(dirpath, name))
+            digest.update(f'{dirpath}/{name}:{st.st_size}:{st.st_mtime_ns}'.encode())
+    return digest.hexdigest()[:12]
+
+
+class ResponseCache:
+    """Flask extension providing the ``cached`` decorator."""
+
+    def __init__(self, app=None, versions=None):
+        self.versions = versions
+        self.enabled = True
+        self.entries = LRUCache()
+        self.salt = ''
+        if app is not None:
+            self.init_app(app, versions)
+
+    def init_app(self, app, versions):
+        app.config.setdefault('RESPONSE_CACHE_ENABLED', True)
+        app.config.setdefault('RESPONSE_CACHE_ENTRIES', 256)
+        self.versions = versions
+        self.enabled = bool(app.config['RESPONSE_CACHE_ENABLED'])
+        self.entries = LRUCache(int(app.config['RESPONSE_CACHE_ENTRIES']))
+        self.salt = _templates_fingerprint(app)
+        if 'assets' in app.extensions:
+            # pages embed fingerprinted asset URLs
+            self.salt += app.extensions['assets'].version
+        app.extensions['response_cache'] = self
+
+    def etag_for(self, tables, user_id):
+        counters = self.versions.get(*tables)
+        raw = f'{self.salt}|{request.path}|{request.query_string.decode("latin-1")}|{user_id}|{counters}'
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def cached(self, *tables, vary_user=False):
+        """Cache GET responses of a view that only reads ``tables``.
+
+        With ``vary_user`` the page embeds the logged-in user's data, so the
+        session user id is part of the key (read from the session cookie, not
+        the database).
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or request.method not in ('GET', 'HEAD'):
+                    return view(*args, **kwargs)
+                user_id = session.get('_user_id') if vary_user else None
+                etag = self.etag_for(tables, user_id)
+                cache_control = 'private, no-cache' if vary_user else 'no-cache'
+
+                if request.if_none_match.contains(etag):
+                    response = make_response('', 304)
+                else:
+                    key = (request.path, request.query_string, user_id)
+                    entry = self.entries.get(key)
+                    if entry is not None and entry[0] == etag:
+                        _, body, mimetype = entry
+                        response = make_response(body)
+                        response.mimetype = mimetype
+                    else:
+                        response = make_response(view(*args, **kwargs))
+                        if response.status_code != 200 or response.is_streamed:
+                            return response
+                        body = response.get_data()
+                        self.entries.set(key, (etag, body, response.mimetype), len(body))
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = cache_control
+                if vary_user:
+                    response.vary.add('Cookie')
+                return response
+            return wrapper
+        return decorator
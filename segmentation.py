@@ -0,0 +1,188 @@
+"""Recipient segmentation for campaign dispatch, evaluated in SQL.
+
+Two normalized columns on ``usuarios`` make the filters indexable:
+
+- ``data_nascimento_iso``: ``data_nascimento`` as ``YYYY-MM-DD`` (the form
+  accepts ISO dates; older rows also use ``DD/MM/YYYY``), so an age range
+  becomes a range over birth dates;
+- ``cidade_norm``: the city from ``endereco`` ("..., Bairro - Cidade/UF"),
+  lower-cased and without accents, so "Brasilia" matches "Brasília/DF".
+
+Both are filled at signup and on profile updates, and backfilled by
+migration 6 (or ``flask backfill-segments``).
+
+A ``cidade`` value that is not the city of any user (a neighbourhood such as
+"Taguatinga", a street) keeps matching the way the filter always did: as a
+substring of ``endereco``. Only those values cost a scan.
+"""
+import unicodedata
+from datetime import date, datetime
+
+RECIPIENT_COLUMNS = 'id, nome, email'
+
+
+def normalize_birth_date(value):
+    """``data_nascimento`` as an ISO date string, or None if unparseable."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        if '-' in value:
+            return datetime.fromisoformat(value).date().isoformat()
+        if '/' in value:
+            day, month, year = value.split('/')
+            return date(int(year), int(month), int(day)).isoformat()
+    except ValueError:
+        return None
+    return None
+
+
+def normalize_text(value):
+    decomposed = unicodedata.normalize('NFKD', value)
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch)).strip().lower()
+
+
+def normalize_city(endereco):
+    """City part of a Brazilian address, normalized for matching, or None."""
+    if not endereco or not endereco.strip():
+        return None
+    city = endereco
+    if ' - ' in city:
+        city = city.rsplit(' - ', 1)[1]
+    elif ',' in city:
+        city = city.rsplit(',', 1)[1]
+    # drop the "/UF" state suffix
+    city = city.split('/', 1)[0]
+    city = normalize_text(city)
+    return city or None
+
+
+def normalized_fields(data_nascimento, endereco):
+    return normalize_birth_date(data_nascimento), normalize_city(endereco)
+
+
+def _years_ago(today, years):
+    try:
+        return today.replace(year=today.year - years)
+    except ValueError:
+        # 29/02 in a non-leap target year
+        return today.replace(year=today.year - years, day=28)
+
+
+def _like_pattern(value):
+    escaped = value.strip().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def known_cities(conn, names):
+    """The ``cidade_norm`` values among the normalized ``names`` that some user has."""
+    names = sorted(set(names))
+    if not names:
+        return set()
+    marks = ','.join('?' for _ in names)
+    rows = conn.execute(f'SELECT DISTINCT cidade_norm FROM usuarios WHERE cidade_norm IN ({marks})', names)
+    return {r[0] for r in rows}
+
+
+def build_query(segmentacao, today=None, columns=RECIPIENT_COLUMNS, conn=None):
+    """SQL and parameters selecting recipients for ``segmentacao``.
+
+    Accepts the same keys as /api/admin/send_campaign: tipo_sanguineo (list),
+    genero, cidade (list), interesse, classificacao, min_age, max_age.
+    ``columns`` is the select list (the export asks for more than the dispatch).
+    ``conn`` tells city names from other address fragments; without it every
+    ``cidade`` value is also matched as a substring of ``endereco``.
+    """
+    today = today or datetime.utcnow().date()
+    # written so the planner never picks the email index for this guard;
+    # the segment filters below are the selective ones
+    query = f"SELECT {columns} FROM usuarios WHERE COALESCE(email, '') != ''"
+    params = []
+
+    tipos = segmentacao.get('tipo_sanguineo') or []
+    genero = segmentacao.get('genero') or None
+    cidade_list = segmentacao.get('cidade') or []
+    interesse = segmentacao.get('interesse') or None
+    classificacao = segmentacao.get('classificacao') or None
+    min_age = segmentacao.get('min_age')
+    max_age = segmentacao.get('max_age')
+
+    if tipos:
+        query += f" AND tipo_sanguineo IN ({','.join('?' for _ in tipos)})"
+        params.extend(tipos)
+    if genero:
+        query += " AND genero = ?"
+        params.append(genero)
+    if cidade_list:
+        values = [(city, normalize_city(city)) for city in cidade_list if city and city.strip()]
+        known = known_cities(conn, (n for _, n in values if n)) if conn is not None else set()
+        cities = sorted(known)
+        substrings = [city for city, n in values if n not in known]
+        terms = [f"cidade_norm IN ({','.join('?' for _ in cities)})"] if cities else []
+        terms += ["endereco LIKE ? ESCAPE '\\'"] * len(substrings)
+        query += f" AND ({' OR '.join(terms) or '0'})"
+        params.extend(cities)
+        params.extend(_like_pattern(city) for city in substrings)
+    if interesse and interesse != 'todos':
+        query += " AND interesse = ?"
+        params.append(interesse)
+    if classificacao and classificacao != 'todos':
+        query += " AND primeira_vez = ?"
+        params.append('sim' if classificacao == 'primeira_vez' else classificacao)
+    # age filters become birth-date bounds; rows without a parseable date
+    # (NULL) never match, as before
+    if min_age is not None:
+        query += " AND data_nascimento_iso <= ?"
+        params.append(_years_ago(today, int(min_age)).isoformat())
+    if max_age is not None:
+        query += " AND data_nascimento_iso > ?"
+        params.append(_years_ago(today, int(max_age) + 1).isoformat())
+    return query, params
+
+
+def from_args(args):
+    """``segmentacao`` from query-string arguments (repeat lists: ``?cidade=a&cidade=b``).
+
+    Raises ValueError for a non-numeric age bound.
+    """
+    segmentacao = {}
+    for key in ('tipo_sanguineo', 'cidade'):
+        values = [v for v in args.getlist(key) if v]
+        if values:
+            segmentacao[key] = values
+    for key in ('genero', 'interesse', 'classificacao'):
+        if args.get(key):
+            segmentacao[key] = args[key]
+    for key in ('min_age', 'max_age'):
+        if args.get(key):
+            segmentacao[key] = int(args[key])
+    return segmentacao
+
+
+def iter_recipients(conn, segmentacao, chunk_size=500):
+    """Yield matching recipients as dicts, reading the cursor in chunks."""
+    query, params = build_query(segmentacao, conn=conn)
+    cursor = conn.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        for r in rows:
+            yield {'id': r['id'], 'nome': r['nome'], 'email': r['email']}
+
+
+def backfill(conn, batch_size=1000):
+    """Recompute the normalized columns for every user; returns rows updated."""
+    updated = 0
+    last_id = 0
+    while True:
+        rows = conn.execute('''
+            SELECT id, data_nascimento, endereco FROM usuarios WHERE id > ? ORDER BY id LIMIT ?
+        ''', (last_id, batch_size)).fetchall()
+        if not rows:
+            return updated
+        conn.executemany('''
+            UPDATE usuarios SET data_nascimento_iso = ?, cidade_norm = ? WHERE id = ?
+        ''', [(*normalized_fields(r['data_nascimento'], r['endereco']), r['id']) for r in rows])
+        updated += len(rows)
+        last_id = rows[-1]['id']
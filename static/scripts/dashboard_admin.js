@@ -133,16 +133,13 @@ document.addEventListener('DOMContentLoaded', () => {
 	const refreshBtn = document.querySelector('.refresh') || document.getElementById('refresh');
 	if (refreshBtn) refreshBtn.addEventListener('click', () => { state.data = sampleData.slice(); updateAll(); });
 
-	// Export CSV - button has class 'btn-csv' in template
+	// Export CSV - button has class 'btn-csv' in template. The file is streamed
+	// by the server from city_stats (all cities, scored with the current weights)
 	const exportCsvBtn = document.querySelector('.btn-csv');
 	if (exportCsvBtn) {
 		exportCsvBtn.addEventListener('click', () => {
-			const rows = [['Cidade','Estimativa','Engajamento(%)','Distância (km)','Score']];
-			state.data.slice().sort((a,b)=>b.score-a.score).forEach(d=>rows.push([d.city,d.potential,Math.round((d.engage||0)*100),d.distance,d.score]));
-			const csv = rows.map(r=>r.join(',')).join('\n');
-			const blob = new Blob([csv],{type:'text/csv'});
-			const url = URL.createObjectURL(blob);
-			const a = document.createElement('a'); a.href = url; a.download = 'previsoes_coleta.csv'; document.body.appendChild(a); a.click(); a.remove(); URL.revokeObjectURL(url);
+			const params = new URLSearchParams({ peso_potencial: state.weights.p, peso_engajamento: state.weights.e, peso_logistica: state.weights.l });
+			window.location.href = '/api/admin/export/cities.csv?' + params.toString();
 		});
 	}
 
@@ -133,7 +133,9 @@ function enviarCampanha(agendado, quillInstance) {
             alert('Erro ao enviar campanha: ' + (data.error || response.statusText));
             return;
         }
-        alert(`Campanha enviada. E-mails enviados: ${data.sent || 0}. Falhas: ${data.failed ? data.failed.length : 0}`);
+        // O backend apenas enfileira o disparo; acompanhamos o job até terminar.
+        alert(`Campanha enfileirada para ${data.recipients_count || 0} destinatário(s). Você será avisado ao final do envio.`);
+        acompanharDisparo(data.job_id);
     })
     .catch((error) => {
         console.error('Erro:', error);
@@ -142,6 +144,42 @@ function enviarCampanha(agendado, quillInstance) {
 }
 
 
+// Consultas ao progresso de um disparo: a cada 2 s, por no máximo 30 min
+const INTERVALO_CONSULTA_DISPARO = 2000;
+const MAX_CONSULTAS_DISPARO = 900;
+
+/**
+ * Consulta periodicamente o progresso de um disparo enfileirado.
+ * Para quando o job termina, quando a API responde com erro (404, 401...)
+ * ou depois de MAX_CONSULTAS_DISPARO tentativas.
+ * @param {number} jobId - ID retornado por /api/admin/send_campaign.
+ * @param {number} [tentativa=1] - Número desta consulta.
+ */
+function acompanharDisparo(jobId, tentativa = 1) {
+    if (!jobId) return;
+    fetch(`/api/admin/send_campaign/${jobId}`, {
+        headers: { 'Accept': 'application/json', 'X-Requested-With': 'XMLHttpRequest' },
+        credentials: 'same-origin'
+    })
+    .then((response) => {
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        return response.json();
+    })
+    .then((job) => {
+        if (job.status !== 'done') {
+            if (tentativa >= MAX_CONSULTAS_DISPARO) {
+                alert('O disparo ainda não terminou. Consulte o andamento mais tarde.');
+                return;
+            }
+            setTimeout(() => acompanharDisparo(jobId, tentativa + 1), INTERVALO_CONSULTA_DISPARO);
+            return;
+        }
+        alert(`Campanha enviada. E-mails enviados: ${job.sent || 0}. Falhas: ${job.failed || 0}`);
+    })
+    .catch((error) => console.error('Erro ao consultar disparo:', error));
+}
+
+
 /**
  * Função auxiliar para pegar valores de um <select multiple>.
  * @param {string} selectId - O ID do elemento <select>.
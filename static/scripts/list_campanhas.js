@@ -2,25 +2,104 @@ let campanhaSelecionada = null;
 let botaoSelecionado = null;
 let campanhasAtuais = [];
 let minhasParticipacoesIds = new Set();
+// usuário logado vindo de /api/bootstrap (null quando anônimo)
+let usuarioAtual;
+// Campanhas são carregadas por páginas (cursor devolvido pela API)
+const CAMPANHAS_POR_PAGINA = 20;
+const CAMPOS_CAMPANHA = 'id,nome,tipo_sanguineo,status';
+let proximoCursor = null;
+// Mudanças de campanhas chegam por SSE (/api/campaigns/stream); sem ele a
+// lista é recarregada depois de cada ação, como antes
+let streamAtivo = false;
+
+async function buscarPaginaCampanhas(cursor) {
+  const params = new URLSearchParams({ limit: CAMPANHAS_POR_PAGINA, fields: CAMPOS_CAMPANHA });
+  if (cursor) params.set('cursor', cursor);
+  const res = await fetch(`/api/campaigns?${params}`);
+  if (!res.ok) throw new Error('Falha ao buscar campanhas');
+  return res.json();
+}
 
+// Usuário, participações e primeira página de campanhas numa só requisição;
+// o navegador revalida com If-None-Match e recebe 304 quando nada mudou
 async function carregarCampanhas() {
   const body = document.getElementById('campanhasTableBody');
   body.innerHTML = '<tr class="table-row"><td colspan="3" class="table-loading">Carregando campanhas...</td></tr>';
 
   try {
-    const res = await fetch('/api/campaigns');
+    const params = new URLSearchParams({ limit: CAMPANHAS_POR_PAGINA, fields: CAMPOS_CAMPANHA });
+    const res = await fetch(`/api/bootstrap?${params}`, { credentials: 'same-origin' });
     if (!res.ok) throw new Error('Falha ao buscar campanhas');
     const data = await res.json();
+    usuarioAtual = data.user;
+    minhasParticipacoesIds = new Set((data.participation_ids || []).map(String));
     campanhasAtuais = data.campaigns || [];
+    proximoCursor = data.next_cursor || null;
 
-    await carregarMinhasParticipacoes();
     renderizarTabela(campanhasAtuais);
+    atualizarEstatisticas(minhasParticipacoesIds.size);
   } catch (err) {
     console.error(err);
     body.innerHTML = '<tr class="table-row"><td colspan="3" class="table-loading">Não foi possível carregar campanhas.</td></tr>';
   }
 }
 
+async function carregarMaisCampanhas(botao) {
+  if (!proximoCursor) return;
+  botao.disabled = true;
+  botao.textContent = 'Carregando...';
+  try {
+    const data = await buscarPaginaCampanhas(proximoCursor);
+    // uma campanha criada depois da primeira página pode já ter chegado pelo SSE
+    const ids = new Set(campanhasAtuais.map(c => String(c.id)));
+    campanhasAtuais = campanhasAtuais.concat((data.campaigns || []).filter(c => !ids.has(String(c.id))));
+    proximoCursor = data.next_cursor || null;
+    renderizarTabela(campanhasAtuais);
+  } catch (err) {
+    console.error(err);
+    botao.disabled = false;
+    botao.textContent = 'Carregar mais campanhas';
+  }
+}
+
+function aplicarMudancas(mudancas) {
+  mudancas.forEach(m => {
+    const i = campanhasAtuais.findIndex(c => String(c.id) === String(m.id));
+    if (m.deleted) {
+      if (i >= 0) campanhasAtuais.splice(i, 1);
+    } else if (i >= 0) {
+      campanhasAtuais[i] = Object.assign({}, campanhasAtuais[i], m);
+    } else if (m.created) {
+      // campanha nova: a lista é ordenada da mais recente para a mais antiga.
+      // Mudanças em campanhas de páginas ainda não carregadas são ignoradas
+      // (chegam com a página)
+      const { created, ...campanha } = m;
+      campanhasAtuais.unshift(campanha);
+    }
+  });
+  renderizarTabela(campanhasAtuais);
+}
+
+function acompanharCampanhas() {
+  if (!window.EventSource) return;
+  const fonte = new EventSource('/api/campaigns/stream');
+  fonte.addEventListener('open', () => { streamAtivo = true; });
+  fonte.addEventListener('campaigns', e => aplicarMudancas(JSON.parse(e.data)));
+  fonte.addEventListener('reset', () => carregarCampanhas());
+  fonte.addEventListener('error', () => {
+    // CLOSED: o servidor recusou (503); o navegador reconecta sozinho nos demais casos
+    if (fonte.readyState === EventSource.CLOSED) streamAtivo = false;
+  });
+}
+
+async function atualizarDepoisDeAcao() {
+  if (!streamAtivo) await carregarCampanhas();
+  else {
+    renderizarTabela(campanhasAtuais);
+    atualizarEstatisticas(minhasParticipacoesIds.size);
+  }
+}
+
 function renderizarTabela(campanhas) {
   const body = document.getElementById('campanhasTableBody');
   body.innerHTML = '';
@@ -66,21 +145,28 @@ function renderizarTabela(campanhas) {
     tr.appendChild(tdAcao);
     body.appendChild(tr);
   });
+
+  if (proximoCursor) {
+    const tr = document.createElement('tr');
+    tr.className = 'table-row';
+    const td = document.createElement('td');
+    td.colSpan = 3;
+    td.className = 'table-cell';
+    const btn = document.createElement('button');
+    btn.className = 'participar-button';
+    btn.textContent = 'Carregar mais campanhas';
+    btn.onclick = () => carregarMaisCampanhas(btn);
+    td.appendChild(btn);
+    tr.appendChild(td);
+    body.appendChild(tr);
+  }
 }
 
 async function participarCampanha(botao, campanhaObj) {
-  try {
-    const res = await fetch('/api/me', {
-      method: 'GET',
-      headers: { 'X-Requested-With': 'XMLHttpRequest', 'Accept': 'application/json' },
-      credentials: 'same-origin'
-    });
-    if (res.status === 401) {
-      window.location.href = '/login';
-      return;
-    }
-  } catch (err) {
-    console.warn('Falha ao verificar autenticação:', err);
+  // a sessão já foi verificada por /api/bootstrap; se expirou, o POST responde 401
+  if (usuarioAtual === null) {
+    window.location.href = '/login';
+    return;
   }
 
   campanhaSelecionada = campanhaObj;
@@ -124,11 +210,19 @@ async function confirmarParticipacao() {
         }
         minhasParticipacoesIds.add(String(campaignId));
         mostrarMensagemSucesso('Você já está inscrito nesta campanha.');
-        await carregarCampanhas();
+        await atualizarDepoisDeAcao();
         return;
       }
       const data = await res.json();
       if (!res.ok) throw new Error(data.error || 'Erro ao participar');
+      if (res.status === 202 && data.status === 'waitlisted') {
+        if (botaoSelecionado) {
+          botaoSelecionado.textContent = `Lista de espera (${data.position}º)`;
+          botaoSelecionado.disabled = true;
+        }
+        mostrarMensagemSucesso(`Campanha lotada: você está na lista de espera (posição ${data.position}).`);
+        return;
+      }
 
       if (botaoSelecionado) {
         botaoSelecionado.textContent = 'Participando ✓';
@@ -139,7 +233,7 @@ async function confirmarParticipacao() {
       }
       minhasParticipacoesIds.add(String(campaignId));
       mostrarMensagemSucesso(`Você agora está participando da campanha: ${campanhaSelecionada.nome}`, '/perfil');
-      await carregarCampanhas();
+      await atualizarDepoisDeAcao();
     } else {
       if (botaoSelecionado) {
         botaoSelecionado.textContent = 'Participando ✓';
@@ -149,7 +243,7 @@ async function confirmarParticipacao() {
         if (linha) linha.classList.add('bg-green-50');
       }
       mostrarMensagemSucesso(`Você agora está participando da campanha: ${campanhaSelecionada && (campanhaSelecionada.nome || campanhaSelecionada)}`, '/perfil');
-      await carregarCampanhas();
+      await atualizarDepoisDeAcao();
     }
   } catch (err) {
     console.error(err);
@@ -159,18 +253,6 @@ async function confirmarParticipacao() {
   }
 }
 
-async function carregarMinhasParticipacoes() {
-  try {
-    const res = await fetch('/api/my_participations', { credentials: 'same-origin', headers: { 'X-Requested-With': 'XMLHttpRequest' } });
-    if (!res.ok) return;
-    const data = await res.json();
-    const ids = (data.participations || []).map(p => String(p.id || p.campanha_id || p.campaign_id || p.campanhaId || p.campaignId));
-    minhasParticipacoesIds = new Set(ids);
-  } catch (err) {
-    console.warn('Não foi possível carregar participações do usuário:', err);
-  }
-}
-
 function fecharModal() {
   const modalEl = document.getElementById('confirmModal');
   if (modalEl) modalEl.style.display = 'none';
@@ -206,26 +288,9 @@ document.addEventListener('keydown', function (e) {
   if (e.key === 'Escape') fecharModal();
 });
 
-document.addEventListener('DOMContentLoaded', () => {
-  carregarCampanhas();
-});
-
-async function carregarEstatisticas() {
+function atualizarEstatisticas(participacoesCount) {
   try {
-    // Buscar informações do usuário
-    const resUsuario = await fetch('/api/me', { credentials: 'same-origin' });
-    let usuario = {};
-    if (resUsuario.ok) {
-      usuario = await resUsuario.json();
-    }
-
-    // Buscar participações
-    const resParticipacoes = await fetch('/api/my_participations', { credentials: 'same-origin' });
-    let participacoesCount = 0;
-    if (resParticipacoes.ok) {
-      const dataPart = await resParticipacoes.json();
-      participacoesCount = (dataPart.participations || []).length;
-    }
+    const usuario = usuarioAtual || {};
 
     // Calcular selos (conquistas) no JS
     const selos = [];
@@ -254,8 +319,9 @@ async function carregarEstatisticas() {
   }
 }
 
-// Chama junto com carregarCampanhas
+// O stream é aberto antes da primeira carga para que nenhuma mudança fique
+// entre as duas; as estatísticas vêm junto com carregarCampanhas
 document.addEventListener('DOMContentLoaded', () => {
+  acompanharCampanhas();
   carregarCampanhas();
-  carregarEstatisticas();
 });
@@ -0,0 +1,236 @@
+"""Structured, non-blocking logging for the app and its background threads.
+
+``StructuredLogging.init_app`` replaces the root logger's handlers with a
+``QueueHandler``: the calling thread only merges the message with its
+%-style arguments and puts the record on a bounded queue. A ``QueueListener``
+thread formats it (JSON lines by default) and writes it to stderr. When the
+queue is full, records are dropped and counted instead of blocking the
+request.
+
+Every request gets an id, taken from a sane ``X-Request-ID`` header or
+generated, and echoed back in the response. Each log line written while the
+request runs carries the id and the endpoint. One access line per request
+(method, path without the query string, status, duration) goes to the
+``access`` logger. ``LOG_SAMPLE_RATES`` keeps only a fraction of the
+below-WARNING lines of busy endpoints. The sampling decision is made once
+per request, so a request is logged completely or not at all. Warnings,
+errors and 5xx responses are always kept.
+
+Log messages must not contain personal data; ``mask_email`` is there for
+the few places where an address helps debugging.
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_request_context, request
+
+# Default root level per APP_ENV when LOG_LEVEL is not set
+DEFAULT_LEVELS = {'development': 'DEBUG', 'testing': 'WARNING', 'production': 'INFO'}
+REQUEST_ID_HEADER = 'X-Request-ID'
+_REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+# LogRecord attributes that are not ``extra=`` fields
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'request_id', 'endpoint', 'taskName'}
+
+
+def mask_email(email):
+    """``'maria@example.com'`` -> ``'m***@example.com'``."""
+    if not email or '@' not in email:
+        return '***'
+    local, domain = email.rsplit('@', 1)
+    return f'{local[:1]}***@{domain}'
+
+
+def parse_sample_rates(spec):
+    """``'main.index=0.01,main.api_get_campaigns=0.1'`` -> {endpoint: rate}."""
+    rates = {}
+    for item in (spec or '').split(','):
+        if '=' not in item:
+            continue
+        endpoint, rate = item.split('=', 1)
+        rates[endpoint.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+            entry['endpoint'] = record.endpoint
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'
+
+
+class RequestContextFilter(logging.Filter):
+    """Tag records with the request id/endpoint and apply per-route sampling.
+
+    Runs in the thread that logs, before the record is queued.
+    """
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.endpoint = request.endpoint
+            if record.levelno < logging.WARNING and not g.get('log_sampled', True):
+                return False
+        else:
+            record.request_id = None
+            record.endpoint = None
+        return True
+
+
+class _Listener(QueueListener):
+
+    def enqueue_sentinel(self):
+        # wait for room instead of failing when the queue is full at shutdown
+        self.queue.put(self._sentinel)
+
+
+class BackgroundHandler(QueueHandler):
+    """QueueHandler owning its listener thread.
+
+    The listener is (re)started lazily in whichever process first logs, so a
+    pre-forking server's workers each get their own writer thread.
+    """
+
+    def __init__(self, target, max_queue=10000):
+        super().__init__(queue.Queue(max_queue))
+        self.target = target
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.max_queue)
+            self._listener = _Listener(self.queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """Write out everything still queued and stop the listener."""
+        with self._lock:
+            if self._listener is None or self._pid != os.getpid():
+                return
+            self._listener.stop()
+            self._listener, self._pid = None, None
+
+    def prepare(self, record):
+        # merge the %-args now (they may be mutated later) but leave the
+        # formatting, exception text included, to the listener thread
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredLogging:
+    """Flask extension configuring the root logger and the request log."""
+
+    def __init__(self, app=None):
+        self.handler = None
+        self.sample_rates = {}
+        self.access_log = logging.getLogger('access')
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('APP_ENV', 'development')
+        app.config.setdefault('LOG_LEVEL', None)
+        app.config.setdefault('LOG_FORMAT', None)
+        app.config.setdefault('LOG_ASYNC', True)
+        app.config.setdefault('LOG_QUEUE_SIZE', 10000)
+        app.config.setdefault('LOG_SAMPLE_RATES', '')
+        env = app.config['APP_ENV']
+        level = (app.config['LOG_LEVEL'] or DEFAULT_LEVELS.get(env, 'INFO')).upper()
+        fmt = app.config['LOG_FORMAT'] or ('text' if env == 'development' else 'json')
+        self.sample_rates = parse_sample_rates(app.config['LOG_SAMPLE_RATES'])
+
+        stream = logging.StreamHandler(sys.stderr)
+        stream.setFormatter(JSONFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+        if app.config['LOG_ASYNC']:
+            handler = BackgroundHandler(stream, int(app.config['LOG_QUEUE_SIZE']))
+        else:
+            handler = stream
+        handler.addFilter(RequestContextFilter())
+
+        root = logging.getLogger()
+        if isinstance(self.handler, BackgroundHandler):
+            self.handler.stop()
+        for old in list(root.handlers):
+            root.removeHandler(old)
+        root.addHandler(handler)
+        root.setLevel(level)
+        self.handler = handler
+        if isinstance(handler, BackgroundHandler):
+            handler.start()
+            atexit.register(handler.stop)
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.extensions['structured_logging'] = self
+
+    def _before_request(self):
+        incoming = request.headers.get(REQUEST_ID_HEADER, '')
+        g.request_id = incoming if _REQUEST_ID_RE.match(incoming) else uuid.uuid4().hex[:16]
+        g.log_started = time.perf_counter()
+        rate = self.sample_rates.get(request.endpoint, 1.0)
+        g.log_sampled = rate >= 1.0 or random.random() < rate
+
+    def _after_request(self, response):
+        response.headers[REQUEST_ID_HEADER] = g.get('request_id', '')
+        started = g.get('log_started')
+        if started is not None and self.access_log.isEnabledFor(logging.INFO):
+            level = logging.WARNING if response.status_code >= 500 else logging.INFO
+            self.access_log.log(level, '%s %s %s', request.method, request.path, response.status_code,
+                                extra={'method': request.method, 'path': request.path,
+                                       'status': response.status_code,
+                                       'duration_ms': round((time.perf_counter() - started) * 1000, 2)})
+        return response
+
+    def stats(self):
+        if isinstance(self.handler, BackgroundHandler):
+            return {'queued': self.handler.queue.qsize(), 'dropped': self.handler.dropped}
+        return {'queued': 0, 'dropped': 0}
@@ -0,0 +1,59 @@
+"""The PII exports under /api/admin are for admins only.
+
+    python -m pytest tests
+"""
+import pytest
+
+import app
+
+DONOR = {'nome': 'Doadora', 'email': 'doadora@exemplo.com.br', 'senha': 'senha-doadora',
+         'tipo_sanguineo': 'O+', 'endereco': 'Rua A, 1 - Brasília'}
+ADMIN = {'nome': 'Admin', 'email': 'admin@exemplo.com.br', 'senha': 'senha-admin'}
+EXPORTS = ('/api/admin/export/donors.csv', '/api/admin/export/donors.xlsx',
+           '/api/admin/export/campaigns/1/participants.csv')
+
+
+@pytest.fixture(scope='module')
+def application(tmp_path_factory):
+    path = tmp_path_factory.mktemp('db') / 'database.db'
+    application = app.create_app({'DATABASE': str(path), 'SECRET_KEY': 'test', 'LOG_LEVEL': 'WARNING',
+                                  'BACKGROUND_WORKERS_AUTOSTART': False})
+    application.test_client().post('/submit', data=DONOR)
+    application.test_client().post('/submit', data=ADMIN)
+    result = application.test_cli_runner().invoke(args=['grant-admin', ADMIN['email']])
+    assert result.exit_code == 0, result.output
+    yield application
+    app.db.close()
+
+
+def client_for(application, user):
+    client = application.test_client()
+    response = client.post('/login', data={'email': user['email'], 'password': user['senha']})
+    assert response.status_code == 302
+    return client
+
+
+@pytest.mark.parametrize('path', EXPORTS)
+def test_donor_session_is_forbidden(application, path):
+    response = client_for(application, DONOR).get(path)
+    assert response.status_code == 403
+
+
+@pytest.mark.parametrize('path', EXPORTS)
+def test_anonymous_is_sent_to_login(application, path):
+    response = application.test_client().get(path)
+    assert response.status_code == 302
+    assert '/login' in response.headers['Location']
+
+
+def test_admin_downloads_donors(application):
+    response = client_for(application, ADMIN).get('/api/admin/export/donors.csv',
+                                                  headers={'Accept-Encoding': 'identity'})
+    assert response.status_code == 200
+    body = response.get_data().decode('utf-8-sig')
+    assert DONOR['email'] in body and ADMIN['email'] in body
+
+
+def test_admin_reaches_participants_export(application):
+    response = client_for(application, ADMIN).get('/api/admin/export/campaigns/999/participants.csv')
+    assert response.status_code == 404
@@ -0,0 +1,52 @@
+"""City filter of segmentation.build_query."""
+import sqlite3
+
+import pytest
+
+import segmentation
+from migrations import migrate
+
+ADDRESSES = {
+    'plano@x.com': 'SQS 308 Bloco C, Asa Sul - Brasília/DF',
+    'tagua@x.com': 'QNL 4 Bloco D, Taguatinga Norte (Taguatinga) - Brasilia/DF',
+    'goiania@x.com': 'Rua 10, Setor Oeste - Goiânia/GO',
+    'anapolis@x.com': 'Av. Brasil 50% off, Centro - Anápolis/GO',
+}
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    migrate(conn)
+    conn.executemany('INSERT INTO usuarios (nome, email, endereco, cidade_norm) VALUES (?, ?, ?, ?)',
+                     [('Doador', email, endereco, segmentation.normalize_city(endereco))
+                      for email, endereco in ADDRESSES.items()])
+    yield conn
+    conn.close()
+
+
+def emails(conn, cidade):
+    query, params = segmentation.build_query({'cidade': cidade}, columns='email', conn=conn)
+    return {r['email'] for r in conn.execute(query, params)}
+
+
+def test_city_names_match_normalized_city(conn):
+    assert emails(conn, ['brasilia']) == {'plano@x.com', 'tagua@x.com'}
+    assert emails(conn, ['Goiânia', 'Anapolis']) == {'goiania@x.com', 'anapolis@x.com'}
+
+
+def test_other_values_match_address_substring(conn):
+    assert emails(conn, ['Taguatinga']) == {'tagua@x.com'}
+    assert emails(conn, ['Asa Sul', 'goiânia']) == {'plano@x.com', 'goiania@x.com'}
+
+
+def test_substring_is_literal(conn):
+    assert emails(conn, ['50%']) == {'anapolis@x.com'}
+    assert emails(conn, ['5_%']) == set()
+
+
+def test_known_cities_use_the_index(conn):
+    query, params = segmentation.build_query({'cidade': ['Brasília']}, conn=conn)
+    plan = ' '.join(r[-1] for r in conn.execute('EXPLAIN QUERY PLAN ' + query, params))
+    assert 'cidade_norm' in plan
@@ -0,0 +1,130 @@
+"""Lazily loaded, cached ``usuario`` context for templates and ``load_user``.
+
+The user row, including its participation counter, comes from a single
+primary-key lookup, and the derived level/badge data is cached per user id
+for a short TTL. Templates get proxies that only load the context when they
+actually touch it. Endpoints
+that change a user's row or participations call ``invalidate(user_id)``; other
+worker processes see the change once their TTL expires.
+"""
+import threading
+import time
+
+from flask import g
+from flask_login import current_user
+from werkzeug.local import LocalProxy
+
+import gamification
+from database import get_db
+
+# participation_count is a denormalized column (see gamification.py), so the
+# whole context is one primary-key lookup.
+USER_CONTEXT_SQL = 'SELECT * FROM usuarios WHERE id = ?'
+
+
+class TTLCache:
+    """Small thread-safe cache whose entries expire after ``ttl`` seconds."""
+
+    def __init__(self, ttl=5.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.max_entries:
+                # dicts keep insertion order: drop the oldest entry
+                self._data.pop(next(iter(self._data)))
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+cache = TTLCache()
+
+
+def configure(ttl):
+    cache.ttl = float(ttl)
+
+
+def invalidate(user_id):
+    cache.invalidate(int(user_id))
+
+
+def build_context(row):
+    """Derive the template ``usuario`` dict and ``all_selos`` from a user row."""
+    usuario = dict(row)
+    fields, all_selos = gamification.progress(usuario)
+    usuario.update(fields)
+    return {'usuario': usuario, 'all_selos': all_selos}
+
+
+# default anonymous usuario to avoid template errors
+ANONYMOUS_CONTEXT = {
+    'usuario': {
+        'nivel': 'Doador Iniciante',
+        'progressoPercentual': 0,
+        'next_level_name': None,
+        'progress_text': '0/1',
+        'participations_to_next': 1,
+        'selos': [],
+        'participation_count': 0
+    },
+    # also include all_selos for anonymous users (all locked)
+    'all_selos': gamification.anonymous_all_selos(),
+}
+
+
+def get_user_context(user_id):
+    """Return the cached context for ``user_id``, loading it with one query on a miss."""
+    user_id = int(user_id)
+    ctx = cache.get(user_id)
+    if ctx is None:
+        row = get_db().execute(USER_CONTEXT_SQL, (user_id,)).fetchone()
+        if row is None:
+            return None
+        ctx = build_context(row)
+        cache.set(user_id, ctx)
+    return ctx
+
+
+def current_context():
+    """Context for the logged-in user of this request, resolved at most once."""
+    if '_usuario_ctx' not in g:
+        ctx = None
+        try:
+            if getattr(current_user, 'is_authenticated', False):
+                ctx = get_user_context(current_user.id)
+        except Exception:
+            ctx = None
+        g._usuario_ctx = ctx or ANONYMOUS_CONTEXT
+    return g._usuario_ctx
+
+
+def template_proxies():
+    """Values for a context processor; nothing is loaded until a template reads them."""
+    return {
+        'usuario': LocalProxy(lambda: current_context()['usuario']),
+        'all_selos': LocalProxy(lambda: current_context()['all_selos']),
+    }
@@ -0,0 +1,105 @@
+"""Per-table version counters shared by every worker process.
+
+Write paths call ``bump(conn, 'campanhas')`` inside their transaction; the
+counter lives in ``table_versions`` so it commits or rolls back with the data.
+After a commit that bumped something, a small stamp file next to the database
+is replaced. Readers ``stat`` that file and only re-read ``table_versions``
+when it changed, so checking whether cached data is current costs no query.
+"""
+import logging
+import os
+import threading
+import uuid
+
+BUMP_SQL = '''
+    INSERT INTO table_versions (name, version) VALUES (?, 1)
+    ON CONFLICT(name) DO UPDATE SET version = version + 1
+'''
+
+# connections (by id) that bumped a counter in their open transaction
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def bump(conn, *names):
+    """Increment the counters for ``names``; call inside a write transaction."""
+    for name in names:
+        conn.execute(BUMP_SQL, (name,))
+    with _pending_lock:
+        _pending.add(id(conn))
+
+
+def version(conn, name):
+    row = conn.execute('SELECT version FROM table_versions WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else 0
+
+
+class TableVersions:
+    """Flask extension answering ``current()`` from the stamp file."""
+
+    def __init__(self, app=None, database=None):
+        self.database = database
+        self.stamp_path = None
+        self._cached = None
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.reloads = 0
+        if app is not None:
+            self.init_app(app, database)
+
+    def init_app(self, app, database):
+        app.config.setdefault('VERSION_STAMP_PATH', app.config['DATABASE'] + '-versions')
+        self.database = database
+        self.stamp_path = app.config['VERSION_STAMP_PATH']
+        database.on_transaction_end(self._transaction_ended)
+        if not os.path.exists(self.stamp_path):
+            self.touch()
+        app.extensions['versions'] = self
+
+    def _transaction_ended(self, conn, committed):
+        with _pending_lock:
+            if id(conn) not in _pending:
+                return
+            _pending.discard(id(conn))
+        if committed:
+            self.touch()
+            for listener in self._listeners:
+                listener()
+
+    def add_listener(self, fn):
+        """Call ``fn()`` after each local commit that bumped a counter."""
+        self._listeners.append(fn)
+
+    def touch(self):
+        """Tell other processes the counters changed (a new inode every time)."""
+        tmp = f'{self.stamp_path}.{os.getpid()}.{uuid.uuid4().hex}'
+        try:
+            with open(tmp, 'w') as fh:
+                fh.write(tmp)
+            os.replace(tmp, self.stamp_path)
+        except OSError:
+            logging.exception('Falha ao atualizar %s', self.stamp_path)
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.stamp_path)
+            return st.st_ino, st.st_mtime_ns
+        except OSError:
+            return None
+
+    def current(self):
+        """All counters as a dict; cached until the stamp file changes."""
+        stamp = self._stamp()
+        cached = self._cached
+        if stamp is not None and cached is not None and cached[0] == stamp:
+            return cached[1]
+        with self.database.connection() as conn:
+            counters = dict(conn.execute('SELECT name, version FROM table_versions').fetchall())
+        with self._lock:
+            self._cached = (stamp, counters)
+            self.reloads += 1
+        return counters
+
+    def get(self, *names):
+        counters = self.current()
+        return tuple(counters.get(name, 0) for name in names)
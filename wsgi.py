@@ -0,0 +1,13 @@
+"""WSGI entry point for production.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+gunicorn.conf.py preloads this module in the master process and applies the
+schema migrations there once, before any worker is forked. Any other WSGI
+server can serve ``wsgi:app`` too; with ``AUTO_MIGRATE`` each process then
+migrates on its first request, and ``start_background_workers()`` has to be
+called in each worker process.
+"""
+from app import create_app
+
+app = application = create_app()